@@ -3,12 +3,11 @@
 
 # My imports
 from __future__ import division
-import os
 import pandas as pd
-import numpy as np
 from aresDriver import aresdriver
 from ewDriver import EWmethod
 from abundanceDriver import AbundanceDriver
+from resultstore import ResultsTable
 from time import time
 
 '''Get from the spectrum to parameters and abundances'''
@@ -16,8 +15,14 @@ from time import time
 
 class FullSpectralAnalysis:
 
+    # The first columns of FASMA_all.dat, the elements follow
+    columns = ['spectrum', 'SNR', 'Teff', 'dTeff', 'logg', 'dlogg', '[Fe/H]', 'd[Fe/H]', 'vt', 'dvt']
+
     def __init__(self, cfgfile='StarMe_all.cfg'):
         self.cfgfile = cfgfile
+        self.results = ResultsTable('FASMA_all.dat', 'fasma', columns=self.columns, na='....')
+        # The tables of the drivers, which are written once at the end
+        self.tables = {}
 
     def _options(self, options=None):
         '''Reads the options inside the config file.
@@ -156,7 +161,9 @@ class FullSpectralAnalysis:
             p = ' '.join(map(str, self.initial))
             linelist = self.spectrum.replace('.fits', '.moog')
             fout.write('{0} {1} {2}'.format(linelist, p, opt))
-        self.params = EWmethod(cfgfile='StarMe_all2.cfg').ewdriver()[:-4]
+        driver = EWmethod(cfgfile='StarMe_all2.cfg')
+        self.params = driver.ewdriver(export=False)[:-4]
+        self.tables['ew'] = driver.results
         # self.params = ewdriver('StarMe_all2.cfg')[:-4]
 
     def abundances(self):
@@ -183,11 +190,16 @@ class FullSpectralAnalysis:
             s = self.spectrum.rpartition('.')
             linelist = s[0] + '_sec.moog'
             fout.write('{0} {1} {2}'.format(linelist, p, opt))
-        self.abundance = AbundanceDriver(cfgfile='StarMe_all3.cfg').abundancedriver()
+        driver = AbundanceDriver(cfgfile='StarMe_all3.cfg')
+        self.abundance = driver.abundancedriver(export=False)
+        self.tables['abundances'] = driver.results
 
     def saveResults(self, dict):
         '''Would like to have:
         spectrum, SNR, parameters, abundances, options
+
+        The results are added to FASMA_all.db, and FASMA_all.dat is written
+        from there at the end of get_all (see resultstore.py)
         '''
         spectrum = dict.pop('spectrum')
         snr = dict.pop('SNR')
@@ -201,69 +213,25 @@ class FullSpectralAnalysis:
         vterr = dict.pop('vterr')
         options = dict.pop('options')
         dict = dict.pop('abundances')
-        elements = dict.keys()
-
-        def _get_header(elements):
-            """Get the header and append new elements to it"""
-            with open('FASMA_all.dat', 'r') as f:
-                header = f.readline()
-            header = header.strip('\n').split(',')
-            for element in elements:
-                if element not in header:
-                    header.append(element)
-            return ','.join(header)
-
-        if not os.path.isfile('FASMA_all.dat'):
-            # The file does not exists, so create it and return from here
-            header = 'spectrum,SNR,Teff,dTeff,logg,dlogg,[Fe/H],d[Fe/H],vt,dvt,' + ','.join(elements)
-            with open('FASMA_all.dat', 'w') as fout:
-                fout.writelines(header + '\n')
-                line = '%s,%i,%i,%i,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f' % (spectrum, snr, teff, tefferr, logg, loggerr, feh, feherr, vt, vterr)
-                for element in elements:
-                    line += ',%s' % dict[element]
-                fout.writelines(line + '\n')
-            return
-        else:
-            header = _get_header(elements)
 
-        try:
-            # Setting previous elements to nan if they do nos exists
-            df = pd.read_csv('FASMA_all.dat', na_values='....')
-            header = header.split(',')
-            for key in header:
-                if key not in df.columns:
-                    df[key] = np.nan
-            df.to_csv(path_or_buf='FASMA_all.dat', header=header, index=False, na_rep='....')
-        except IOError:
-            # It does not exists yet, so create the file from scratch
-            with open('FASMA_all.dat', 'w') as fout:
-                fout.writelines(header + '\n')
-
-        df = pd.read_csv('FASMA_all.dat', na_values='....')
-        rows = df.shape[0]
-        for element in header[10:]:
-            if element in elements:
-                df[element] = dict[element]
-            else:
-                df[element] = np.nan
-        df['spectrum'] = spectrum
-        df['SNR'] = snr
-        df['Teff'] = teff
-        df['dTeff'] = tefferr
-        df['logg'] = logg
-        df['dlogg'] = loggerr
-        df['[Fe/H]'] = feh
-        df['d[Fe/H]'] = feherr
-        df['vt'] = vt
-        df['dvt'] = vterr
-
-        if rows:
-            df.drop(df.index[range(rows-1)], inplace=True)
-
-        df.to_csv(path_or_buf='FASMA_all.dat', header=False, index=False, mode='a', na_rep='....')
+        row = [('spectrum', spectrum), ('SNR', int(snr)), ('Teff', int(teff)), ('dTeff', int(tefferr)),
+               ('logg', round(logg, 2)), ('dlogg', round(loggerr, 2)), ('[Fe/H]', round(feh, 2)),
+               ('d[Fe/H]', round(feherr, 2)), ('vt', round(vt, 2)), ('dvt', round(vterr, 2))]
+        row += [(element, dict[element]) for element in dict.keys()]
+        self.results.add(spectrum, row)
 
     def get_all(self):
         '''Get EW measurements, parameters from EW method, and abundances'''
+        try:
+            self._get_all()
+        finally:
+            # FASMA_all.dat, EWresults.dat and abundresults.dat are only
+            # written once, whatever the number of stars
+            self.results.export()
+            for table in self.tables.values():
+                table.export()
+
+    def _get_all(self):
         with open(self.cfgfile, 'r') as stars:
             for star in stars:
                 if not star[0].isalpha():  # Skip comments
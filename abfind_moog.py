@@ -5,9 +5,8 @@
 from __future__ import division, print_function
 import numpy as np
 import matplotlib.pyplot as plt
-from utils import Readmoog
+from utils import Readmoog, linfit
 from interpolation import interpolator
-import statsmodels.formula.api as sm
 import os
 import argparse
 
@@ -42,14 +41,11 @@ def plot_data(data, outlier=False, version=2014):
     s = 3*np.std(abund)
 
     data = {'EP': EP, 'logRW': logRW, 'abund': abund, 'sig': sig, 'wave': wave}
-    w = np.ones(len(data['abund']))
 
-    z1 = sm.wls('abund ~ EP', data=data, weights=w).fit().params
-    z1 = [z1[1], z1[0]]
+    z1 = linfit(EP, abund)[:2]
     p1 = np.poly1d(z1)
 
-    z2 = sm.wls('abund ~ logRW', data=data, weights=w).fit().params
-    z2 = [z2[1], z2[0]]
+    z2 = linfit(logRW, abund)[:2]
     p2 = np.poly1d(z2)
 
     plt.figure(figsize=(8, 9))
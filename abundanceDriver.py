@@ -10,6 +10,7 @@ import pandas as pd
 from loggf_update import update_loggf
 from interpolation import interpolator
 from utils import _update_par, _run_moog, Readmoog
+from resultstore import ResultsTable, fingerprint
 
 pd.set_option('display.max_rows', 500)
 pd.set_option('display.max_columns', 500)
@@ -18,12 +19,35 @@ pd.set_option('display.width', 1000)
 
 class AbundanceDriver:
 
-    def __init__(self, cfgfile='StarMe_abund.cfg', overwrite=None):
+    # The first columns of abundresults.dat, the elements follow
+    columns = ['linelist', 'temperature', 'logg', '[Fe/H]', 'vt']
+    formats = {'temperature': '%i', 'logg': '%.2f', '[Fe/H]': '%.2f', 'vt': '%.2f'}
+
+    def __init__(self, cfgfile='StarMe_abund.cfg', overwrite=None, store='abundresults.db', resume=False):
+        """Derive abundances for the line lists in the configuration file
+
+        Input
+        -----
+        cfgfile : str
+          Configuration file (default: StarMe_abund.cfg)
+        overwrite : bool
+          Remove the results of earlier runs (default: False)
+        store : str
+          The store with the results of all runs, see resultstore.py
+          (default: abundresults.db)
+        resume : bool
+          Skip the line lists which are done with the same inputs, i.e. the
+          same line list, parameters and options (see _digest). The log of
+          the earlier runs is kept (default: False)
+        """
         self.cfgfile = cfgfile
         self.overwrite = overwrite
+        self.resume = resume
+        self.results = ResultsTable('abundresults.dat', 'abundances', columns=self.columns,
+                                    formats=self.formats, store=store)
 
         # Setup of logger
-        if os.path.isfile('captain.log'):  # Cleaning from previous runs
+        if not resume and os.path.isfile('captain.log'):  # Cleaning from previous runs
             os.remove('captain.log')
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
@@ -44,7 +68,7 @@ class AbundanceDriver:
         # Create results directory
         if not os.path.isdir('results'):
             os.mkdir('results')
-            logger.info('results directory was created')
+            self.logger.info('results directory was created')
 
     def _options(self, options=None):
         '''Reads the options inside the config file'''
@@ -64,71 +88,31 @@ class AbundanceDriver:
             defaults['model'] = defaults['model'].lower()
             self.options = defaults
 
-    def save(self):
-        """Write results"""
+    def _digest(self, linelist):
+        """The hash of the inputs of a line list, with the current parameters
+        and options (see resultstore.fingerprint). The loggf of the line list
+        are left out, since they are replaced for the model (see update_loggf).
+        None if the line list can not be read."""
+        try:
+            lines = np.loadtxt('linelist/%s' % linelist, skiprows=1, usecols=(0, 1, 2, 4), ndmin=2)
+        except (IOError, ValueError, IndexError):
+            return None
+        return fingerprint([lines.tolist(), list(self.initial), self.options])
+
+    def save(self, key=None, digest=None):
+        """Add the results of the current line list to the store, with the
+        line of the configuration file and the hash of its inputs (see
+        _digest). Only this star is written, whatever the number of stars
+        already there."""
         linelist = self.abundance_dict.pop('linelist')
         teff = self.abundance_dict.pop('Temperature')
         logg = self.abundance_dict.pop('Gravity')
         feh = self.abundance_dict.pop('[Fe/H]')
         vt = self.abundance_dict.pop('microturbulence')
-        elements = self.abundance_dict.keys()
-
-        def _get_header(elements):
-            """Get the header and append new elements to it"""
-            with open('abundresults.dat', 'r') as f:
-                header = f.readline()
-            header = header.strip('\n').split(',')
-            for element in elements:
-                if element not in header:
-                    header.append(element)
-            return ','.join(header)
-
-        if not os.path.isfile('abundresults.dat'):
-            # The file does not exists, so create it and return from here
-            header = 'linelist,temperature,logg,[Fe/H],vt,' + ','.join(elements)
-            with open('abundresults.dat', 'w') as fout:
-                fout.writelines(header + '\n')
-                line = '%s,%i,%.2f,%.2f,%.2f' % (linelist, teff, logg, feh, vt)
-                for element in elements:
-                    line += ',%s' % self.abundance_dict[element]
-                fout.writelines(line + '\n')
-            return
-        else:
-            header = _get_header(elements)
-
-        if self.overwrite:
-            with open('abundresults.dat', 'w') as fout:
-                fout.writelines(header + '\n')
-        else:
-            try:
-                df = pd.read_csv('abundresults.dat', na_values='...')
-                header = header.split(',')
-                for key in header:
-                    if key not in df.columns:
-                        df[key] = np.nan
-                df.to_csv(path_or_buf='abundresults.dat', header=header, index=False, na_rep='...')
-            except IOError:
-                # It does not exists yet, so create the file from scratch
-                with open('abundresults.dat', 'w') as fout:
-                    fout.writelines(header + '\n')
-
-        df = pd.read_csv('abundresults.dat', na_values='...')
-        rows = df.shape[0]
-        for element in header[5:]:
-            if element in elements:
-                df[element] = self.abundance_dict[element]
-            else:
-                df[element] = np.nan
-        df['linelist'] = linelist
-        df['temperature'] = teff
-        df['logg'] = logg
-        df['[Fe/H]'] = feh
-        df['vt'] = vt
-
-        if rows:
-            df.drop(df.index[range(rows-1)], inplace=True)
-
-        df.to_csv(path_or_buf='abundresults.dat', header=False, index=False, mode='a', na_rep='...')
+        row = [('linelist', linelist), ('temperature', int(teff)), ('logg', round(logg, 2)),
+               ('[Fe/H]', round(feh, 2)), ('vt', round(vt, 2))]
+        row += [(element, abundance) for element, abundance in self.abundance_dict.items()]
+        self.results.add(linelist, row, key=key, digest=digest)
 
     def weighted_avg_and_std(self, values):
         """Get the weighted average and standard deviation.
@@ -153,14 +137,21 @@ class AbundanceDriver:
         std = np.sqrt(np.average((values-average)**2, weights=weights_rounded))
         return average, std
 
-    def abundancedriver(self):
+    def abundancedriver(self, export=True):
         """The function that glues everything together
 
+        Input
+        -----
+        export : bool
+          Write abundresults.dat at the end (default: True)
+
         Output
         ------
         abundresults.dat : file
           Easy readable table with results from many linelists
         """
+        if self.overwrite:
+            self.results.clear()
 
         with open(self.cfgfile, 'r') as lines:
             for line in lines:
@@ -204,6 +195,11 @@ class AbundanceDriver:
                     self.logger.error('Your request for type: %s is not available' % self.options['model'])
                     continue
 
+                digest = self._digest(line[0])
+                if self.resume and self.results.done(' '.join(line), digest):
+                    self.logger.info('Skipping line list (done with the same inputs): %s' % line[0])
+                    continue
+
                 update_loggf(self.options['model'], 'linelist/%s' % line[0], region='ABoptical')
                 # Get the initial grid models
                 self.logger.info('Interpolation of model...')
@@ -227,8 +223,11 @@ class AbundanceDriver:
                         abundance = sub_table.abund.values[0]
                     self.abundance_dict[element] = abundance
 
-                self.save()
+                self.save(key=' '.join(line), digest=digest)
 
+        # Write abundresults.dat with a column for each element
+        if export:
+            self.results.export()
         return self.abundance_dict
 
     def to_screen(self):
@@ -248,10 +247,12 @@ class AbundanceDriver:
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) > 1:
-        cfgfile = sys.argv[1]
+    resume = '--resume' in sys.argv
+    argv = [arg for arg in sys.argv if arg != '--resume']
+    if len(argv) > 1:
+        cfgfile = argv[1]
     else:
         cfgfile = 'StarMe_abund.cfg'
-    driver = AbundanceDriver(cfgfile=cfgfile)
+    driver = AbundanceDriver(cfgfile=cfgfile, resume=resume)
     _ = driver.abundancedriver()
     driver.to_screen()
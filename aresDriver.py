@@ -5,16 +5,21 @@
 from __future__ import division, print_function
 import logging
 import os
+import subprocess
 from shutil import copyfile
 from glob import glob
+from multiprocessing import Pool
 import numpy as np
 import decimal
 import pandas as pd
+from utils import scratch
+from resultstore import ResultStore, fingerprint
 
 
 def _run_ares():
-    """Run ARES"""
-    os.system('ARES > /dev/null')
+    """Run ARES with mine.opt in the current directory"""
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['ARES'], stdout=devnull)
     for tmp in ['tmp', 'tmp2', 'tmp3']:
         if os.path.isfile(tmp):
             os.remove(tmp)
@@ -23,7 +28,7 @@ def round_up0(i):
     """Round up to 2nd decimal because of stupid python"""
 
     rounded = decimal.Decimal(str(i)).quantize(decimal.Decimal('1.11'), rounding=decimal.ROUND_HALF_UP)
-    return np.float(rounded)
+    return float(rounded)
 
 def get_snr(fname='logARES.txt'):
     """Get the SNR from ARES
@@ -227,19 +232,135 @@ def aresRunner(linelist, spectrum, out, options):
         raise IOError('ARES did not run properly. Take a look at "logARES.txt" for more help.')
     print('\n')
 
-def aresdriver(starLines='StarMe_ares.cfg'):
+def _readLine(line):
+    """The line list, spectrum and options from a line in the configuration
+    file, or None if the line can not be used
+
+    Input
+    -----
+    line : list
+      A line from the configuration file after being split at spaces
+
+    Output
+    ------
+    line_list : str
+      The line list in rawLinelist
+    spectrum : str
+      The spectrum, in spectra or the path to it
+    options : dict
+      The options for ARES (see _options)
+    """
+    if len(line) == 2:
+        options = _options()
+    elif len(line) == 3:
+        options = _options(line[-1])
+    else:
+        return None
+    line_list = line[0]
+    spectrum = line[1]
+
+    if not options['output']:
+        options['output'] = '%s.ares' % spectrum.rpartition('/')[2].rpartition('.')[0]
+    if os.path.isfile('spectra/%s' % spectrum):
+        options['fullpath'] = False
+    elif os.path.isfile(spectrum):
+        options['fullpath'] = True
+        # The spectrum is read from the scratch directory
+        spectrum = os.path.abspath(spectrum)
+    else:
+        return None
+    return line_list, spectrum, options
+
+
+def _aresStar(job):
+    """Measure the EWs in a spectrum inside its own scratch directory, with
+    its own mine.opt and logARES.txt. The line lists are copied in, and the
+    results are copied to linelist afterwards.
+
+    Input
+    -----
+    job : tuple
+      (line_list, spectrum, options) from _readLine
+
+    Output
+    ------
+    snr : int
+      The SNR from ARES (None if not found)
+    """
+    line_list, spectrum, options = job
+    root = os.getcwd()
+    out = options['output']
+    with scratch(links=('spectra',), dirs=('linelist', 'rawLinelist')):
+        for fname in (line_list, options['extra']):
+            if fname is not None:
+                copyfile(os.path.join(root, 'rawLinelist', fname), os.path.join('rawLinelist', fname))
+        try:
+            aresRunner(line_list, spectrum, out, options)
+            if options['extra'] is not None:
+                # A copy, so the job still has the output of the first line list
+                out = out.replace('.ares', '_sec.ares')
+                aresRunner(options['extra'], spectrum, out, dict(options, output=out))
+        except IOError:
+            # Keep the log of ARES to see what went wrong
+            if os.path.isfile('logARES.txt'):
+                copyfile('logARES.txt', os.path.join(root, 'logARES.txt'))
+            raise
+        try:
+            snr = get_snr()
+        except (IOError, IndexError):
+            snr = None
+        for fname in glob('linelist/*'):
+            copyfile(fname, os.path.join(root, fname))
+    return snr
+
+
+def _digest(job):
+    """The hash of the inputs of a spectrum: the spectrum, the line lists and
+    the options (see resultstore.fingerprint)
+
+    Input
+    -----
+    job : tuple
+      (line_list, spectrum, options) from _readLine
+
+    Output
+    ------
+    digest : str
+      The hash, or None if a file is missing
+    """
+    line_list, spectrum, options = job
+    files = [spectrum if options['fullpath'] else 'spectra/%s' % spectrum]
+    files += ['rawLinelist/%s' % fname for fname in (line_list, options['extra']) if fname is not None]
+    return fingerprint([line_list, options], files=files)
+
+
+def _output(job):
+    """The line list from ARES for a spectrum"""
+    return 'linelist/%s' % job[2]['output'].replace('.ares', '.moog')
+
+
+def aresdriver(starLines='StarMe_ares.cfg', processes=1, resume=False, store='aresresults.db'):
     """The function that glues everything together
 
     Input:
     starLines   -   Configuration file (default: StarMe_ares.cfg)
+    processes   -   Number of spectra to measure at the same time. Each one
+                    runs in its own scratch directory (default: 1)
+    resume      -   Skip the spectra which are measured with the same inputs,
+                    i.e. the same spectrum, line lists and options, and the
+                    line list from ARES is still there (default: False)
+    store       -   The store with the hash of the inputs of each spectrum
+                    (default: aresresults.db, see resultstore.py)
 
     Output:
     <linelist>.out          -   Output file
+    snr                     -   The SNR of the last spectrum
     """
-    try:  # Cleaning from previous runs
-        os.remove('captain.log')
-    except OSError:
-        pass
+    if not resume:
+        try:  # Cleaning from previous runs
+            os.remove('captain.log')
+        except OSError:
+            pass
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
     handler = logging.FileHandler('captain.log')
@@ -258,6 +379,8 @@ def aresdriver(starLines='StarMe_ares.cfg'):
         logger.info('linelist directory was created')
         raise IOError('Please put linelists in rawLinelist folder')
 
+    store = ResultStore(store)
+    jobs, digests = [], []
     with open(starLines, 'r') as lines:
         for line in lines:
             if not line[0].isalpha():
@@ -267,45 +390,38 @@ def aresdriver(starLines='StarMe_ares.cfg'):
             line = line.strip()
             line = line.split(' ')
 
-            if len(line) == 2:
-                options = _options()
-                line_list = line[0]
-                spectrum = line[1]
-            elif len(line) == 3:
-                options = _options(line[-1])
-                line_list = line[0]
-                spectrum = line[1]
-            else:
+            job = _readLine(line)
+            if job is None:
                 logger.error('Could not process information for this line: %s' % line)
                 continue
-
-            if options['output']:
-                out = options['output']
-            else:
-                out = '%s.ares' % spectrum.rpartition('/')[2].rpartition('.')[0]
-                options['output'] = out
-            if os.path.isfile('spectra/%s' % spectrum):
-                options['fullpath'] = False
-            elif os.path.isfile(spectrum):
-                options['fullpath'] = True
-            else:
+            digest = _digest(job)
+            if resume and store.done('ares', job[2]['output'], digest) and os.path.isfile(_output(job)):
+                logger.info('Skipping spectrum (done with the same inputs): %s' % job[1])
                 continue
+            jobs.append(job)
+            digests.append(digest)
 
-            aresRunner(line_list, spectrum, out, options)
-            if options['extra'] is not None:
-                line_list = options['extra']
-                out = out.replace('.ares', '_sec.ares')
-                options['output'] = out
-                aresRunner(line_list, spectrum, out, options)
-
-    snr = get_snr()
-    os.remove('logARES.txt')
+    snr = None
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        results = pool.imap(_aresStar, jobs) if pool is not None else (_aresStar(job) for job in jobs)
+        # Each spectrum is added to the manifest as soon as it is measured
+        for job, digest, snr in zip(jobs, digests, results):
+            row = [('linelist', _output(job)), ('spectrum', job[1]), ('snr', snr)]
+            store.add('ares', job[1], row, key=job[2]['output'], digest=digest)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return snr
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) > 1:
-        cfgfile = sys.argv[1]
+    resume = '--resume' in sys.argv
+    argv = [arg for arg in sys.argv if arg != '--resume']
+    if len(argv) > 1:
+        cfgfile = argv[1]
     else:
         cfgfile = 'StarMe_ares.cfg'
-    _ = aresdriver(starLines=cfgfile)
+    processes = int(argv[2]) if len(argv) > 2 else 1
+    _ = aresdriver(starLines=cfgfile, processes=processes, resume=resume)
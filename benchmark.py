@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''Benchmarks of the hot paths of FASMA, written as JSON.
+
+Run from the root of FASMA (where models and linelist are):
+
+    python benchmark.py
+    python benchmark.py -o new.json --compare benchmark.json
+
+Benchmarks which need something that is not there (e.g. the models of an
+atmosphere type, or MOOGSILENT) are written as skipped with the reason. Any
+other error stops the run. With --compare the medians are compared to an
+earlier run, and the exit status is 1 if any of them got slower than the
+tolerance, or did not run this time.
+'''
+
+# My imports
+from __future__ import division, print_function
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+from glob import glob
+from shutil import copyfile
+import numpy as np
+
+timer = getattr(time, 'perf_counter', time.time)
+linelist = 'linelist/sun_harps_ganymede.moog'
+summary = 'results/sun_harps_ganymede.moog.out'
+sun = [5777, 4.44, 0.00, 1.00]
+
+
+def _which(program):
+    '''The path to an executable in PATH, or None'''
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        fname = os.path.join(path, program)
+        if os.path.isfile(fname) and os.access(fname, os.X_OK):
+            return fname
+    return None
+
+
+def _clear_caches():
+    '''Forget the interpolated atmospheres and the results from MOOG, so each
+    run starts cold'''
+    from interpolation import _structures
+    from utils import moog_cache, line_cache
+    _structures.clear()
+    moog_cache.clear()
+    line_cache.clear()
+
+
+def _meta():
+    '''Information about the machine and the version of the code'''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+            'moog': _which('MOOGSILENT')}
+
+
+def _missing(requires):
+    '''The reason a benchmark can not run, or None if all it needs is there.
+    requires has MOOGSILENT, files, or folders which must not be empty, e.g.
+    models/kurucz95'''
+    for need in requires:
+        if need == 'MOOGSILENT':
+            if _which(need) is None:
+                return 'MOOGSILENT is not installed'
+        elif os.path.isdir(need):
+            if not os.listdir(need):
+                return 'No models in %s' % need
+        elif not os.path.isfile(need):
+            return 'No such file or folder: %s' % need
+    return None
+
+
+def bench(name, func, repeat=5, setup=None, requires=(), **params):
+    '''Time a function
+
+    Inputs
+    ------
+    name : str
+      The name of the benchmark
+    func : callable
+      The function to time (without arguments)
+    repeat : int
+      The number of timed runs, after one run which is not timed (default: 5)
+    setup : callable
+      Called before each run, and not timed (default: None)
+    requires : list/tuple
+      What the benchmark needs, see _missing (default: nothing)
+
+    Additional keyword arguments describe the benchmark, e.g. the atmtype,
+    and are written with the results.
+
+    Output
+    ------
+    result : dict
+      The name, the parameters and the min, median, mean and max time in
+      seconds. If something it requires is missing, only the reason it was
+      skipped. Errors of the function are raised.
+    '''
+    result = {'name': name, 'params': params}
+    reason = _missing(requires)
+    if reason is not None:
+        result['skipped'] = reason
+        return result
+    times = []
+    for i in range(repeat+1):
+        if setup is not None:
+            setup()
+        t0 = timer()
+        func()
+        if i:
+            times.append(timer()-t0)
+    result.update({'repeat': repeat, 'min': min(times), 'median': float(np.median(times)),
+                   'mean': float(np.mean(times)), 'max': max(times)})
+    return result
+
+
+def _points(N, seed=42):
+    '''N points around the Sun (Teff, logg, [Fe/H], vt)'''
+    rng = np.random.RandomState(seed)
+    return np.column_stack((rng.uniform(5500, 6000, N), rng.uniform(4.0, 4.5, N),
+                            rng.uniform(-0.1, 0.0, N), rng.uniform(0.8, 1.2, N)))
+
+
+def _atmosphere(layers=72):
+    '''An atmosphere with the shape of an interpolated Kurucz model'''
+    return np.column_stack((np.logspace(-4, 1, layers), np.linspace(4000, 9000, layers),
+                            np.logspace(2, 5, layers), np.logspace(9, 15, layers),
+                            np.logspace(-1, 1, layers), np.zeros(layers), np.zeros(layers)+1e5))
+
+
+def _interpolator_batch(points, atmtype):
+    '''Interpolate many atmospheres, which should all be in the grid'''
+    from interpolation import interpolator_batch
+    _, params = interpolator_batch(points, atmtype=atmtype)
+    if np.isnan(params[:, 0]).any():
+        raise ValueError('Could not interpolate %i of the points' % np.isnan(params[:, 0]).sum())
+
+
+def _ewdriver(stars=1, processes=1):
+    '''Analyse the solar line list for a number of stars with EWmethod'''
+    from utils import scratch
+    from ewDriver import EWmethod
+    root = os.getcwd()
+    with scratch(links=('models', 'rawLinelist', 'TMCALC', 'SpectralTypes.yml'),
+                 dirs=('linelist', 'results')):
+        with open('StarMe_bench.cfg', 'w') as cfg:
+            for i in range(stars):
+                fname = 'star%i.moog' % i
+                copyfile(os.path.join(root, linelist), os.path.join('linelist', fname))
+                cfg.write('%s\n' % fname)
+        driver = EWmethod(cfgfile='StarMe_bench.cfg', overwrite=True, processes=processes)
+        try:
+            driver.ewdriver()
+        finally:
+            for handler in driver.logger.handlers[:]:
+                driver.logger.removeHandler(handler)
+                handler.close()
+        if driver.parameters is None:
+            raise ValueError('The analysis of %s failed' % linelist)
+
+
+def _fun_moog(x):
+    '''Run MOOG once for the solar line list'''
+    from utils import scratch, fun_moog, _update_par
+    root = os.getcwd()
+    with scratch(dirs=('linelist',)):
+        copyfile(os.path.join(root, linelist), linelist)
+        _update_par(line_list=linelist)
+        fun_moog(x, 'kurucz95', cache=False)
+
+
+def run(repeat=5, stars=(1, 10, 100), workers=(1, 2), quick=False):
+    '''Run all benchmarks
+
+    Inputs
+    ------
+    repeat : int
+      The number of timed runs of each benchmark (default: 5)
+    stars : list/tuple
+      The number of stars in the scaling runs (default: 1, 10, 100)
+    workers : list/tuple
+      The number of processes in the scaling runs of the full analysis
+      (default: 1, 2)
+    quick : bool
+      Skip the full analyses with EWmethod (default: False)
+
+    Output
+    ------
+    results : list
+      The result of each benchmark (see bench)
+    '''
+    from interpolation import interpolator, read_model, save_model
+    from utils import Readmoog, slope
+    results = []
+    moog = ('MOOGSILENT', 'models/kurucz95', linelist)
+
+    # Interpolation of a single atmosphere, from cold caches
+    for atmtype in ('kurucz95', 'apogee_kurucz', 'marcs'):
+        models = ('models/%s' % atmtype,)
+        results.append(bench('interpolator', lambda: interpolator(sun, save=False, atmtype=atmtype),
+                             repeat=repeat, setup=_clear_caches, requires=models, atmtype=atmtype))
+        for N in stars:
+            points = _points(N)
+            results.append(bench('interpolator_batch', lambda: _interpolator_batch(points, atmtype),
+                                 repeat=repeat, setup=_clear_caches, requires=models, atmtype=atmtype,
+                                 stars=N))
+
+    # Reading and writing of atmosphere models
+    models = sorted(glob('models/kurucz95/*/*.gz'))
+    if models:
+        results.append(bench('read_model', lambda: read_model(models[0]), repeat=repeat))
+    else:
+        results.append({'name': 'read_model', 'params': {}, 'skipped': 'No models in models/kurucz95'})
+    atmosphere = _atmosphere()
+    fout = os.path.join(tempfile.gettempdir(), 'fasma_benchmark.atm')
+    results.append(bench('save_model', lambda: save_model(atmosphere, sun, fout=fout), repeat=repeat))
+    if os.path.isfile(fout):
+        os.remove(fout)
+
+    # The summary from MOOG
+    results.append(bench('Readmoog.fe_statistics', lambda: Readmoog(params=sun, fname=summary).fe_statistics(),
+                         repeat=repeat, requires=(summary,)))
+    results.append(bench('Readmoog.all_table', lambda: Readmoog(params=sun, fname=summary).all_table(),
+                         repeat=repeat, requires=(summary,)))
+    data = Readmoog(params=sun, fname=summary).fe_statistics()[6] if os.path.isfile(summary) else None
+    for weights in ('null', 'sigma'):
+        results.append(bench('slope', lambda: slope((data[:, 2], data[:, 6]), weights=weights),
+                             repeat=repeat, requires=(summary,), weights=weights))
+
+    # MOOG
+    results.append(bench('fun_moog', lambda: _fun_moog(sun), repeat=repeat, setup=_clear_caches, requires=moog))
+    if not quick:
+        results.append(bench('ewdriver', _ewdriver, repeat=repeat, setup=_clear_caches, requires=moog,
+                             stars=1, processes=1))
+        for N in stars:
+            for processes in workers:
+                if (N, processes) == (1, 1):
+                    continue
+                results.append(bench('ewdriver', lambda: _ewdriver(N, processes), repeat=1,
+                                     setup=_clear_caches, requires=moog, stars=N, processes=processes))
+    return results
+
+
+def _key(result):
+    '''Identify a benchmark by its name and parameters'''
+    return result['name'], tuple(sorted(result['params'].items()))
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''Compare the median times with an earlier run
+
+    Inputs
+    ------
+    results : list
+      The results of this run (see run)
+    baseline : list
+      The results of an earlier run
+    tolerance : float
+      The allowed relative slow down (default: 0.25)
+
+    Output
+    ------
+    regressions : list
+      (name, params, old median, new median) of the benchmarks which are
+      slower than the tolerance. The new median is None for benchmarks which
+      ran before, but were skipped this time
+    '''
+    old = dict((_key(result), result) for result in baseline if 'median' in result)
+    regressions = []
+    for result in results:
+        before = old.get(_key(result))
+        if before is None:
+            continue
+        if 'median' not in result:
+            regressions.append((result['name'], result['params'], before['median'], None))
+        elif result['median'] > before['median']*(1+tolerance):
+            regressions.append((result['name'], result['params'], before['median'], result['median']))
+    return regressions
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Benchmarks of FASMA.')
+    args.add_argument('-o', '--out',       help='Save the results here', default='benchmark.json')
+    args.add_argument('-r', '--repeat',    help='Timed runs of each benchmark', type=int, default=5)
+    args.add_argument('-s', '--stars',     help='Number of stars in the scaling runs', type=int, nargs='+', default=[1, 10, 100])
+    args.add_argument('-w', '--workers',   help='Number of processes in the scaling runs', type=int, nargs='+', default=[1, 2])
+    args.add_argument('-q', '--quick',     help='Skip the full analyses', action='store_true')
+    args.add_argument('-c', '--compare',   help='Compare with the results of an earlier run', default=None)
+    args.add_argument('-t', '--tolerance', help='Allowed relative slow down with --compare', type=float, default=0.25)
+    args = args.parse_args()
+
+    results = run(repeat=args.repeat, stars=args.stars, workers=args.workers, quick=args.quick)
+    with open(args.out, 'w') as f:
+        json.dump({'meta': _meta(), 'results': results}, f, indent=2, sort_keys=True)
+    for result in results:
+        time_ = ('%10.4fs' % result['median']) if 'median' in result else '   skipped'
+        print('%-24s %s %s' % (result['name'], time_, result['params'] or ''))
+    print('Saved in: %s' % args.out)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for name, params, before, after in regressions:
+            if after is None:
+                print('Not run: %s %s %.4fs -> skipped' % (name, params, before), file=sys.stderr)
+            else:
+                print('Slower: %s %s %.4fs -> %.4fs' % (name, params, before, after), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
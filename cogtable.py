@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''Curve-of-growth tables for the standard line lists.
+
+For a fixed line list the abundance of a line from abfind only depends on the
+atmospheric parameters and the measured EW. build runs MOOG once for each
+point of a grid in (Teff, logg, [Fe/H], vt), with every line of the line list
+at each EW of a grid, and saves the abundances in a compressed .npz:
+
+    python cogtable.py rawLinelist/Sousa2007_opt_kurucz.lst -m kurucz95 -p 4
+
+COGTable interpolates such a table, so the summary from MOOG for any line list
+made from these lines can be made without MOOG (see fun_moog). With the option
+cogtable the EW method minimizes on the table, and MOOG only polishes the
+final parameters.
+'''
+
+# My imports
+from __future__ import division, print_function
+import os
+import argparse
+import itertools
+from glob import glob
+import numpy as np
+from utils import make_summary
+
+names = ('teff', 'logg', 'feh', 'vt')
+# The default grid, inside the models of all atmosphere types
+grid = {'teff': tuple(range(4500, 6751, 250)),
+        'logg': (3.0, 3.5, 4.0, 4.5, 5.0),
+        'feh':  (-1.0, -0.75, -0.5, -0.25, 0.0, 0.25, 0.5),
+        'vt':   (0.0, 0.5, 1.0, 1.5, 2.0, 2.5)}
+# The EWs (mA) of each line, about evenly spaced in log EW
+ews = (2, 3, 5, 7, 10, 15, 20, 30, 45, 65, 90, 125, 175, 250)
+
+
+def _read_lines(fname):
+    '''The lines (wavelength, element, EP, loggf) of a line list, either in
+    the layout of rawLinelist or of MOOG. Header lines are skipped'''
+    lines = []
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                lines.append([float(value) for value in line.split()[:4]])
+            except ValueError:
+                continue
+    lines = np.array([line for line in lines if len(line) == 4])
+    # MOOG needs the lines of each species together
+    return lines[np.argsort(lines[:, 1], kind='mergesort')]
+
+
+def build(linelist, fout=None, atmtype='kurucz95', version=2014, processes=1,
+          grid=grid, ews=ews, maxlines=2500):
+    '''Run MOOG (abfind) over a grid for a line list and save the table
+
+    Inputs
+    ------
+    linelist : str
+      The line list, e.g. rawLinelist/Sousa2007_opt_kurucz.lst
+    fout : str
+      The table (default: cogtables/<linelist>_<atmtype>.npz)
+    atmtype : str
+      The atmosphere models (default: kurucz95)
+    version : int
+      The version of MOOG, with the ID column (default: 2014)
+    processes : int
+      The number of MOOG engines running at the same time (default: 1)
+    grid : dict
+      The values of teff, logg, feh and vt, at least two of each
+    ews : list/tuple
+      The EWs (mA) of each line
+    maxlines : int
+      The most lines MOOG can take in one run (default: 2500)
+
+    Output
+    ------
+    fout : str
+      The table. Points which could not be interpolated, or lines which MOOG
+      did not give, are NaN.
+    '''
+    from interpolation import interpolator_batch
+    from moogengine import MoogPool
+    if fout is None:
+        name = os.path.splitext(os.path.basename(linelist))[0]
+        fout = os.path.join('cogtables', '%s_%s.npz' % (name, atmtype))
+    if os.path.dirname(fout) and not os.path.isdir(os.path.dirname(fout)):
+        os.makedirs(os.path.dirname(fout))
+
+    lines = _read_lines(linelist)
+    ews = np.array(ews, dtype=float)
+    axes = [np.array(grid[name], dtype=float) for name in names]
+    points = np.array(list(itertools.product(*axes)))
+    atmospheres, params = interpolator_batch(points, atmtype=atmtype)
+    valid = np.flatnonzero(np.all(np.isclose(params, points), axis=1))
+
+    abund = np.zeros((len(points), len(lines), len(ews)), dtype=np.float32) + np.nan
+    titles = {}
+    # Each line is in the line list once for each EW
+    step = max(1, maxlines // len(ews))
+    pool = MoogPool(np.append(lines[0], ews[0]), processes=processes, version=version)
+    try:
+        for start in range(0, len(lines), step):
+            chunk = lines[start:start+step]
+            rows = np.column_stack((np.repeat(chunk, len(ews), axis=0), np.tile(ews, len(chunk))))
+            pool.set_lines(rows)
+            for i in range(0, len(valid), 8*processes):
+                jobs = valid[i:i+8*processes]
+                atm = [atmospheres[j][np.isfinite(atmospheres[j][:, 0])] for j in jobs]
+                for j, m in zip(jobs, pool.map([(a, list(p)) for a, p in zip(atm, params[jobs])])):
+                    blocks = [block for block in m.species() if len(block['lines'])]
+                    table = np.vstack([block['lines'] for block in blocks]) if blocks else np.zeros((0, 8))
+                    if len(table) != len(rows) or not np.allclose(table[:, 0], rows[:, 0], atol=0.01):
+                        continue
+                    abund[j, start:start+len(chunk)] = table[:, 6].reshape(len(chunk), len(ews))
+                    title = [line for line in m.lines if line.startswith('Abundance Results')]
+                    titles.update((round(block['lines'][0, 1], 1), t) for t, block in zip(title, m.species())
+                                  if len(block['lines']))
+    finally:
+        pool.close()
+
+    shape = tuple(len(axis) for axis in axes) + (len(lines), len(ews))
+    ids = sorted(titles)
+    np.savez_compressed(fout, abund=abund.reshape(shape), lines=lines, ews=ews,
+                        ids=np.array(ids), titles=np.array([titles[ID] for ID in ids]),
+                        atmtype=atmtype, version=version, linelist=os.path.basename(linelist),
+                        **dict(zip(names, axes)))
+    return fout
+
+
+class COGTable:
+    '''A curve-of-growth table made by build. The abundance of a line is
+    interpolated linearly in the parameters and in log EW, and shifted by
+    the difference in loggf, since it only depends on gf times the abundance.
+
+    Input
+    -----
+    fname : str
+      The table (.npz)
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        with np.load(fname) as data:
+            self.axes = [data[name] for name in names]
+            self.logew = np.log10(data['ews'])
+            self.lines = data['lines']
+            self.abund = data['abund']
+            self.titles = dict(zip(np.round(data['ids'], 1), [str(title) for title in data['titles']]))
+            self.atmtype = str(data['atmtype'])
+            self.version = int(data['version'])
+        self.keys = dict(((round(w, 2), round(ID, 1)), i) for i, (w, ID) in enumerate(self.lines[:, :2]))
+
+    def index(self, lines):
+        '''The index of each line (wavelength, element, ...) in the table, or
+        None if not all of them are there'''
+        try:
+            return np.array([self.keys[(round(w, 2), round(ID, 1))] for w, ID in np.atleast_2d(lines)[:, :2]])
+        except KeyError:
+            return None
+
+    def _cell(self, x):
+        '''The lower corner of the cell with x, and the position inside it
+        along each axis. None if x is outside the table'''
+        corner, weights = [], []
+        for axis, value in zip(self.axes, x):
+            if not axis[0] <= value <= axis[-1]:
+                return None
+            i = min(axis.searchsorted(value, side='right') - 1, len(axis) - 2)
+            corner.append(i)
+            weights.append((value - axis[i]) / (axis[i+1] - axis[i]))
+        return corner, weights
+
+    def abundances(self, x, lines):
+        '''The abundance of each line at a point
+
+        Inputs
+        ------
+        x : list/tuple
+          The parameters (Teff, logg, [Fe/H], vt)
+        lines : ndarray
+          The line list (wavelength, element, EP, loggf, EW)
+
+        Output
+        ------
+        abund : ndarray
+          The abundance of each line. None if a line is not in the table, or
+          x is outside it (or at a point MOOG could not do)
+        '''
+        lines = np.atleast_2d(lines)
+        idx = self.index(lines)
+        cell = self._cell(x)
+        if idx is None or cell is None:
+            return None
+        corner, weights = cell
+        table = self.abund[tuple(slice(i, i+2) for i in corner)][..., idx, :].astype(float)
+        for t in weights:
+            table = table[0]*(1-t) + table[1]*t
+        logew = np.log10(lines[:, 4])
+        j = np.clip(self.logew.searchsorted(logew) - 1, 0, len(self.logew) - 2)
+        u = (logew - self.logew[j]) / (self.logew[j+1] - self.logew[j])
+        n = np.arange(len(lines))
+        abund = table[n, j] + u*(table[n, j+1] - table[n, j])
+        abund -= lines[:, 3] - self.lines[idx, 3]
+        if np.isnan(abund).any():
+            return None
+        return abund
+
+    def summary(self, x, lines):
+        '''Make the summary from MOOG for a line list at a point
+
+        Inputs
+        ------
+        x : list/tuple
+          The parameters (Teff, logg, [Fe/H], vt)
+        lines : ndarray
+          The line list (wavelength, element, EP, loggf, EW)
+
+        Outputs
+        -------
+        summary : list
+          The lines of the summary (see utils.make_summary)
+        params : list
+          The parameters
+        Returns None if the abundances are not in the table (see abundances).
+        '''
+        abund = self.abundances(x, lines)
+        if abund is None:
+            return None
+        lines = np.atleast_2d(lines)
+        logrw = np.log10(lines[:, 4]/lines[:, 0]) - 3
+        rows = np.column_stack((lines[:, :5], logrw, abund, np.zeros(len(lines))))
+        header = ['Abundances from the curve-of-growth table: %s\n' % self.fname,
+                  'Teff= %4i   log g= %4.2f   vt= %4.2f M/H= %5.2f\n' % (round(x[0]), x[1], x[3], x[2]),
+                  '\n']
+        return make_summary(header, self.titles, rows), list(x)
+
+
+_tables = {}
+
+
+def load(fname):
+    '''A table, which is only read once in each process'''
+    fname = os.path.abspath(fname)
+    if fname not in _tables:
+        _tables[fname] = COGTable(fname)
+    return _tables[fname]
+
+
+def find(lines, atmtype, version=2014, path='cogtables'):
+    '''The first table in a folder with all the lines, for the atmosphere
+    type and version of MOOG
+
+    Inputs
+    ------
+    lines : ndarray
+      The line list (wavelength, element, EP, loggf, EW)
+    atmtype : str
+      The atmosphere models
+    version : int
+      The version of MOOG (default: 2014)
+    path : str
+      The folder with the tables (default: cogtables)
+
+    Output
+    ------
+    table : COGTable
+      The table, or None if there is none
+    '''
+    for fname in sorted(glob(os.path.join(path, '*.npz'))):
+        table = load(fname)
+        if (table.atmtype, table.version) == (atmtype, version) and table.index(lines) is not None:
+            return table
+    return None
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Make a curve-of-growth table for a line list with MOOG.')
+    args.add_argument('linelist',           help='The line list, e.g. rawLinelist/Sousa2007_opt_kurucz.lst')
+    args.add_argument('-o', '--out',        help='The table (default: cogtables/<linelist>_<model>.npz)', default=None)
+    args.add_argument('-m', '--model',      help='Model atmosphere', default='kurucz95', choices=['kurucz95', 'apogee_kurucz', 'marcs'])
+    args.add_argument('-v', '--moogversion', help='MOOG version', type=int, default=2014)
+    args.add_argument('-p', '--processes',  help='Number of MOOG engines', type=int, default=1)
+    args = args.parse_args()
+
+    fout = build(args.linelist, fout=args.out, atmtype=args.model, version=args.moogversion,
+                 processes=args.processes)
+    print('Saved in: %s' % fout)
@@ -4,19 +4,45 @@
 # My imports
 from __future__ import division, print_function
 import os
+import json
+import time
 import yaml
 import logging
 import numpy as np
+from glob import glob
+from functools import partial
 from shutil import copyfile
+from multiprocessing import Pool
 from minimization import Minimize
 from loggf_update import update_loggf
 from interpolation import interpolator
-from utils import fun_moog, Readmoog, _update_par, error
+from utils import fun_moog, Readmoog, _update_par, error, scratch, moog_cache, timings
+from resultstore import ResultsTable, fingerprint
+import cogtable
+
+
+# The driver used inside each worker process of the pool
+_driver = None
+
+
+def _initWorker(driver):
+    """Give each worker process its own copy of the driver."""
+    global _driver
+    _driver = driver
+
+
+def _starWorker(line):
+    """Analyse a single line from the configuration file in a worker."""
+    return _driver._isolatedStar(line)
 
 
 class EWmethod:
 
-    def __init__(self, cfgfile='StarMe_ew.cfg', overwrite=None):
+    # The phases which are timed for each line list (see utils.Timings)
+    phases = ('interpolation', 'atmosphere', 'moog', 'parsing', 'slopes', 'error', 'outliers')
+
+    def __init__(self, cfgfile='StarMe_ew.cfg', overwrite=None, processes=1,
+                 metrics='EWmetrics.jsonl', extracolumns=False, resume=False):
         """The function that glues everything together for the EW method
 
         Input
@@ -25,19 +51,40 @@ class EWmethod:
           Configuration file (default: StarMe_ew.cfg)
         overwrite : bool
           Overwrite the EWresults.dat file (default: False)
+        processes : int
+          Number of line lists to analyse in parallel. Each one runs in its
+          own scratch directory (default: 1)
+        metrics : str
+          File where the time spent in each phase, and the number of MOOG
+          calls, interpolations and cache hits are saved for each line list
+          as a line of JSON. None to not save them (default: EWmetrics.jsonl)
+        extracolumns : bool
+          Add the metrics as columns to EWresults.dat (default: False)
+        resume : bool
+          Skip the line lists which are done with the same inputs, i.e. the
+          same line list, initial parameters and options (see _digest). The
+          log of the earlier runs is kept (default: False)
 
         Output
         ------
         <linelist>.(NC).out : file
           The output line list; NC=not converged.
         EWresults.dat : file
-          Easy readable table with results from many linelists
+          Easy readable table with results from many linelists. They are
+          kept in EWresults.db (see resultstore.py)
         """
         self.cfgfile = cfgfile
         self.overwrite = overwrite
+        self.processes = processes
+        self.metricsfile = metrics
+        self.extracolumns = extracolumns
+        self.resume = resume
+        self.metrics = None
+        self.parameters = None
+        self.root = os.getcwd()
 
         # Setup of logger
-        if os.path.isfile('captain.log'):  # Cleaning from previous runs
+        if not resume and os.path.isfile('captain.log'):  # Cleaning from previous runs
             os.remove('captain.log')
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
@@ -178,7 +225,10 @@ class EWmethod:
                     'teffrange' : False,
                     'autofixvt' : False,
                     'tmcalc'    : False,
-                    'sigma'     : 3
+                    'sigma'     : 3,
+                    'cache'     : False,
+                    'cogtable'  : False,
+                    'solver'    : 'heuristic'
                     }
         if not options:
             self.options = defaults
@@ -198,13 +248,16 @@ class EWmethod:
             defaults['RWcrit']       = float(defaults['RWcrit'])
             defaults['ABdiffcrit']   = float(defaults['ABdiffcrit'])
             defaults['MOOGv']        = int(defaults['MOOGv'])
+            if defaults['solver'] not in ['heuristic', 'newton', 'broyden']:
+                print('Invalid option set for option "solver"')
+                defaults['solver'] = 'heuristic'
             if defaults['outlier'] not in [False, '1Iter', '1Once', 'allIter', 'allOnce']:
                 print('Invalid option set for option "outlier"')
                 defaults['outlier'] = False
             self.options = defaults
 
-    def _genStar(self):
-        """A generator for the configuration file."""
+    def _readConfig(self):
+        """A generator for the lines in the configuration file."""
         lines = open(self.cfgfile, 'r')
         for line in lines:
             if not line[0].isalnum():
@@ -215,6 +268,11 @@ class EWmethod:
             if len(line) not in [1, 2, 5, 6]:
                 # Not the expected format
                 continue
+            yield line
+
+    def _genStar(self):
+        """A generator for the configuration file."""
+        for line in self._readConfig():
             self._setup(line)
             yield self.initial, self.options, line
 
@@ -225,6 +283,11 @@ class EWmethod:
         else:
             _update_par(line_list='linelist/%s' % self.linelist)
 
+        # Keep the results from MOOG on disk, so they can be used again
+        if self.options['cache']:
+            path = 'cache' if self.options['cache'] is True else self.options['cache']
+            moog_cache.path = os.path.join(self.root, path)
+
         # Make the initial interpolation
         interpolator(params=self.initial, atmtype=self.options['model'])
 
@@ -245,31 +308,105 @@ class EWmethod:
             region = 'EWNIR'
         update_loggf(self.options['model'], 'linelist/%s' % self.linelist, region=region)
 
-    def _output(self, header=None):
-        """Create the output file 'EWresults.dat'."""
-
+    def _header(self):
+        """The columns of 'EWresults.dat'."""
         hdr = ['linelist', 'teff', 'tefferr', 'logg', 'loggerr', 'feh', 'feherr',
                'vt', 'vterr', 'loggastero', 'dloggastero', 'loggLC', 'dloggLC',
                'convergence', 'fixteff', 'fixlogg', 'fixfeh', 'fixvt', 'outlier',
                'weights', 'model', 'refine', 'EPcrit', 'RWcrit', 'ABdiffcrit']
+        if self.extracolumns:
+            hdr += ['runtime', 'iterations', 'moogcalls', 'interpolations', 'cachehits'] +\
+                   ['time_%s' % phase for phase in self.phases]
+        return hdr
+
+    def _output(self, header=None, digest=None):
+        """Add the current results to the store of 'EWresults.dat', with the
+        hash of the inputs (see _digest). With header, set up the store, and
+        remove the old results if overwrite."""
         if header is not None:
+            # Missing values (e.g. NaN errors) are written as nan, as before
+            self.results = ResultsTable('EWresults.dat', 'ew', columns=self._header(), sep='\t', na='nan')
             if self.overwrite:
-                with open('EWresults.dat', 'w') as output:
-                    output.write('\t'.join(hdr)+'\n')
-            else:
-                if not os.path.isfile('EWresults.dat'):
-                    with open('EWresults.dat', 'w') as output:
-                        output.write('\t'.join(hdr)+'\n')
+                self.results.clear()
         else:
-            tmp = [self.linelist] + self.parameters +\
-                  [self.converged, self.options['fix_teff'],
-                   self.options['fix_logg'], self.options['fix_feh'],
-                   self.options['fix_vt'], self.options['outlier']] +\
-                  [self.options['weights'], self.options['model'],
-                   self.options['refine'], self.options['EPcrit'],
-                   self.options['RWcrit'], self.options['ABdiffcrit']]
-            with open('EWresults.dat', 'a') as output:
-                output.write('\t'.join(list(map(str, tmp)))+'\n')
+            self.results.add(self.linelist, self._row(), key=' '.join(self.line), digest=digest)
+
+    def _digest(self, line):
+        """The hash of the inputs of a line from the configuration file, after
+        the setup (see resultstore.fingerprint). The loggf of the line list are
+        left out, since they are replaced for the model (see update_loggf).
+
+        Input
+        -----
+        line : list
+          A line from the configuration file after being split at spaces
+
+        Output
+        ------
+        digest : str
+          The hash, or None if the line list can not be read
+        """
+        try:
+            lines = np.loadtxt(os.path.join(self.root, 'linelist', line[0]), skiprows=1, usecols=(0, 1, 2, 4), ndmin=2)
+        except (IOError, ValueError, IndexError):
+            return None
+        options = dict((key, value) for key, value in self.options.items() if key != 'GUI')
+        return fingerprint([lines.tolist(), list(self.initial), options])
+
+    def _skip(self, line, digest):
+        """True if the line list is done with the same inputs, with resume"""
+        if self.resume and self.results.done(' '.join(line), digest):
+            self.logger.info('Skipping line list (done with the same inputs): %s' % line[0])
+            return True
+        return False
+
+    def _row(self):
+        """The current results as (column, value) for 'EWresults.dat'."""
+        tmp = [self.linelist] + self.parameters +\
+              [self.converged, self.options['fix_teff'],
+               self.options['fix_logg'], self.options['fix_feh'],
+               self.options['fix_vt'], self.options['outlier']] +\
+              [self.options['weights'], self.options['model'],
+               self.options['refine'], self.options['EPcrit'],
+               self.options['RWcrit'], self.options['ABdiffcrit']]
+        if self.extracolumns:
+            tmp += self._metricColumns()
+        return list(zip(self._header(), tmp))
+
+    def _metricColumns(self):
+        """The metrics of the current line list for 'EWresults.dat'."""
+        m = self.metrics
+        hits = sum([n for name, n in m['counts'].items() if name.endswith('cache_hits')])
+        return [m['wall'], m['counts'].get('iterations', 0), m['calls'].get('moog', 0),
+                m['calls'].get('interpolation', 0), hits] +\
+               [m['time'].get(phase, 0.0) for phase in self.phases]
+
+    def _metrics(self, parameters):
+        """The time spent in each phase and the counters since the start of
+        the current line list (see utils.Timings).
+
+        Input
+        -----
+        parameters : list
+          The final parameters, or None if the analysis failed
+
+        Output
+        ------
+        metrics : dict
+          The metrics, which are also kept in self.metrics
+        """
+        self.metrics = timings.summary()
+        self.metrics.update({'linelist': self.linelist,
+                             'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             'success': parameters is not None,
+                             'converged': getattr(self, 'converged', None) if parameters is not None else None})
+        return self.metrics
+
+    def _saveMetrics(self, metrics):
+        """Add the metrics of a line list to the metrics file."""
+        if self.metricsfile:
+            with open(self.metricsfile, 'a') as f:
+                f.write(json.dumps(metrics, sort_keys=True)+'\n')
 
     def _printToScreen(self):
         """
@@ -291,6 +428,42 @@ class EWmethod:
                 print('\nSorry, you did not win. However, your final parameters are:')
             print(u' Teff:{:>8d}+/-{:.0f}\n logg:{:>8.2f}+/-{:1.2f}\n [Fe/H]:{:>+6.2f}+/-{:1.2f}\n vt:{:>10.2f}+/-{:1.2f}\n\n\n\n'.format(*self.parameters))
 
+    def _table(self):
+        """The curve-of-growth table for the line list (option cogtable), or
+        None. The table is either given, or the first one in cogtables with
+        all the lines (see cogtable.py)."""
+        if not self.options['cogtable']:
+            return None
+        lines = np.loadtxt('linelist/%s' % self.linelist, skiprows=1, usecols=range(5), ndmin=2)
+        if self.options['cogtable'] is True:
+            table = cogtable.find(lines, self.options['model'], version=self.options['MOOGv'],
+                                  path=os.path.join(self.root, 'cogtables'))
+        else:
+            fname = os.path.join(self.root, self.options['cogtable'])
+            table = cogtable.load(fname) if os.path.isfile(fname) else None
+            if (table is not None) and (table.index(lines) is None or table.atmtype != self.options['model']):
+                table = None
+        if table is None:
+            self.logger.warning('No curve-of-growth table for this line list. Using MOOG.')
+        return table
+
+    def _minimize(self, x0):
+        """Run the minimization routine from x0, and count the iterations.
+        With a curve-of-growth table the minimization is done on the table,
+        and MOOG only polishes the result."""
+        table = self._table()
+        if table is not None:
+            function = Minimize(x0, partial(fun_moog, table=table), **self.options)
+            try:
+                x0, _ = function.minimize()
+            finally:
+                timings.count('table_iterations', function.iteration)
+        function = Minimize(x0, fun_moog, **self.options)
+        try:
+            return function.minimize()
+        finally:
+            timings.count('iterations', function.iteration)
+
     def minizationRunner(self, p=None):
         """A function to run the minimization routine
 
@@ -300,12 +473,8 @@ class EWmethod:
           True if the minimization run succesfully
         """
         # Run the minimization routine first time
-        if p is not None:
-            function = Minimize(p, fun_moog, **self.options)
-        else:
-            function = Minimize(self.initial, fun_moog, **self.options)
         try:
-            self.parameters, self.converged = function.minimize()
+            self.parameters, self.converged = self._minimize(self.initial if p is None else p)
             return True
         except ValueError:
             print('No FeII lines were measured.')
@@ -332,8 +501,7 @@ class EWmethod:
                 self.removeOutlier(tmpll, wavelength)
                 print('Removing line: %.2f. Outliers removed: %d' % (wavelength, Noutlier))
                 print('Restarting the minimization routine...\n')
-                function = Minimize(self.parameters, fun_moog, **self.options)
-                self.parameters, self.converged = function.minimize()
+                self.parameters, self.converged = self._minimize(self.parameters)
                 outliers = self._hasOutlier()
 
         elif type == '1Once':
@@ -345,34 +513,31 @@ class EWmethod:
                 self.removeOutlier(tmpll, wavelength)
                 print('Removing line: %.2f. Outliers removed: %d' % (wavelength, Noutlier))
                 print('Restarting the minimization routine...\n')
-                function = Minimize(self.parameters, fun_moog, **self.options)
-                self.parameters, self.converged = function.minimize()
+                self.parameters, self.converged = self._minimize(self.parameters)
                 outliers = self._hasOutlier()
 
         elif type == 'allIter':
             # Remove all outliers above 3 sigma iteratively
             while outliers:
                 newLineList = True  # At the end, create a new linelist
-                for wavelength in outliers.itervalues():
+                for wavelength in outliers.values():
                     self.removeOutlier(tmpll, wavelength)
                     Noutlier += 1
                     print('Removing line: %.2f. Outliers removed: %d' % (wavelength, Noutlier))
                 print('Restarting the minimization routine...\n')
-                function = Minimize(self.parameters, fun_moog, **self.options)
-                self.parameters, self.converged = function.minimize()
+                self.parameters, self.converged = self._minimize(self.parameters)
                 outliers = self._hasOutlier()
 
         elif type == 'allOnce':
             # Remove all outliers above 3 sigma once
             if outliers:
                 newLineList = True  # At the end, create a new linelist
-                for wavelength in outliers.itervalues():
+                for wavelength in outliers.values():
                     self.removeOutlier(tmpll, wavelength)
                     Noutlier += 1
                     print('Removing line: %.2f. Outliers removed: %d' % (wavelength, Noutlier))
                 print('Restarting the minimization routine...\n')
-                function = Minimize(self.parameters, fun_moog, **self.options)
-                self.parameters, self.converged = function.minimize()
+                self.parameters, self.converged = self._minimize(self.parameters)
                 outliers = self._hasOutlier()
 
         if newLineList:
@@ -512,61 +677,160 @@ class EWmethod:
         self.parameters.append(loggLC)
         self.parameters.append(error_loggLC)
 
-    def ewdriver(self):
-        # Creating the output file
-        self._output(header=True)
+    def _runStar(self):
+        """Analyse the current line list from start to end.
 
-        for (self.initial, self.options, self.line) in self._genStar():
-            self.logger.info('Start with line list: %s' % self.linelist)
-            self.logger.info('Initial parameters: {:.0f}, {:.2f}, {:.2f}, {:.2f}'.format(*self.initial))
-            self._prepare()
-            if self.options is None:
-                self.logger.error('The line list does not exists!\n')
-                continue  # The line list does not exists
-
-            self.logger.info('Starting the initial minimization routine...')
-            status = self.minizationRunner()
-            if status is None:
-                self.logger.error('The minimization routine did not finish succesfully.')
-                continue  # Problem with the minimization routine
-            else:
-                self.logger.info('The minimization routine finished succesfully.')
+        Output
+        ------
+        parameters : list
+          The final parameters with errors, or None if the line list could not
+          be analysed
+        """
+        timings.reset()
+        self.logger.info('Start with line list: %s' % self.linelist)
+        self.logger.info('Initial parameters: {:.0f}, {:.2f}, {:.2f}, {:.2f}'.format(*self.initial))
+        self._prepare()
+        if self.options is None:
+            self.logger.error('The line list does not exists!\n')
+            return None  # The line list does not exists
+
+        self.logger.info('Starting the initial minimization routine...')
+        status = self.minizationRunner()
+        if status is None:
+            self.logger.error('The minimization routine did not finish succesfully.')
+            return None  # Problem with the minimization routine
+        else:
+            self.logger.info('The minimization routine finished succesfully.')
 
-            if self.options['outlier']:
-                self.logger.info('Removing outliers.')
+        if self.options['outlier']:
+            self.logger.info('Removing outliers.')
+            with timings('outliers'):
                 self.outlierRunner()
 
-            if self.options['teffrange']:
-                self.logger.info('Correcting the line list, if necessary, for low Teff.')
-                self.teffrangeRunner()
+        if self.options['teffrange']:
+            self.logger.info('Correcting the line list, if necessary, for low Teff.')
+            self.teffrangeRunner()
 
-            if self.options['autofixvt']:
-                self.logger.info('Fixing vt if necessary.')
-                self.autofixvtRunner()
+        if self.options['autofixvt']:
+            self.logger.info('Fixing vt if necessary.')
+            self.autofixvtRunner()
 
-            if self.options['refine'] and self.converged:
-                self.logger.info('Refining the parameters.')
-                self.refineRunner()
+        if self.options['refine'] and self.converged:
+            self.logger.info('Refining the parameters.')
+            self.refineRunner()
 
-            self.logger.info('Final parameters: {:.0f}, {:.2f}, {:.2f}, {:.2f}\n'.format(*self.parameters))
-            self._renaming()
+        self.logger.info('Final parameters: {:.0f}, {:.2f}, {:.2f}, {:.2f}\n'.format(*self.parameters))
+        self._renaming()
+        with timings('error'):
             self.parameters = error(self.linelist, self.converged,
                                     self.parameters,
                                     atmtype=self.options['model'],
                                     version=self.options['MOOGv'],
                                     weights=self.options['weights'])
 
-            self.loggCorrections()
-            self._output()
-            self._printToScreen()
+        self.loggCorrections()
+        self._printToScreen()
         return self.parameters
 
+    def _isolatedStar(self, line):
+        """Analyse a line from the configuration file inside its own scratch
+        directory. The line list is copied in, and the results and the
+        (updated) line lists are copied back afterwards.
+
+        Input
+        -----
+        line : list
+          A line from the configuration file after being split at spaces
+
+        Output
+        ------
+        parameters : list
+          The final parameters with errors (None if the analysis failed)
+        row : list
+          The row for 'EWresults.dat' (None if the analysis failed)
+        metrics : dict
+          The time spent in each phase and the counters (see _metrics)
+        """
+        root = os.getcwd()
+        links = ('models', 'rawLinelist', 'TMCALC', 'SpectralTypes.yml')
+        with scratch(links=links, dirs=('linelist', 'results')):
+            fname = os.path.join(root, 'linelist', line[0])
+            if os.path.isfile(fname):
+                copyfile(fname, os.path.join('linelist', line[0]))
+            self._setup(line)
+            parameters = self._runStar()
+            metrics = self._metrics(parameters)
+            row = None if parameters is None else self._row()
+            for fname in glob('results/*') + glob('linelist/*'):
+                copyfile(fname, os.path.join(root, fname))
+        return parameters, row, metrics
+
+    def ewdriver(self, export=True):
+        """Analyse all line lists in the configuration file
+
+        Input
+        -----
+        export : bool
+          Write 'EWresults.dat' at the end. When the driver is called for
+          each star, the table can be written once at the end instead (see
+          FASMA_all.py) (default: True)
+
+        Output
+        ------
+        parameters : list
+          The final parameters of the last line list
+        """
+        # Creating the output file
+        self._output(header=True)
+        if self.overwrite and self.metricsfile and os.path.isfile(self.metricsfile):
+            os.remove(self.metricsfile)
+
+        try:
+            if self.processes > 1:
+                jobs, digests = [], []
+                for line in self._readConfig():
+                    self._setup(line)
+                    digest = self._digest(line)
+                    if not self._skip(line, digest):
+                        jobs.append(line)
+                        digests.append(digest)
+                pool = Pool(self.processes, initializer=_initWorker, initargs=(self,))
+                try:
+                    results = pool.imap(_starWorker, jobs)
+                    for line, digest, (parameters, row, metrics) in zip(jobs, digests, results):
+                        self._saveMetrics(metrics)
+                        if row is None:
+                            continue
+                        self.parameters = parameters
+                        self.results.add(row[0][1], row, key=' '.join(line), digest=digest)
+                finally:
+                    pool.close()
+                    pool.join()
+                return self.parameters
+
+            for (self.initial, self.options, self.line) in self._genStar():
+                digest = self._digest(self.line)
+                if self._skip(self.line, digest):
+                    continue
+                parameters = self._runStar()
+                self._saveMetrics(self._metrics(parameters))
+                if parameters is None:
+                    continue
+                self._output(digest=digest)
+            return self.parameters
+        finally:
+            # Write 'EWresults.dat' with the results of all runs
+            if export:
+                self.results.export()
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) > 1:
-        cfgfile = sys.argv[1]
+    resume = '--resume' in sys.argv
+    argv = [arg for arg in sys.argv if arg != '--resume']
+    if len(argv) > 1:
+        cfgfile = argv[1]
     else:
         cfgfile = 'StarMe_ew.cfg'
-    driver = EWmethod(cfgfile=cfgfile, overwrite=None)
+    processes = int(argv[2]) if len(argv) > 2 else 1
+    driver = EWmethod(cfgfile=cfgfile, overwrite=None, processes=processes, resume=resume)
     parameters = driver.ewdriver()
@@ -2,8 +2,10 @@
 from __future__ import division
 import numpy as np
 import gzip
-from scipy.interpolate import griddata
-from utils import GetModels
+from collections import OrderedDict
+from scipy.spatial import Delaunay
+from utils import GetModels, timings
+from modelgrid import read_models, marcs_grid
 
 def read_model(fname):
     '''Read the model atmosphere
@@ -65,15 +67,120 @@ def solar_abundance(elem):
 
     return ind+1, solar[ind]
 
-def interpolator_kurucz(params, atmtype='kurucz95'):
-    '''Interpolation for Kurucz'''
+def _linear_weights(gridpoints, point):
+    '''Weights for a linear interpolation of point on the Delaunay
+    triangulation of the grid points. This gives the same result as
+    scipy.interpolate.griddata(..., method='linear', rescale=True), but the
+    weights can be applied to all layers and columns at once.
 
+    Input
+    -----
+    gridpoints : ndarray
+      The (Teff, logg, [Fe/H]) of the models, shape (N, 3)
+    point : tuple/ndarray
+      The (Teff, logg, [Fe/H]) to interpolate to, or many of them with shape
+      (M, 3)
+
+    Output
+    ------
+    weights : ndarray
+      The weight of each model (NaN if point is outside the grid points),
+      with shape (M, N) for many points
+    '''
+    points = np.asarray(gridpoints, dtype=float)
+    offset = np.mean(points, axis=0)
+    scale = np.ptp(points - offset, axis=0)
+    scale[~(scale > 0)] = 1.0
+    points = (points - offset) / scale
+    xi = (np.atleast_2d(np.asarray(point, dtype=float)) - offset) / scale
+
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(xi)
+    weights = np.zeros((len(xi), len(points)))
+    inside = simplex != -1
+    transform = tri.transform[simplex[inside]]
+    b = np.einsum('ijk,ik->ij', transform[:, :-1], xi[inside] - transform[:, -1])
+    rows = np.flatnonzero(inside)[:, np.newaxis]
+    weights[rows, tri.simplices[simplex[inside]]] = np.column_stack((b, 1-b.sum(axis=1)))
+    weights[~inside] = np.nan
+    return weights[0] if np.ndim(point) == 1 else weights
+
+
+def _multilinear_weights(gridpoints, point):
+    '''Weights for a multilinear interpolation of point on the regular
+    Teff/logg/[Fe/H] cube spanned by the grid points.
+
+    Input
+    -----
+    gridpoints : ndarray
+      The (Teff, logg, [Fe/H]) of the models, shape (N, 3)
+    point : tuple/ndarray
+      The (Teff, logg, [Fe/H]) to interpolate to, or many of them with shape
+      (M, 3)
+
+    Output
+    ------
+    weights : ndarray
+      The weight of each model, with shape (M, N) for many points
+    '''
+    if np.ndim(point) == 2:
+        return np.array([_multilinear_weights(gridpoints, p) for p in point])
+    points = np.asarray(gridpoints, dtype=float)
+    weights = np.ones(len(points))
+    for axis, value in enumerate(point):
+        nodes = np.unique(points[:, axis])
+        if len(nodes) == 1:
+            continue
+        i = min(max(np.searchsorted(nodes, value) - 1, 0), len(nodes) - 2)
+        low, high = nodes[i], nodes[i+1]
+        t = (value - low) / (high - low)
+        weights *= np.where(points[:, axis] == low, 1-t,
+                            np.where(points[:, axis] == high, t, 0.0))
+    # The same grid point can show up twice when filling gaps in the grid
+    _, first = np.unique(points, axis=0, return_index=True)
+    duplicate = np.ones(len(points), dtype=bool)
+    duplicate[first] = False
+    weights[duplicate] = 0.0
+    return weights
+
+
+def _weights(gridpoints, point, method='linear'):
+    '''Weights of the grid points with the given method (see
+    _linear_weights and _multilinear_weights)'''
+    if method == 'linear':
+        return _linear_weights(gridpoints, point)
+    elif method == 'multilinear':
+        return _multilinear_weights(gridpoints, point)
+    raise ValueError('Unknown interpolation method: %s' % method)
+
+
+def _add_vt(structure, vt):
+    '''Add the constant microturbulence column to an atmosphere'''
+    vt_array = np.zeros(structure.shape[0])+vt*1e5
+    return np.hstack((structure, vt_array[:, np.newaxis]))
+
+
+def _kurucz_cell(params, atmtype='kurucz95'):
+    '''The Kurucz models around a point
+
+    Input
+    -----
+    params : list
+      Teff, logg, [Fe/H] desired.
+    atmtype : str
+      The atmosphere models being used. Default is kurucz95.
+
+    Output
+    ------
+    mnames : list
+      The paths of the models
+    gridpoints : ndarray
+      The (Teff, logg, [Fe/H]) of the models
+    point : tuple
+      The (Teff, logg, [Fe/H]) to interpolate to, as adjusted by GetModels
+    '''
     m = GetModels(params[0], params[1], params[2], atmtype=atmtype)
     mdict = m.getmodels()
-    params[0] = mdict['teff'][0]
-    params[1] = mdict['logg'][0]
-    params[2] = mdict['feh'][0]
-    mnames = mdict['models']
     teff = mdict['teff']
     logg = mdict['logg']
     feh = mdict['feh']
@@ -83,93 +190,205 @@ def interpolator_kurucz(params, atmtype='kurucz95'):
         for grav in logg[1]:
             for metal in feh[1]:
                 gridpoints.append((temp, grav, metal))
-    gridpoints = np.asarray(gridpoints)
-    # Define the points to obtain at the end
-    teff = teff[0]
-    logg = logg[0]
-    feh  = feh[0]
-    options = {'method': 'linear', 'rescale': True}
-
-    # Reading the models
-    models = []
-    for mname in mnames:
-        tatm = read_model(mname)
-        models.append(tatm)
-
-    layers = range(min([model.shape[0] for model in models]))
-    columns = range(6)
-    newatm = np.zeros((len(layers), len(columns)))
-    for layer in layers:
-        for column in columns:
-            tlayer = [model[layer, column] for model in models]
-            newatm[layer, column] = griddata(gridpoints, tlayer, (teff, logg, feh), **options)
-    vt_array = np.zeros(len(layers))+params[-1]*1e5
-    newatm = np.hstack((newatm, vt_array[:, np.newaxis]))
+    return mdict['models'], np.asarray(gridpoints), (teff[0], logg[0], feh[0])
+
+
+def interpolator_kurucz(params, atmtype='kurucz95', method='linear'):
+    '''Interpolation for Kurucz. The weights of the surrounding models are
+    found once, and applied to all layers and columns of the models in one go.
+
+    Input
+    -----
+    params : list
+      Teff, logg, [Fe/H], vt desired.
+    atmtype : str
+      The atmosphere models being used. Default is kurucz95.
+    method : str
+      'linear' for a linear interpolation on the Delaunay triangulation of the
+      surrounding models (same as griddata), or 'multilinear' for a plain
+      multilinear interpolation on the Teff/logg/[Fe/H] cube. Default is linear.
+
+    Output
+    ------
+    newatm : ndarray
+      New interpolated atmosphere.
+    '''
+
+    mnames, gridpoints, point = _kurucz_cell(params, atmtype=atmtype)
+    params[:3] = point
+    weights = _weights(gridpoints, point, method=method)
+
+    # Reading the models (from the packed grid if available)
+    models = read_models(mnames, atmtype=atmtype)
+
+    newatm = np.tensordot(weights, models, axes=1)
+    return _add_vt(newatm, params[-1])
+
+def _marcs_cell(params, microlim=3.0):
+    '''The MARCS models around a point, if the point can be interpolated
+
+    Input
+    -----
+    params : list
+      Teff, logg, [Fe/H], vt desired.
+    microlim : float
+      The largest vt of the models
+
+    Output
+    ------
+    sel : ndarray
+      The indices of the models (see modelgrid.MarcsGrid.select)
+    point : tuple
+      The (Teff, logg, [Fe/H]) to interpolate to
+    Returns None if the point can not be interpolated.
+    '''
+    grid = marcs_grid.load()
+    Teff  = np.round(params[0],0)
+    logg  = np.round(params[1],2)
+    metal = np.round(params[2],2)
+    micro = np.round(params[3],2)
+    sel = marcs_grid.select(Teff, logg, metal)
+    if micro > microlim:
+        micro = microlim
+    if len(sel) <= 1 or micro < 0.:
+        return None
+    tmod, gmod, mmod = grid['tmod'][sel], grid['gmod'][sel], grid['mmod'][sel]
+    dT = max(tmod)-min(tmod)
+    dm = max(mmod)-min(mmod)
+    dg = max(gmod)-min(gmod)
+    testt = (min(tmod) <= Teff) and (max(tmod) >= Teff) and dT > 0.
+    testm = (min(mmod) <= metal) and (max(mmod) >= metal) and dm > 0.
+    testg = (min(gmod) <= logg) and (max(gmod) >= logg) and dg > 0.
+    if testt and testm and testg:
+        return sel, (Teff, logg, metal)
+    return None
+
+
+def _marcs_models(sel, points):
+    '''Interpolate the MARCS models to many points in the same cell
+
+    Input
+    -----
+    sel : ndarray
+      The indices of the models (see _marcs_cell)
+    points : ndarray
+      The (Teff, logg, [Fe/H]) to interpolate to, shape (M, 3)
+
+    Output
+    ------
+    newatm : ndarray
+      The atmospheres without vt, shape (M, layers, 5). NaN for the points
+      which could not be interpolated
+    '''
+    grid = marcs_grid.load()
+    weights = _linear_weights(np.column_stack((grid['tmod'][sel], grid['gmod'][sel], grid['mmod'][sel])), points)
+    teint = weights.dot(grid['Temod'][sel])
+    lpgint  = weights.dot(grid['lpgmod'][sel])
+    lpeint  = weights.dot(grid['lpemod'][sel])
+    rhoxint = weights.dot(grid['rhoxmod'][sel])
+    kint    = weights.dot(grid['kmod'][sel])
+    newatm = np.stack((rhoxint, teint, 10.**lpgint, 10.**lpeint, kint), axis=-1)
+    newatm[~np.isfinite(teint[:, 0])] = np.nan
     return newatm
 
+
 def interpolator_marcs(params, fesun=7.47, microlim=3.0):
     '''Interpolation for marcs. The function is taken from STEPAR
-    (Tabernero et al. 2019) to deal the gaps in the grid.'''
-
-    import _pickle as pic
-
-    gridMODS = open("models/marcs/MARCS1M.bin","rb")
-    tmod     = pic.load(gridMODS)
-    gmod     = pic.load(gridMODS)
-    mmod     = pic.load(gridMODS)
-    ltaumod  = pic.load(gridMODS)
-    Temod    = pic.load(gridMODS)
-    lpgmod   = pic.load(gridMODS)
-    lpemod   = pic.load(gridMODS)
-    rhoxmod  = pic.load(gridMODS)
-    kmod     = pic.load(gridMODS)
-    gridMODS.close()
-
-    x = list(params)
-    Teff  = np.round(x[0],0)
-    logg  = np.round(x[1],2)
-    metal = np.round(x[2],2)
-    micro = np.round(x[3],2)
-    sel = np.where((np.abs(tmod-Teff) <= 251.) & (np.abs(mmod-metal) <= 0.251) & (np.abs(gmod-logg) <= 0.5))
-    lT = np.shape(tmod[sel])[0]
-    lm = np.shape(mmod[sel])[0]
-    lg = np.shape(gmod[sel])[0]
-    if micro > microlim:
-        micro = microlim
-    if lT > 1 and lm > 1 and lg > 1 and micro <= microlim and micro >= 0.:
-        dT = max(tmod[sel])-min(tmod[sel])
-        dm = max(mmod[sel])-min(mmod[sel])
-        dg = max(gmod[sel])-min(gmod[sel])
-        testt = (min(tmod[sel]) <= Teff) and (max(tmod[sel]) >= Teff) and dT > 0.
-        testm = (min(mmod[sel]) <= metal) and (max(mmod[sel]) >= metal) and dm > 0.
-        testg = (min(gmod[sel]) <= logg) and (max(gmod[sel]) >= logg) and dg > 0.
-        if testt and testm and testg:
-            testint = True
-        else:
-            testint = False
-    else:
-        testint = False
-    if testint:
-        teint = griddata((tmod[sel], gmod[sel], mmod[sel]), Temod[sel], (Teff, logg, metal), method='linear', fill_value=np.nan, rescale=True)
-        if np.isfinite(teint[0]):
-            lpgint  = griddata((tmod[sel], gmod[sel], mmod[sel]), lpgmod[sel], (Teff, logg, metal),  method='linear', fill_value=np.nan, rescale=True)
-            lpeint  = griddata((tmod[sel], gmod[sel], mmod[sel]), lpemod[sel], (Teff, logg, metal),  method='linear', fill_value=np.nan, rescale=True)
-            rhoxint = griddata((tmod[sel], gmod[sel], mmod[sel]), rhoxmod[sel], (Teff, logg, metal), method='linear', fill_value=np.nan, rescale=True)
-            kint    = griddata((tmod[sel], gmod[sel], mmod[sel]), kmod[sel], (Teff, logg, metal),    method='linear', fill_value=np.nan, rescale=True)
-            nlayers = len(kint)
-            newatm = []
-            for i in range(nlayers):
-                newatm.append([rhoxint[i], teint[i], 10.**lpgint[i], 10.**lpeint[i], kint[i]])
-            newatm = np.array(newatm)
-            vt_array = np.zeros(nlayers)+params[-1]*1e5
-            newatm = np.hstack((newatm, vt_array[:, np.newaxis]))
-            return newatm
-        else:
-            return False
+    (Tabernero et al. 2019) to deal the gaps in the grid. The grid is only
+    loaded once (see modelgrid.MarcsGrid).'''
+
+    cell = _marcs_cell(params, microlim=microlim)
+    if cell is None:
+        return False
+    sel, point = cell
+    newatm = _marcs_models(sel, [point])[0]
+    if np.isfinite(newatm[0, 1]):
+        return _add_vt(newatm, params[-1])
     else:
         return False
 
-def interpolator(params, abund=0.0, elem=False, save=True, atmtype='kurucz95', result=None):
+
+def interpolator_batch(params, atmtype='kurucz95', method='linear'):
+    '''Interpolate many atmospheres at once. The points are grouped by the
+    models around them, so the models of each cell are read and weighted
+    once for all the points inside it.
+
+    Input
+    -----
+    params : ndarray
+      Teff, logg, [Fe/H], vt for each point, shape (N, 4)
+    atmtype : str
+      The atmosphere models being used. Default is kurucz95.
+    method : str
+      Interpolation method for the Kurucz models: 'linear' or 'multilinear'.
+      Default is linear.
+
+    Output
+    ------
+    atmospheres : ndarray
+      The atmospheres with shape (N, layers, 7), in the same columns as
+      written by save_model. Layers beyond the end of an atmosphere, and
+      points which could not be interpolated, are NaN.
+    params : ndarray
+      The parameters of the atmospheres (GetModels may adjust them), NaN for
+      points which could not be interpolated
+    '''
+    if atmtype not in ('kurucz95', 'apogee_kurucz', 'marcs'):
+        raise NameError('Could not find %s models' % atmtype)
+    params = np.array(params, dtype=float, ndmin=2)
+    cells = OrderedDict()
+    for i, p in enumerate(params):
+        try:
+            if atmtype == 'marcs':
+                cell = _marcs_cell(p)
+                if cell is None:
+                    params[i] = np.nan
+                    continue
+                sel, point = cell
+                key, info = tuple(sel), sel
+            else:
+                mnames, gridpoints, point = _kurucz_cell(p, atmtype=atmtype)
+                key, info = tuple(mnames), (mnames, gridpoints)
+                params[i, :3] = point
+        except (ValueError, IndexError):  # Outside the grid or missing models
+            params[i] = np.nan
+            continue
+        cells.setdefault(key, (info, []))[1].append((i, point))
+
+    newatms = {}
+    for info, members in cells.values():
+        idx = [i for i, _ in members]
+        points = np.array([point for _, point in members])
+        if atmtype == 'marcs':
+            models = _marcs_models(info, points)
+        else:
+            mnames, gridpoints = info
+            weights = _weights(gridpoints, points, method=method)
+            models = np.tensordot(weights, read_models(mnames, atmtype=atmtype), axes=1)
+        for i, model in zip(idx, models):
+            if np.isfinite(model[0, 1]):
+                newatms[i] = model
+            else:
+                params[i] = np.nan
+
+    layers = max([model.shape[0] for model in newatms.values()] + [0])
+    atmospheres = np.zeros((len(params), layers, 7)) + np.nan
+    for i, model in newatms.items():
+        ncols = model.shape[1]
+        atmospheres[i, :model.shape[0], :ncols] = model
+        atmospheres[i, :model.shape[0], ncols] = params[i, 3]*1e5
+        atmospheres[i, :model.shape[0], ncols+1:] = 0.0
+    return atmospheres, params
+
+
+# The interpolated atmospheres without the vt column, with the (Teff, logg,
+# [Fe/H]) they were interpolated to. vt only sets a constant column, so a
+# change in vt does not need a new interpolation.
+_structures = OrderedDict()
+_maxstructures = 256
+
+
+def interpolator(params, abund=0.0, elem=False, save=True, atmtype='kurucz95', result=None, method='linear'):
     '''This is a new approach based on a scipy interpolator.
     Re1sembles the original interpolator we used but with a change
 
@@ -181,6 +400,9 @@ def interpolator(params, abund=0.0, elem=False, save=True, atmtype='kurucz95', r
       Wether the new atmosphere should be saved. Default is True.
     atmtype : str
       The atmosphere models being used. Default is Kurucz95.
+    method : str
+      Interpolation method for the Kurucz models: 'linear' or 'multilinear'.
+      Default is linear.
 
     Output
     ------
@@ -189,14 +411,30 @@ def interpolator(params, abund=0.0, elem=False, save=True, atmtype='kurucz95', r
     '''
 
     params = list(params)
-    if atmtype == 'marcs':
-        newatm = interpolator_marcs(params, fesun=7.47, microlim=3.0)
-    elif atmtype == 'kurucz95':
-        newatm = interpolator_kurucz(params, atmtype=atmtype)
-    elif atmtype == 'apogee_kurucz':
-        newatm = interpolator_kurucz(params, atmtype=atmtype)
+    key = (atmtype, method, params[0], params[1], params[2])
+    # MARCS gives no atmosphere for a negative vt, so skip the cache for those
+    cached = _structures.pop(key, None) if params[3] >= 0 else None
+    if cached is not None:
+        timings.count('interpolation_cache_hits')
+        _structures[key] = cached
+        structure, point = cached
+        params[:3] = point
+        newatm = _add_vt(structure, params[3])
     else:
-        raise NameError('Could not find %s models' % atmtype)
+        with timings('interpolation'):
+            if atmtype == 'marcs':
+                newatm = interpolator_marcs(params, fesun=7.47, microlim=3.0)
+            elif atmtype == 'kurucz95':
+                newatm = interpolator_kurucz(params, atmtype=atmtype, method=method)
+            elif atmtype == 'apogee_kurucz':
+                newatm = interpolator_kurucz(params, atmtype=atmtype, method=method)
+            else:
+                raise NameError('Could not find %s models' % atmtype)
+        if isinstance(newatm, np.ndarray):
+            # A copy, so changes to the returned atmosphere do not reach the cache
+            _structures[key] = (newatm[:, :-1].copy(), tuple(params[:3]))
+            if len(_structures) > _maxstructures:
+                _structures.popitem(last=False)
 
     if save:
             save_model(newatm, params, abund=abund, elem=elem, type=atmtype)
@@ -251,22 +489,41 @@ def save_model(model, params, abund=0.0, elem=False, type='kurucz95', fout='out.
     _fmt = ('%15.8E', '%8.1f', '%.3E', '%.3E', '%.3E', '%.3E', '%.3E')
     while model.shape[1] < len(_fmt):
         model = np.column_stack((model, np.zeros_like(model[:, 0])))
-    np.savetxt(fout, model, header=header, footer=footer, comments='', delimiter=' ', fmt=_fmt)
+    with timings('atmosphere'):
+        np.savetxt(fout, model, header=header, footer=footer, comments='', delimiter=' ', fmt=_fmt)
 
 if __name__ == '__main__':
+    import os
     import argparse
     args = argparse.ArgumentParser(description='Get a model atmosphere.')
-    args.add_argument('teff',   type=int,       help='Effective temperature')
-    args.add_argument('logg',   type=float,     help='Surface gravity')
-    args.add_argument('feh',    type=float,     help='Metallicity, [Fe/H]')
-    args.add_argument('vt',     type=float,     help='Microturbulence')
+    args.add_argument('teff',   type=int,       help='Effective temperature', nargs='?')
+    args.add_argument('logg',   type=float,     help='Surface gravity', nargs='?')
+    args.add_argument('feh',    type=float,     help='Metallicity, [Fe/H]', nargs='?')
+    args.add_argument('vt',     type=float,     help='Microturbulence', nargs='?')
     args.add_argument('-elem',  type=str,       help='Element', default=False)
     args.add_argument('-abund', type=float,     help='Abundance', default=0.0)
     args.add_argument('-o',     '--out',        help='Output atmosphere', default='out.atm')
     args.add_argument('-a',     '--atmosphere', help='Model atmosphere', choices=['kurucz95', 'apogee_kurucz', 'marcs'], default='kurucz95')
+    args.add_argument('-m',     '--method',     help='Interpolation method', choices=['linear', 'multilinear'], default='linear')
+    args.add_argument('-b',     '--batch',      help='File with Teff, logg, [Fe/H], vt in each row. The atmospheres are saved in <out>_<row>.atm', default=None)
+    parser = args
     args = args.parse_args()
 
-    params = [args.teff, args.logg, args.feh, args.vt]
-    atmosphere, p = interpolator(params, elem=args.elem, abund=args.abund, save=False, atmtype=args.atmosphere, result=True)
-    save_model(atmosphere, params, elem=args.elem, abund=args.abund, type=args.atmosphere, fout=args.out)
-    print('Atmosphere model sucessfully saved in: %s' % args.out)
+    if args.batch:
+        params = np.loadtxt(args.batch, ndmin=2, usecols=range(4))
+        atmospheres, p = interpolator_batch(params, atmtype=args.atmosphere, method=args.method)
+        root, ext = os.path.splitext(args.out)
+        for i, (atmosphere, param) in enumerate(zip(atmospheres, params)):
+            if np.isnan(p[i, 0]):
+                print('Could not interpolate row %i: %s' % (i+1, param))
+                continue
+            atmosphere = atmosphere[np.isfinite(atmosphere[:, 0])]
+            save_model(atmosphere, param, elem=args.elem, abund=args.abund, type=args.atmosphere, fout='%s_%i%s' % (root, i+1, ext))
+        print('Atmosphere models sucessfully saved in: %s_*%s' % (root, ext))
+    else:
+        if args.vt is None:
+            parser.error('Give Teff, logg, [Fe/H] and vt, or a file with --batch')
+        params = [args.teff, args.logg, args.feh, args.vt]
+        atmosphere, p = interpolator(params, elem=args.elem, abund=args.abund, save=False, atmtype=args.atmosphere, result=True, method=args.method)
+        save_model(atmosphere, params, elem=args.elem, abund=args.abund, type=args.atmosphere, fout=args.out)
+        print('Atmosphere model sucessfully saved in: %s' % args.out)
@@ -8,12 +8,24 @@ from copy import copy
 
 
 class Minimize:
-    '''Minimize for best parameters given a line list'''
+    '''Minimize for best parameters given a line list
+
+    The solver can be 'heuristic' (fixed steps from the slopes), 'newton'
+    (Newton steps with a finite difference Jacobian in every iteration) or
+    'broyden' (a finite difference Jacobian which is updated with Broyden's
+    method after each step).
+    '''
+
+    # Steps for the finite difference Jacobian. They are larger than the
+    # rounding done by _format_x0
+    fd_steps = (50.0, 0.10, 0.05, 0.10)
+    # The largest Newton step allowed for (Teff, logg, [Fe/H], vt)
+    max_steps = (500.0, 0.50, 0.50, 0.50)
 
     def __init__(self, x0, func, model, weights='null',
                  fix_teff=False, fix_logg=False, fix_feh=False, fix_vt=False,
                  iterations=160, EPcrit=0.001, RWcrit=0.003, ABdiffcrit=0.01,
-                 MOOGv=2014, GUI=True, **kwargs):
+                 MOOGv=2014, GUI=True, solver='heuristic', **kwargs):
         self.x0 = x0
         self.func = func
         self.model = model
@@ -29,6 +41,7 @@ class Minimize:
         self.ABdiffcrit = ABdiffcrit
         self.MOOGv = MOOGv
         self.GUI = GUI
+        self.solver = solver.lower()
         if self.model.lower() == 'kurucz95':
             self.bounds = [3750, 39000, 0.0, 5.0, -3, 1, 0, 9.99]
         if self.model.lower() == 'apogee_kurucz':
@@ -94,7 +107,147 @@ class Minimize:
         self.x0[2] = round(self.x0[2], 2)
         self.x0[3] = round(self.x0[3], 2)
 
+    def _free(self):
+        '''Indices of the parameters which are not fixed'''
+        fixed = (self.fix_teff, self.fix_logg, self.fix_feh, self.fix_vt)
+        return [i for i in range(4) if not fixed[i]]
+
+    def _evaluate(self, x, free):
+        '''Run MOOG at x and return the residuals for the free parameters
+
+        Inputs
+        ------
+        x : list
+          The parameters (Teff, logg, [Fe/H], vt)
+        free : list
+          Indices of the free parameters
+
+        Output
+        ------
+        F : ndarray
+          The EP slope, FeII-FeI, [Fe/H] offset and RW slope, divided by their
+          convergence criteria. Only for the free parameters
+        '''
+        self.x0 = list(x)
+        if self.fix_vt:
+            self._getMic()
+        for i in (1, 3, 5, 7):
+            self.check_bounds(i)
+        self._format_x0()
+        res, self.slopeEP, self.slopeRW, abundances, self.x0 = self.func(self.x0, self.model, weights=self.weights, version=self.MOOGv)
+        self.x0 = list(self.x0)
+        self.Abdiff = np.diff(abundances)[0]
+        self.fe_input = abundances[0]
+        F = np.array([self.slopeEP/self.EPcrit, self.Abdiff/self.ABdiffcrit,
+                      (self.x0[2]+7.47-abundances[0])/0.01, self.slopeRW/self.RWcrit])
+        return F[free]
+
+    def _jacobian(self, free, F):
+        '''Jacobian of the residuals with finite differences around x0
+
+        Inputs
+        ------
+        free : list
+          Indices of the free parameters
+        F : ndarray
+          The residuals at x0
+
+        Output
+        ------
+        J : ndarray
+          The Jacobian for the free parameters
+        '''
+        x = list(self.x0)
+        J = np.zeros((len(free), len(free)))
+        for k, i in enumerate(free):
+            xi = list(x)
+            # Step towards the inside of the bounds
+            h = self.fd_steps[i]
+            xi[i] += h if x[i]+h <= self.bounds[2*i+1] else -h
+            Fi = self._evaluate(xi, free)
+            self.iteration += 1
+            dx = self.x0[i] - x[i]
+            if dx:
+                J[:, k] = (Fi - F) / dx
+        self.x0 = x
+        return J
+
+    def newton(self):
+        '''Solve for the parameters with damped Newton steps, where the
+        Jacobian is found with finite differences ('newton') or updated with
+        Broyden's method ('broyden'). The steps are limited by max_steps and
+        the bounds.
+
+        Output
+        ------
+        x0 : list
+          The parameters (Teff, logg, [Fe/H], vt)
+        converged : bool
+          True if the parameters converged
+        Returns None if the steps get smaller than the rounding of the
+        parameters, so the heuristic solver can take over.
+        '''
+        free = self._free()
+        self._format_x0()
+        F = self._evaluate(self.x0, free)
+        if self.check_convergence(self.fe_input):
+            return self.x0, True
+        self.print_format()
+        best = {np.dot(F, F): copy(self.x0)}
+
+        J = None
+        damping = 1.0
+        while self.iteration < self.maxiterations:
+            fresh = J is None
+            if fresh:
+                J = self._jacobian(free, F)
+            dx = np.linalg.lstsq(J, -F, rcond=-1)[0] * damping
+            dx /= max([1.0] + [abs(d)/self.max_steps[i] for d, i in zip(dx, free)])
+
+            x = list(self.x0)
+            xnew = list(self.x0)
+            for d, i in zip(dx, free):
+                xnew[i] += d
+            Fnew = self._evaluate(xnew, free)
+            self.iteration += 1
+            self.print_format()
+            best[np.dot(Fnew, Fnew)] = copy(self.x0)
+            if self.check_convergence(self.fe_input):
+                print('\nStopped in %i iterations' % self.iteration)
+                return self.x0, True
+
+            step = np.array([self.x0[i] - x[i] for i in free])
+            if not step.any():
+                # Too small to change the rounded parameters
+                return None
+            if np.dot(Fnew, Fnew) < np.dot(F, F):
+                if self.solver == 'broyden':
+                    J += np.outer(Fnew - F - np.dot(J, step), step) / np.dot(step, step)
+                else:
+                    J = None
+                F = Fnew
+                damping = 1.0
+            else:
+                # Go back, and take a shorter step with a new Jacobian
+                self.x0 = x
+                if fresh:
+                    damping /= 2
+                    if damping < 0.1:
+                        return None
+                J = None
+
+        print('\nStopped in %i iterations' % self.iteration)
+        x0 = best[min(best.keys())]
+        _ = self.func(x0, self.model, weights=self.weights, version=self.MOOGv)
+        return x0, False
+
     def minimize(self):
+        if self.solver in ('newton', 'broyden'):
+            result = self.newton()
+            if result is not None:
+                return result
+            self.x0 = list(self.x0)
+
         self._format_x0()
         res, self.slopeEP, self.slopeRW, abundances, self.x0 = self.func(self.x0, self.model, version=self.MOOGv)
         self.Abdiff = np.diff(abundances)[0]
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''Binary versions of the model atmosphere grids.
+
+The Kurucz grids are packed once into a single dense cube, which is memory
+mapped by the interpolation, so no model has to be decompressed or parsed
+while running. The MARCS grid is unpickled once per process, and can be
+converted to memory mappable arrays. An index of the models which exist in
+each grid is saved as well, so GetModels does not have to look for the
+files. Run this script after installing the models:
+
+    python modelgrid.py kurucz95 apogee_kurucz marcs
+'''
+
+# My imports
+from __future__ import division, print_function
+import os
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+from utils import GetModels, kurucz95, apogee_kurucz, marcs, kurucz08
+
+kurucz = {'kurucz95': kurucz95, 'apogee_kurucz': apogee_kurucz}
+grids = {'kurucz95': kurucz95, 'apogee_kurucz': apogee_kurucz, 'marcs': marcs, 'kurucz08': kurucz08}
+_cubes = {}
+_available = {}
+
+
+def _cube_path(atmtype):
+    '''Paths of the packed grid and the number of layers of each model'''
+    return 'models/%s.npy' % atmtype, 'models/%s_nlayers.npy' % atmtype
+
+
+def _model_index(atmtype):
+    '''Map the path of each model in the grid to its (Teff, logg, [Fe/H])
+    index in the cube
+
+    Input
+    -----
+    atmtype : str
+      The atmosphere models, kurucz95 or apogee_kurucz
+
+    Output
+    ------
+    index : dict
+      {path: (i, j, k)} for all grid points
+    '''
+    grid = kurucz[atmtype]
+    m = GetModels(grid['teff'][0], grid['logg'][0], grid['feh'][0], atmtype)
+    index = {}
+    for i, teff in enumerate(m.grid['teff']):
+        for j, logg in enumerate(m.grid['logg']):
+            for k, feh in enumerate(m.grid['feh']):
+                index[m._model_path(teff, logg, feh)] = (i, j, k)
+    return index
+
+
+def _available_path(atmtype):
+    '''Path of the index of the available models'''
+    return 'models/%s_available.npy' % atmtype
+
+
+def _modified(atmtype):
+    '''The last time models were added to or removed from a grid, i.e. the
+    newest time of change of models/<atmtype> and its folders'''
+    path = 'models/%s' % atmtype
+    if not os.path.isdir(path):
+        return 0
+    folders = [os.path.join(path, name) for name in os.listdir(path)]
+    return max(os.path.getmtime(folder) for folder in [path] + folders if os.path.isdir(folder))
+
+
+def index_models(atmtype='kurucz95'):
+    '''Check which models of a grid exist, and save the result in
+    models/<atmtype>_available.npy, so it only has to be done once. The
+    MARCS models are all in one pickle, so they are not indexed
+
+    Input
+    -----
+    atmtype : str
+      The atmosphere models, e.g. kurucz95
+
+    Output
+    ------
+    available : ndarray
+      Boolean cube over the (Teff, logg, [Fe/H]) of the grid (see
+      utils.GetModels), True where the model exists
+    '''
+    if atmtype not in grids:
+        raise NotImplementedError('You request for atmospheric models: %s is not available' % atmtype)
+    if atmtype == 'marcs':
+        raise NotImplementedError('The MARCS models are not files in a grid, and are not indexed')
+    grid = grids[atmtype]
+    m = GetModels(grid['teff'][0], grid['logg'][0], grid['feh'][0], atmtype)
+    available = np.zeros((len(m.grid['teff']), len(m.grid['logg']), len(m.grid['feh'])), dtype=bool)
+    for i, teff in enumerate(m.grid['teff']):
+        for j, logg in enumerate(m.grid['logg']):
+            for k, feh in enumerate(m.grid['feh']):
+                available[i, j, k] = os.path.isfile(m._model_path(teff, logg, feh))
+    if os.path.isdir('models/%s' % atmtype):
+        np.save(_available_path(atmtype), available)
+    _available[atmtype] = available
+    return available
+
+
+def available_models(atmtype='kurucz95'):
+    '''The models which exist in a grid, from the saved index. The index is
+    made the first time it is needed (see index_models), made again when
+    models were added to or removed from the grid since, and only read once
+    per process.
+
+    Input
+    -----
+    atmtype : str
+      The atmosphere models, e.g. kurucz95
+
+    Output
+    ------
+    available : ndarray
+      Boolean cube over the (Teff, logg, [Fe/H]) of the grid
+    '''
+    if atmtype not in _available:
+        fname = _available_path(atmtype)
+        grid = grids.get(atmtype, {})
+        shape = tuple(len(grid.get(axis, ())) for axis in ('teff', 'logg', 'feh'))
+        fresh = os.path.isfile(fname) and os.path.getmtime(fname) >= _modified(atmtype)
+        available = np.load(fname) if fresh else None
+        if available is not None and available.shape == shape:
+            _available[atmtype] = available
+        else:
+            # No index yet, models changed since, or made for another version
+            # of the grid
+            index_models(atmtype)
+    return _available[atmtype]
+
+
+def pack_kurucz(atmtype='kurucz95', ncolumns=6):
+    '''Pack all the models of a Kurucz grid into one binary cube with shape
+    (Teff, logg, [Fe/H], layer, column). Missing models and layers are NaN.
+
+    Input
+    -----
+    atmtype : str
+      The atmosphere models, kurucz95 or apogee_kurucz
+    ncolumns : int
+      The number of columns to keep from each model (default: 6)
+
+    Output
+    ------
+    models/<atmtype>.npy : file
+      The packed grid
+    models/<atmtype>_nlayers.npy : file
+      The number of layers of each model. Missing models have 0 layers, so
+      this is also the mask of the available models.
+    '''
+    from interpolation import read_model
+    if atmtype not in kurucz:
+        raise NotImplementedError('Can not pack the models: %s' % atmtype)
+    grid = kurucz[atmtype]
+    shape = (len(grid['teff']), len(grid['logg']), len(grid['feh']))
+
+    models = {}
+    for fname, ijk in _model_index(atmtype).items():
+        if os.path.isfile(fname):
+            models[ijk] = read_model(fname)[:, :ncolumns]
+    if not models:
+        raise IOError('No models found in: models/%s' % atmtype)
+
+    nlayers = np.zeros(shape, dtype=np.int16)
+    layers = max([model.shape[0] for model in models.values()])
+    cube = np.zeros(shape + (layers, ncolumns)) + np.nan
+    for ijk, model in models.items():
+        nlayers[ijk] = model.shape[0]
+        cube[ijk][:model.shape[0]] = model
+
+    fcube, fnlayers = _cube_path(atmtype)
+    np.save(fcube, cube)
+    np.save(fnlayers, nlayers)
+    return fcube
+
+
+def load_kurucz(atmtype='kurucz95'):
+    '''Memory map the packed Kurucz grid. It is only loaded once per process,
+    and forked processes share the same pages.
+
+    Input
+    -----
+    atmtype : str
+      The atmosphere models, kurucz95 or apogee_kurucz
+
+    Output
+    ------
+    grid : tuple
+      (cube, nlayers, index) or None if the grid is not packed
+    '''
+    if atmtype not in _cubes:
+        fcube, fnlayers = _cube_path(atmtype)
+        if (atmtype in kurucz) and os.path.isfile(fcube) and os.path.isfile(fnlayers):
+            _cubes[atmtype] = (np.load(fcube, mmap_mode='r'), np.load(fnlayers),
+                               _model_index(atmtype))
+        else:
+            _cubes[atmtype] = None
+    return _cubes[atmtype]
+
+
+def read_models(mnames, atmtype='kurucz95', ncolumns=6):
+    '''Get the models to interpolate between, cut to the same number of
+    layers. The packed grid is used if available, otherwise the models are
+    read from the gz files.
+
+    Input
+    -----
+    mnames : list
+      The paths of the models (from GetModels)
+    atmtype : str
+      The atmosphere models, kurucz95 or apogee_kurucz
+    ncolumns : int
+      The number of columns to return (default: 6)
+
+    Output
+    ------
+    models : ndarray
+      The models with shape (model, layer, column)
+    '''
+    grid = load_kurucz(atmtype)
+    if grid is not None:
+        cube, nlayers, index = grid
+        idx = [index.get(mname) for mname in mnames]
+        if all(ijk is not None and nlayers[ijk] for ijk in idx):
+            layers = min([nlayers[ijk] for ijk in idx])
+            return np.array([cube[ijk][:layers, :ncolumns] for ijk in idx])
+
+    from interpolation import read_model
+    models = [read_model(mname) for mname in mnames]
+    layers = min([model.shape[0] for model in models])
+    return np.array([model[:layers, :ncolumns] for model in models])
+
+
+class MarcsGrid:
+    '''The MARCS grid (models/marcs/MARCS1M.bin). The arrays are loaded the
+    first time they are needed and kept for the rest of the process, together
+    with a KD-tree over (Teff, logg, [Fe/H]) to select the models around a
+    point.
+
+    Inputs
+    ------
+    fname : str
+      The pickled grid (default: models/marcs/MARCS1M.bin). If the grid has
+      been converted, the arrays in the folder with the same name (without
+      .bin) are memory mapped instead.
+    '''
+
+    names = ('tmod', 'gmod', 'mmod', 'ltaumod', 'Temod', 'lpgmod', 'lpemod',
+             'rhoxmod', 'kmod')
+    # The half width of the box around a point in (Teff, logg, [Fe/H])
+    scale = np.array([251., 0.5, 0.251])
+
+    def __init__(self, fname='models/marcs/MARCS1M.bin'):
+        self.fname = fname
+        self.path = fname.rpartition('.')[0]
+        self.data = None
+        self.tree = None
+
+    def _read_pickle(self):
+        '''Read the nine arrays from the pickled grid'''
+        with open(self.fname, 'rb') as gridMODS:
+            return dict((name, pickle.load(gridMODS)) for name in self.names)
+
+    def load(self):
+        '''Load the grid and build the KD-tree (only done once)
+
+        Output
+        ------
+        data : dict
+          The arrays of the grid, e.g. data['Temod']
+        '''
+        if self.data is None:
+            if all(os.path.isfile('%s/%s.npy' % (self.path, name)) for name in self.names):
+                data = dict((name, np.load('%s/%s.npy' % (self.path, name), mmap_mode='r'))
+                            for name in self.names)
+            else:
+                data = self._read_pickle()
+            points = np.column_stack((data['tmod'], data['gmod'], data['mmod']))
+            # The tree is set first, since other threads only check the data
+            self.tree = cKDTree(points / self.scale)
+            self.data = data
+        return self.data
+
+    def select(self, teff, logg, feh):
+        '''Indices of the models with |Teff-teff| <= 251, |logg-logg| <= 0.5,
+        and |[Fe/H]-feh| <= 0.251, in the same order as a np.where on the full
+        arrays would give
+
+        Inputs
+        ------
+        teff : float
+          Effective temperature
+        logg : float
+          Surface gravity
+        feh : float
+          Metallicity
+
+        Output
+        ------
+        sel : ndarray
+          The indices of the selected models
+        '''
+        data = self.load()
+        point = np.array([teff, logg, feh])
+        # Ask the tree for a slightly larger box and apply the exact limits
+        idx = self.tree.query_ball_point(point / self.scale, r=1+1e-6, p=np.inf)
+        idx = np.sort(np.asarray(idx, dtype=int))
+        tmod, gmod, mmod = data['tmod'][idx], data['gmod'][idx], data['mmod'][idx]
+        mask = (np.abs(tmod-teff) <= 251.) & (np.abs(mmod-feh) <= 0.251) & (np.abs(gmod-logg) <= 0.5)
+        return idx[mask]
+
+    def convert(self):
+        '''Save the arrays of the pickled grid as .npy files, which can be
+        memory mapped by all processes
+
+        Output
+        ------
+        path : str
+          The folder with the arrays
+        '''
+        data = self._read_pickle()
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        for name in self.names:
+            np.save('%s/%s.npy' % (self.path, name), np.asarray(data[name]))
+        return self.path
+
+
+marcs_grid = MarcsGrid()
+
+
+if __name__ == '__main__':
+    import sys
+    atmtypes = sys.argv[1:] if len(sys.argv) > 1 else list(kurucz.keys()) + ['marcs']
+    for atmtype in atmtypes:
+        if atmtype != 'marcs':
+            print('Indexing models/%s...' % atmtype)
+            index_models(atmtype)
+        print('Packing models/%s...' % atmtype)
+        if atmtype == 'marcs':
+            print('Saved in: %s' % marcs_grid.convert())
+        else:
+            print('Saved in: %s' % pack_kurucz(atmtype))
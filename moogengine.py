@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''Run MOOG on arrays instead of files in the working directory.
+
+MOOG does all of its input and output through Fortran units which are set up
+from batch.par, so it can not be called on arrays directly. The engine hides
+this: it owns a private folder with its own batch.par, atmosphere, line list
+and summary, runs MOOGSILENT there without a shell, and hands back the
+results as arrays. MoogPool keeps a number of engines alive in worker
+processes, which get their jobs over pipes.
+'''
+
+# My imports
+from __future__ import division
+import os
+import shutil
+import tempfile
+import subprocess
+from multiprocessing import Process, Pipe
+import numpy as np
+from utils import _update_par, Readmoog, timings
+from interpolation import save_model
+
+_fmt = ('%9.3f', '%10.1f', '%9.2f', '%9.3f', '%28.1f')
+_header = 'Wavelength     ele       EP      loggf                          EW'
+
+
+class MoogEngine:
+    '''A MOOG abfind engine working on arrays
+
+    Inputs
+    ------
+    lines : ndarray/str
+      The line list (wavelength, element, EP, loggf, EW) with one line per
+      row, or the path to a line list in MOOG format
+    driver : str
+      The MOOG driver to use (default: abfind)
+    version : int
+      The version of MOOG (default: 2014)
+
+    Additional keyword arguments are passed to batch.par (see utils._update_par)
+    '''
+
+    def __init__(self, lines, driver='abfind', version=2014, **kwargs):
+        self.version = version
+        self.path = tempfile.mkdtemp(prefix='fasma_moog_')
+        self.set_lines(lines)
+        _update_par(atmosphere_model='out.atm', line_list='lines.moog',
+                    par=os.path.join(self.path, 'batch.par'), driver=driver, **kwargs)
+
+    def set_lines(self, lines):
+        '''Use a new line list for the following runs
+
+        Input
+        -----
+        lines : ndarray/str
+          The line list as an array, or the path to a line list
+        '''
+        fname = os.path.join(self.path, 'lines.moog')
+        if isinstance(lines, str):
+            # Use the line list as it is, so nothing is lost in formatting
+            shutil.copyfile(lines, fname)
+            self.lines = np.atleast_2d(np.loadtxt(lines, skiprows=1, usecols=range(5)))
+        else:
+            self.lines = np.atleast_2d(np.asarray(lines, dtype=float))
+            np.savetxt(fname, self.lines, fmt=_fmt, header=_header)
+
+    def run(self, atmosphere, params, abund=0.0, elem=False):
+        '''Run MOOG with an atmosphere model
+
+        Inputs
+        ------
+        atmosphere : ndarray
+          The model atmosphere (from interpolation.interpolator)
+        params : list/tuple
+          The atmospheric parameters (Teff, logg, [Fe/H], vt)
+
+        Output
+        ------
+        fname : str
+          The path to the summary from MOOG
+        '''
+        save_model(atmosphere, params, abund=abund, elem=elem, fout=os.path.join(self.path, 'out.atm'))
+        with open(os.devnull, 'w') as devnull, timings('moog'):
+            subprocess.call(['MOOGSILENT'], cwd=self.path, stdout=devnull, stderr=devnull)
+        return os.path.join(self.path, 'summary.out')
+
+    def abfind(self, atmosphere, params, abund=0.0, elem=False):
+        '''Run MOOG and read the results
+
+        Inputs
+        ------
+        atmosphere : ndarray
+          The model atmosphere (from interpolation.interpolator)
+        params : list/tuple
+          The atmospheric parameters (Teff, logg, [Fe/H], vt)
+
+        Output
+        ------
+        m : Readmoog
+          The results of the run
+        '''
+        fname = self.run(atmosphere, params, abund=abund, elem=elem)
+        return Readmoog(params=params, fname=fname, version=self.version)
+
+    def abundances(self, atmosphere, params):
+        '''Get the abundance of each line
+
+        Inputs
+        ------
+        atmosphere : ndarray
+          The model atmosphere (from interpolation.interpolator)
+        params : list/tuple
+          The atmospheric parameters (Teff, logg, [Fe/H], vt)
+
+        Output
+        ------
+        wavelength : ndarray
+          The wavelength of the lines
+        species : ndarray
+          The species of the lines, e.g. 26.1
+        abundance : ndarray
+          The abundance of the lines
+        '''
+        table = self.abfind(atmosphere, params).all_table()
+        if self.version > 2013:
+            species = table.ID.values
+        else:
+            species = np.zeros(len(table)) + np.nan
+        return table.wavelength.values, species, table.abund.values
+
+    def close(self):
+        '''Remove the folder of the engine'''
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def _worker(conn, lines, driver, version, kwargs):
+    '''Serve jobs for a MoogPool until None is received'''
+    engine = MoogEngine(lines, driver=driver, version=version, **kwargs)
+    try:
+        while True:
+            job = conn.recv()
+            if job is None:
+                break
+            command, args = job
+            try:
+                if command == 'lines':
+                    engine.set_lines(args)
+                    conn.send(True)
+                elif command == 'abfind':
+                    conn.send(engine.abfind(*args))
+                else:
+                    conn.send(ValueError('Unknown command: %s' % command))
+            except Exception as e:
+                conn.send(e)
+    finally:
+        engine.close()
+
+
+class MoogPool:
+    '''A pool of MOOG engines running in worker processes which are started
+    once. Each worker owns its own folder, and gets the atmosphere models
+    over a pipe and sends the results back. It can be used as the engine of
+    fun_moog.
+
+    Inputs
+    ------
+    lines : ndarray/str
+      The line list (wavelength, element, EP, loggf, EW) with one line per
+      row, or the path to a line list in MOOG format
+    processes : int
+      The number of workers (default: 2)
+    driver : str
+      The MOOG driver to use (default: abfind)
+    version : int
+      The version of MOOG (default: 2014)
+
+    Additional keyword arguments are passed to batch.par (see utils._update_par)
+    '''
+
+    def __init__(self, lines, processes=2, driver='abfind', version=2014, **kwargs):
+        self.version = version
+        # For summaries which are not made by the workers (see fun_moog)
+        self.path = tempfile.mkdtemp(prefix='fasma_moogpool_')
+        if isinstance(lines, str):
+            lines = np.loadtxt(lines, skiprows=1, usecols=range(5))
+        self.lines = np.atleast_2d(np.asarray(lines, dtype=float))
+        self.connections = []
+        self.workers = []
+        for _ in range(processes):
+            conn, child = Pipe()
+            worker = Process(target=_worker, args=(child, self.lines, driver, version, kwargs))
+            worker.daemon = True
+            worker.start()
+            self.connections.append(conn)
+            self.workers.append(worker)
+
+    def _receive(self, conn):
+        '''Get the answer from a worker, and raise its errors here'''
+        result = conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def set_lines(self, lines):
+        '''Use a new line list in all the workers
+
+        Input
+        -----
+        lines : ndarray/str
+          The line list as an array, or the path to a line list
+        '''
+        if isinstance(lines, str):
+            lines = np.loadtxt(lines, skiprows=1, usecols=range(5))
+        self.lines = np.atleast_2d(np.asarray(lines, dtype=float))
+        for conn in self.connections:
+            conn.send(('lines', self.lines))
+        for conn in self.connections:
+            self._receive(conn)
+
+    def map(self, jobs):
+        '''Run MOOG for many atmosphere models at the same time
+
+        Input
+        -----
+        jobs : list
+          List of (atmosphere, params) with the model atmosphere (from
+          interpolation.interpolator) and the parameters (Teff, logg, [Fe/H], vt)
+
+        Output
+        ------
+        results : list
+          A Readmoog with the results for each job
+        '''
+        results = []
+        N = len(self.connections)
+        for i in range(0, len(jobs), N):
+            batch = jobs[i:i+N]
+            for conn, job in zip(self.connections, batch):
+                conn.send(('abfind', tuple(job)))
+            results += [self._receive(conn) for conn in self.connections[:len(batch)]]
+        return results
+
+    def abfind(self, atmosphere, params):
+        '''Run MOOG and read the results (see MoogEngine.abfind)'''
+        return self.map([(atmosphere, params)])[0]
+
+    def close(self):
+        '''Stop the workers and remove their folders'''
+        for conn in self.connections:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+        shutil.rmtree(self.path, ignore_errors=True)
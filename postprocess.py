@@ -1,12 +1,13 @@
 #!/usr/bin/python
 
-from __future__ import division
+from __future__ import division, print_function
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import argparse
 import seaborn as sns
+from stellar import torres, add_properties, ages
 colorSB = sns.color_palette()
 
 pd.set_option('display.max_rows', 500)
@@ -14,55 +15,16 @@ pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
 
 
-def massTorres(teff, erteff, logg, erlogg, feh, erfeh):
-    """Calculate a mass using the Torres calibration"""
-    ntrials = 100
-    randomteff = teff + erteff * np.random.randn(ntrials)
-    randomlogg = logg + erlogg * np.random.randn(ntrials)
-    randomfeh = feh + erfeh * np.random.randn(ntrials)
+def massTorres(teff, erteff, logg, erlogg, feh, erfeh, ntrials=100, seed=None):
+    """Calculate a mass using the Torres calibration (see stellar.torres)"""
+    mass, masserr, _, _ = torres(teff, erteff, logg, erlogg, feh, erfeh, ntrials=ntrials, seed=seed)
+    return mass[0], masserr[0]
 
-    # Parameters for the Torres calibration:
-    a1, a2, a3 = 1.5689, 1.3787, 0.4243
-    a4, a5, a6 = 1.139, -0.1425, 0.01969
-    a7 = 0.1010
 
-    logM = np.zeros(ntrials)
-    for i in xrange(ntrials):
-        X = np.log10(randomteff[i]) - 4.1
-        logM[i] = a1 + a2*X + a3*X**2 + a4*X**3 + a5*randomlogg[i]**2 + a6*randomlogg[i]**3 + a7*randomfeh[i]
-
-    meanMasslog = np.mean(logM)
-    sigMasslog = np.sqrt(np.sum(logM-meanMasslog)**2)/(ntrials-1)
-    sigMasslogTot = np.sqrt(0.027**2 + sigMasslog**2)
-
-    meanMass = 10**meanMasslog
-    sigMass = 10**(meanMasslog + sigMasslogTot) - meanMass
-    return meanMass, sigMass
-
-
-def radTorres(teff, erteff, logg, erlogg, feh, erfeh):
-    ntrials = 100
-    randomteff = teff + erteff*np.random.randn(ntrials)
-    randomlogg = logg + erlogg*np.random.randn(ntrials)
-    randomfeh = feh + erfeh*np.random.randn(ntrials)
-
-    # Parameters for the Torres calibration:
-    b1, b2, b3 = 2.4427, 0.6679, 0.1771
-    b4, b5, b6 = 0.705, -0.21415, 0.02306
-    b7 = 0.04173
-
-    logR = np.zeros(ntrials)
-    for i in xrange(ntrials):
-        X = np.log10(randomteff[i]) - 4.1
-        logR[i] = b1 + b2*X + b3*X**2 + b4*X**3 + b5*randomlogg[i]**2 + b6*randomlogg[i]**3 + b7*randomfeh[i]
-
-    meanRadlog = np.mean(logR)
-    sigRadlog = np.sqrt(np.sum((logR-meanRadlog)**2))/(ntrials-1)
-    sigRadlogTot = np.sqrt(0.014**2 + sigRadlog**2)
-
-    meanRad = 10**meanRadlog
-    sigRad = 10**(meanRadlog + sigRadlogTot) - meanRad
-    return meanRad, sigRad
+def radTorres(teff, erteff, logg, erlogg, feh, erfeh, ntrials=100, seed=None):
+    """Calculate a radius using the Torres calibration (see stellar.torres)"""
+    _, _, radius, radiuserr = torres(teff, erteff, logg, erlogg, feh, erfeh, ntrials=ntrials, seed=seed)
+    return radius[0], radiuserr[0]
 
 
 def _parser():
@@ -82,6 +44,8 @@ def _parser():
     parser.add_argument('-s', help='Place Solar values in the plot', default=False, action='store_true')
     parser.add_argument('-l', help='Fit a linear regression', default=False, action='store_true')
     parser.add_argument('-p', '--plotting', help='The settings for plotting', choices=['screen', 'paper', 'poster'], default='screen')
+    parser.add_argument('-n', '--ntrials', help='Monte Carlo trials for the mass and radius', type=int, default=100)
+    parser.add_argument('--seed', help='Seed of the Monte Carlo trials', type=int, default=None)
     args = parser.parse_args()
     return args
 
@@ -127,23 +91,10 @@ if __name__ == '__main__':
 
     m_ = ['mass', 'masserr', 'lum', 'radius', 'radiuserr', 'age']
     if (args.x in m_) or (args.y in m_) or (args.z in m_):
-        params = zip(df.teff, df.tefferr, df.logg, df.loggerr, df.feh, df.feherr)
-        m = [massTorres(t, et, l, el, f, ef) for t, et, l, el, f, ef in params]
-        r = [radTorres(t, et, l, el, f, ef) for t, et, l, el, f, ef in params]
-        df['mass'] = pd.Series(np.asarray(m)[:, 0])
-        df['masserr'] = pd.Series(np.asarray(m)[:, 1])
-        df['radius'] = pd.Series(np.asarray(r)[:, 0])
-        df['radiuserr'] = pd.Series(np.asarray(r)[:, 1])
-        df['lum'] = (df.teff/5777)**4 * df.radius**2
+        df = add_properties(df, ntrials=args.ntrials, seed=args.seed)
 
     if (args.x == 'age') or (args.y == 'age') or (args.z == 'age'):
-        from isochrones.dartmouth import Dartmouth_Isochrone
-        dar = Dartmouth_Isochrone()
-        age = np.zeros(df.shape[0])
-        for i, (mass, feh) in enumerate(df[['mass', 'feh']].values):
-            tmp = dar.agerange(mass, feh)
-            age[i] = (10**(tmp[0]-9) + 10**(tmp[1]-9))/2
-        df['age'] = pd.Series(age)
+        df['age'] = ages(df.mass.values, df.feh.values)
 
     df1 = df[df.convergence]
     df2 = df[~df.convergence]
@@ -171,7 +122,7 @@ if __name__ == '__main__':
 
     if args.l:
         p = np.polyfit(df1[args.x], df1[args.y], deg=1)
-        print '  y=%.3f*x+%.3f' % (p[0], p[1])
+        print('  y=%.3f*x+%.3f' % (p[0], p[1]))
         yfit = np.poly1d(p)(df1[args.x])
         plt.plot(df1[args.x], yfit, '-k')
 
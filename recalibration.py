@@ -2,7 +2,7 @@
 # -*- coding: utf8 -*-
 
 # My imports
-from __future__ import division
+from __future__ import division, print_function
 import numpy as np
 import pandas as pd
 import argparse
@@ -41,8 +41,175 @@ def solar_abundance(atom):
     return solar[atom-1]
 
 
+_fmt = ('%9.3f', '%10.1f', '%9.2f', '%9.3f', '%28.1f')
+_header = 'Wavelength     ele    EP     loggf        EW'
+
+
+def _saveLines(lines, loggf, fname='temporary.moog'):
+    '''Save the line list for MOOG with a trial loggf for each line
+
+    MOOG takes the values as gf (and not loggf) if all of them are positive,
+    so gf is written in that case.
+
+    Inputs
+    ------
+    lines : ndarray
+      The lines (wavelength, element, EP, loggf, EW)
+    loggf : ndarray
+      The trial loggf of each line
+    fname : str
+      The line list for MOOG (default: temporary.moog)
+    '''
+    lines = np.array(lines, dtype=float)
+    fmt = list(_fmt)
+    if np.all(loggf >= 0):
+        lines[:, 3] = 10**loggf
+        fmt[3] = '%9.4g'
+    else:
+        lines[:, 3] = loggf
+    np.savetxt(fname, lines, fmt=fmt, header=_header)
+
+
+def _match(lines, wavelength, values):
+    '''The value of each line found by its wavelength, NaN for the lines
+    which are not in the output from MOOG'''
+    found = {}
+    for w, value in zip(wavelength, values):
+        found.setdefault(round(w, 2), []).append(value)
+    out = np.zeros(len(lines)) + np.nan
+    for i, w in enumerate(lines[:, 0]):
+        values = found.get(round(w, 2))
+        if values:
+            out[i] = values.pop(0)
+    return out
+
+
+def _abundances(lines, params=None, version=2014, fname='summary.out'):
+    '''The abundance of each line relative to the Sun (driver abfind)'''
+    m = Readmoog(params=params, fname=fname, version=version)
+    idx = 1 if version > 2013 else 0
+    table = [block['lines'] for block in m.species()]
+    table = np.vstack(table) if table else np.zeros((0, 7+idx))
+    abund = _match(lines, table[:, 0], table[:, 5+idx])
+    solar = np.array([solar_abundance(int(element)) for element in lines[:, 1]])
+    return np.round(abund - solar, 3)
+
+
+def _ews(lines, fname='summary.out'):
+    '''The difference between the EW from MOOG and the measured EW of each
+    line (driver ewfind)'''
+    table = []
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                values = list(map(float, line.split()))
+            except ValueError:
+                continue
+            if len(values) > 6:
+                table.append(values)
+    table = np.array(table) if table else np.zeros((0, 7))
+    return _match(lines, table[:, 0], table[:, 6]) - lines[:, 4]
+
+
+def illinois(a, b, fa, fb, c, fc, side):
+    '''One step of the Illinois method (regula falsi) for many roots at once
+
+    Inputs
+    ------
+    a, b : ndarray
+      The brackets of the roots
+    fa, fb : ndarray
+      The function at the brackets, with different signs
+    c, fc : ndarray
+      The new point inside the brackets and the function there
+    side : ndarray
+      The bracket which was kept in the last step (-1 for a, 1 for b, 0 for
+      none). The function at a bracket kept twice in a row is halved, so the
+      method does not get stuck at one side like regula falsi.
+
+    Outputs
+    -------
+    a, b, fa, fb, side : ndarray
+      The new brackets, with the root between them
+    '''
+    a, b, fa, fb, side = [np.array(x, dtype=float) for x in (a, b, fa, fb, side)]
+    left = fa*fc < 0  # The root is between a and c
+    right = ~left
+    fa[left & (side == -1)] /= 2
+    fb[right & (side == 1)] /= 2
+    b[left], fb[left] = c[left], fc[left]
+    a[right], fa[right] = c[right], fc[right]
+    side[left], side[right] = -1, 1
+    return a, b, fa, fb, side
+
+
+def recalibrate(lines, params=None, version=2014, maxiter=40, driver='abfind', xtol=5e-4):
+    '''Recalibrate the loggf of all lines at the same time
+
+    The root of each line is bracketed in loggf+-5 and found with the Illinois
+    method. Each iteration is a single run of MOOG for all lines, each line at
+    its own trial loggf, so the number of runs does not depend on the number
+    of lines.
+
+    Inputs
+    ------
+    lines : ndarray
+      The lines containing (wavelength, element, EP, loggf, EW) in that order
+    params : list/tuple
+      The parameters (Teff, logg, [Fe/H], vt)
+    version : int
+      The version of MOOG
+    maxiter : int
+      The maximum number of iterations (default: 40)
+    driver : str
+      The MOOG driver to use (abfind or ewfind)
+    xtol : float
+      A line is done when its bracket is smaller than this (default: 0.0005)
+
+    Output
+    ------
+    loggf : ndarray
+      The new recalibrated loggf of each line. Lines without a root in the
+      bracket get the end of the bracket closest to it, and lines which MOOG
+      did not give keep the old loggf.
+    '''
+    lines = np.atleast_2d(np.array(lines, dtype=float))
+    ewfind = driver == 'ewfind'
+    ftol = 0.05 if ewfind else 5e-4  # The precision of the output from MOOG
+
+    def moog(loggf):
+        _saveLines(lines, loggf)
+        runMoog()
+        if ewfind:
+            return _ews(lines)
+        return _abundances(lines, params=params, version=version)
+
+    loggf = lines[:, 3].copy()
+    a, b = loggf-5, loggf+5  # extreme values of loggf
+    fa, fb = moog(a), moog(b)
+    found = np.isfinite(fa) & np.isfinite(fb)
+    closest = np.where(np.abs(fa) < np.abs(fb), a, b)
+    loggf[found] = closest[found]
+    active = found & (fa*fb < 0)
+    side = np.zeros(len(lines))
+    for _ in range(maxiter):
+        if not active.any():
+            break
+        c = loggf.copy()
+        c[active] = (b - fb*(b-a)/(fb-fa))[active]
+        fc = moog(c)
+        # Lines which MOOG lost keep the best loggf so far
+        active &= np.isfinite(fc)
+        loggf[active] = c[active]
+        step = illinois(a, b, fa, fb, c, fc, side)
+        for new, old in zip(step, (a, b, fa, fb, side)):
+            old[active] = new[active]
+        active &= (np.abs(fc) > ftol) & (b-a > xtol)
+    return loggf
+
+
 def recalSingleLine(line, params=None, version=2014, maxiter=40, driver='abfind'):
-    '''Recalibrate a single line and return the new loggf
+    '''Recalibrate a single line and return the new loggf (see recalibrate)
 
     Inputs
     ------
@@ -60,42 +227,7 @@ def recalSingleLine(line, params=None, version=2014, maxiter=40, driver='abfind'
     loggf : float
       The new recalibrated loggf
     '''
-
-    def moogAbund(loggf, ewdriver=False):
-        line[3] = loggf
-        np.savetxt('temporary.moog', line[:, np.newaxis].T, fmt=fmt, header=header)
-        runMoog()
-        if ewdriver:
-            d = np.loadtxt('summary.out', skiprows=5, usecols=(6,))
-            out = d-line[4]
-        else:
-            m = Readmoog(params=params, version=version)
-            _, abund = m.elements()
-            solar = solar_abundance(int(line[1]))
-            out = round(abund[0] - solar, 3)
-        return out
-
-    ewdriver = True if driver == 'ewfind' else False
-
-    fmt = ('%9.3f', '%10.1f', '%9.2f', '%9.3f', '%28.1f')
-    header = 'Wavelength     ele    EP     loggf        EW'
-    np.savetxt('temporary.moog', line[:, np.newaxis].T, fmt=fmt, header=header)
-    loggf_old = line[3]
-    a, b = loggf_old-5, loggf_old+5  # extreme values of loggf
-    c = (a+b)/2
-    for _ in range(maxiter):
-        if c == 0:  # Don't evaluate at loggf = 0
-            c += (abs(a) + abs(b)) / 10
-        fa = moogAbund(a, ewdriver=ewdriver)
-        fc = moogAbund(c, ewdriver=ewdriver)
-        if fc == 0:
-            return c
-        elif fa*fc < 0:
-            b = c
-        else:
-            a = c
-        c = (a+b)/2
-    return c
+    return float(recalibrate(line, params=params, version=version, maxiter=maxiter, driver=driver)[0])
 
 
 def _parser():
@@ -104,7 +236,7 @@ def _parser():
     parser.add_argument('output', help='Name of output file (saved in rawLinelist)')
     parser.add_argument('-m', '--model', help='Model atmosphere', default='kurucz95', choices=['kurucz95', 'apogee_kurucz', 'marcs'])
     parser.add_argument('-v', '--moogversion', help='MOOG version', default=2014)
-    parser.add_argument('-d', '--damping', help='Damping to be used in MOOG', default=1, choices=map(str, [1, 2]))
+    parser.add_argument('-d', '--damping', help='Damping to be used in MOOG', default=1, choices=list(map(str, [1, 2])))
     parser.add_argument('-dr', '--driver', help='Which driver to use', default='abfind', choices=['abfind', 'ewfind'])
     parser.add_argument('-p', '--parameters', help='Atmospheric parameters, Teff, logg, [Fe/H], vt', nargs='+', default=None)
     args = parser.parse_args()
@@ -124,7 +256,7 @@ if __name__ == '__main__':  # pragma: no cover
     if args.parameters is None:
         params = [5777, 4.44, 0.00, 1.00]
     else:
-        params = map(float, args.parameters)
+        params = list(map(float, args.parameters))
         params[0] = int(params[0])
 
     interpolator(params=params, atmtype=args.model, save=True)
@@ -134,29 +266,26 @@ if __name__ == '__main__':  # pragma: no cover
     header1 = 'WL         num       E.P.     loggf         ele     EWsun\n'
     header1 += '-------    ----      ----     ------        ----    -----'
     header2 = 'Wavelength     ele       EP      loggf                          EW'
-    x = lines[cols].values[0][:, np.newaxis].T
+    x = lines[cols].values
     np.savetxt('temporary.moog', x, fmt=fmt2, header=header2)
 
     options = {'driver': args.driver,
                'damping': args.damping}
     updateBatch(line_list='temporary.moog', **options)
 
-    newloggf = np.zeros(lines.shape[0])
-    for i, line in enumerate(lines[cols].values):
-        print 'Wavelength: %.3f' % line[0]
-        print 'Old loggf: %.3f' % line[3]
-        zz = recalSingleLine(line, params=params, version=args.moogversion, driver=args.driver)
-        zz = np.log10(zz) if zz > 0 else zz
-        newloggf[i] = zz
-        print 'New loggf: %.3f\n' % newloggf[i]
+    newloggf = recalibrate(x, params=params, version=int(args.moogversion), driver=args.driver)
+    for line, loggf in zip(x, newloggf):
+        print('Wavelength: %.3f' % line[0])
+        print('Old loggf: %.3f' % line[3])
+        print('New loggf: %.3f\n' % loggf)
 
     lines['newloggf'] = pd.Series(newloggf)
     X = lines[['WL', 'num', 'EP', 'newloggf', 'ele', 'EW']]
     fmt1 = ('%7.2f', '%7.1f', '%9.2f', '%10.3f', '%10s', '%9.1f')
-    print 'Saving results to: %s' % fout1
+    print('Saving results to: %s' % fout1)
     np.savetxt(fout1, X, fmt=fmt1, header=header1, comments='')
 
     X = lines[['WL', 'num', 'EP', 'newloggf', 'EW']]
-    print 'Saving results to: %s' % fout2
+    print('Saving results to: %s' % fout2)
     np.savetxt(fout2, X, fmt=fmt2, header=header2)
     os.remove('temporary.moog')
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''An append-only store for the results of the drivers.
+
+The results are kept in SQLite in a long format: an entry for each star (or
+line list), and a field for each of its values. Adding a star is a single
+transaction, which does not depend on the number of stars already there, new
+columns (e.g. a new element) do not change the old entries, and several
+processes can add to the same store at the same time. The tables in the old
+comma separated layout are made with export:
+
+    python resultstore.py abundresults.db abundances -o abundresults.dat
+    python resultstore.py EWresults.db ew --star sun_harps_ganymede.moog
+
+ResultsTable ties a store to one of the tables of the drivers
+(EWresults.dat, abundresults.dat and FASMA_all.dat).
+
+The store also keeps a manifest with a hash of the inputs of each result (see
+fingerprint). With the option resume the drivers skip the entries of their
+configuration files whose inputs did not change since the last run, so a run
+which died, or a configuration file with new stars, only does the new work.
+'''
+
+# My imports
+from __future__ import division, print_function
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    star TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    entry INTEGER NOT NULL REFERENCES entries(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value
+);
+CREATE TABLE IF NOT EXISTS manifest (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    entry INTEGER REFERENCES entries(id),
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS entries_kind_star ON entries (kind, star);
+CREATE INDEX IF NOT EXISTS fields_entry ON fields (entry);
+'''
+
+
+def _value(value):
+    '''A value as it is saved in SQLite. Booleans are saved as text, so
+    they are exported as True/False, and NaN as NULL.'''
+    if value is None or isinstance(value, (bool, np.bool_)):
+        return None if value is None else str(bool(value))
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    return str(value)
+
+
+def fingerprint(values=(), files=()):
+    '''A hash of the inputs of a run
+
+    Inputs
+    ------
+    values : list/dict
+      Values which can be written as JSON, e.g. the options and the initial
+      parameters
+    files : list
+      Files, e.g. a line list or a spectrum, of which the content is hashed
+
+    Output
+    ------
+    digest : str
+      The SHA-1 hash, or None if one of the files does not exist
+    '''
+    sha = hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf8'))
+    for fname in files:
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def _text(value, fmt=None):
+    '''A value as it is written by export, with a format such as %.2f for
+    numbers'''
+    if fmt is not None and isinstance(value, (int, float)):
+        return fmt % value
+    return str(value)
+
+
+class ResultStore:
+    '''Results of many stars in a SQLite database
+
+    Input
+    -----
+    fname : str
+      The database (default: results.db). It is created if needed.
+    timeout : float
+      Seconds to wait for other processes writing to the store (default: 60)
+    '''
+
+    def __init__(self, fname='results.db', timeout=60.0):
+        self.fname = fname
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.executescript(_schema)
+
+    @contextmanager
+    def _connect(self):
+        '''A connection which commits at the end, or rolls back on errors.
+        Connections are not kept, so the store can be sent to other
+        processes.'''
+        conn = sqlite3.connect(self.fname, timeout=self.timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, kind, star, row, key=None, digest=None):
+        '''Add the results of a star
+
+        Inputs
+        ------
+        kind : str
+          The kind of results, e.g. abundances
+        star : str
+          The name of the star or line list
+        row : dict/list
+          The results as {name: value}, or a list of (name, value) to keep
+          the order of the columns. Missing values (None or NaN) are left out
+        key : str
+          The entry of the configuration file with these results, e.g. the
+          whole line, for the manifest (default: None)
+        digest : str
+          The hash of the inputs of the entry (see fingerprint). The results
+          from an earlier run of the same key are replaced (default: None)
+
+        Output
+        ------
+        entry : int
+          The id of the new entry
+        '''
+        with self._connect() as conn:
+            entry = self._insert(conn, kind, star, row)
+            if key is not None and digest is not None:
+                old = conn.execute('SELECT entry FROM manifest WHERE kind = ? AND key = ?', (kind, str(key))).fetchone()
+                if old is not None and old[0] is not None:
+                    conn.execute('DELETE FROM fields WHERE entry = ?', old)
+                    conn.execute('DELETE FROM entries WHERE id = ?', old)
+                conn.execute('INSERT OR REPLACE INTO manifest (kind, key, digest, entry) VALUES (?, ?, ?, ?)',
+                             (kind, str(key), digest, entry))
+            return entry
+
+    def done(self, kind, key, digest):
+        '''True if the results of an entry of a configuration file are in the
+        store, from the same inputs (see add)'''
+        if digest is None:
+            return False
+        with self._connect() as conn:
+            old = conn.execute('SELECT digest FROM manifest WHERE kind = ? AND key = ?', (kind, str(key))).fetchone()
+        return old is not None and old[0] == digest
+
+    def _insert(self, conn, kind, star, row):
+        '''Insert an entry with its fields (see add)'''
+        row = list(row.items()) if isinstance(row, dict) else list(row)
+        created = time.strftime('%Y-%m-%dT%H:%M:%S')
+        entry = conn.execute('INSERT INTO entries (kind, star, created) VALUES (?, ?, ?)',
+                             (kind, str(star), created)).lastrowid
+        fields = [(entry, i, str(name), _value(value)) for i, (name, value) in enumerate(row)]
+        # Missing values (None or NaN) are not saved
+        conn.executemany('INSERT INTO fields (entry, position, name, value) VALUES (?, ?, ?, ?)',
+                         [field for field in fields if field[-1] is not None])
+        return entry
+
+    def load(self, kind, fname, star='linelist', sep=',', na='...'):
+        '''Add the rows of a table in the layout of export, e.g. from before
+        the store was used
+
+        Inputs
+        ------
+        kind : str
+          The kind of results, e.g. abundances
+        fname : str
+          The table with a header
+        star : str
+          The column with the name of the star or line list (default:
+          linelist, or the first column if there is none)
+        sep : str
+          The column separator (default: ,)
+        na : str
+          Missing values in the table (default: ...)
+
+        Output
+        ------
+        n : int
+          The number of rows added
+        '''
+        def convert(value):
+            for type_ in (int, float):
+                try:
+                    return type_(value)
+                except ValueError:
+                    pass
+            return value
+
+        n = 0
+        with open(fname, 'r') as f, self._connect() as conn:
+            header = f.readline().strip('\n').split(sep)
+            for line in f:
+                values = line.strip('\n').split(sep)
+                if len(values) != len(header):
+                    continue
+                # Missing values are not saved (see add)
+                row = [(name, convert(value)) for name, value in zip(header, values) if value not in (na, '')]
+                self._insert(conn, kind, dict(row).get(star, values[0]), row)
+                n += 1
+        return n
+
+    def count(self, kind):
+        '''The number of entries of a kind'''
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM entries WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def clear(self, kind):
+        '''Remove all results of a kind'''
+        with self._connect() as conn:
+            conn.execute('DELETE FROM fields WHERE entry IN (SELECT id FROM entries WHERE kind = ?)', (kind,))
+            conn.execute('DELETE FROM entries WHERE kind = ?', (kind,))
+            conn.execute('DELETE FROM manifest WHERE kind = ?', (kind,))
+
+    def rows(self, kind, star=None):
+        '''The results in the order they were added
+
+        Inputs
+        ------
+        kind : str
+          The kind of results, e.g. abundances
+        star : str
+          Only the results of this star or line list (default: all)
+
+        Output
+        ------
+        rows : list
+          An OrderedDict with the values of each entry
+        '''
+        sql = 'SELECT entries.id, fields.name, fields.value FROM entries JOIN fields ON fields.entry = entries.id ' \
+              'WHERE entries.kind = ?'
+        args = [kind]
+        if star is not None:
+            sql += ' AND entries.star = ?'
+            args.append(str(star))
+        sql += ' ORDER BY entries.id, fields.position'
+        rows = OrderedDict()
+        with self._connect() as conn:
+            for entry, name, value in conn.execute(sql, args):
+                rows.setdefault(entry, OrderedDict())[name] = value
+        return list(rows.values())
+
+    def columns(self, kind, rows=None):
+        '''The names of all values of a kind, in the order they first appear'''
+        rows = self.rows(kind) if rows is None else rows
+        columns = OrderedDict()
+        for row in rows:
+            for name in row:
+                columns[name] = None
+        return list(columns.keys())
+
+    def table(self, kind, star=None):
+        '''The results as a pandas DataFrame with a column for each value (see
+        rows)'''
+        import pandas as pd
+        rows = self.rows(kind, star=star)
+        return pd.DataFrame(rows, columns=self.columns(kind, rows=rows))
+
+    def export(self, kind, fname, sep=',', na='...', columns=None, formats=None):
+        '''Write the results in a table with a header, one line for each entry
+
+        Inputs
+        ------
+        kind : str
+          The kind of results, e.g. abundances
+        fname : str
+          The output file
+        sep : str
+          The column separator (default: ,)
+        na : str
+          Written for missing values (default: ...)
+        columns : list
+          The first columns, the others follow in the order they first appear
+          (default: None)
+        formats : dict
+          The format of the numbers of some columns, e.g. {'logg': '%.2f'}
+          (default: None)
+
+        Output
+        ------
+        fname : file
+          The table. It is written to a temporary file first, so readers never
+          see half a table.
+        '''
+        rows = self.rows(kind)
+        formats = formats or {}
+        header = list(columns or [])
+        header += [name for name in self.columns(kind, rows=rows) if name not in header]
+        tmp = '%s.tmp%i' % (fname, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(sep.join(header) + '\n')
+            for row in rows:
+                values = [(name, row.get(name)) for name in header]
+                f.write(sep.join(na if value is None else _text(value, formats.get(name))
+                                 for name, value in values) + '\n')
+        os.rename(tmp, fname)
+        return fname
+
+
+class ResultsTable:
+    '''A table of results of the drivers (e.g. EWresults.dat) backed by a
+    ResultStore. Each star is added to the store, which takes the same time
+    whatever the number of stars already there, and is safe with several
+    processes. The table itself is only written by export.
+
+    Inputs
+    ------
+    fname : str
+      The table, e.g. abundresults.dat
+    kind : str
+      The kind of results in the store, e.g. abundances
+    columns : list
+      The first columns of the table (default: None)
+    sep : str
+      The column separator (default: ,)
+    na : str
+      Written for missing values (default: ...)
+    formats : dict
+      The format of the numbers of some columns (default: None)
+    store : str
+      The SQLite store (default: fname with the extension .db). If the store
+      is empty and the table exists, the rows of the table are added first.
+    '''
+
+    def __init__(self, fname, kind, columns=None, sep=',', na='...', formats=None, store=None):
+        self.fname = fname
+        self.kind = kind
+        self.columns = list(columns or [])
+        self.sep = sep
+        self.na = na
+        self.formats = formats
+        self.store = ResultStore(store or '%s.db' % os.path.splitext(fname)[0])
+        if not self.store.count(kind) and os.path.isfile(fname):
+            self.store.load(kind, fname, star=self.columns[0] if self.columns else None, sep=sep, na=na)
+
+    def add(self, star, row, key=None, digest=None):
+        '''Add the results of a star (see ResultStore.add)'''
+        return self.store.add(self.kind, star, row, key=key, digest=digest)
+
+    def done(self, key, digest):
+        '''True if an entry is done with the same inputs (see ResultStore.done)'''
+        return self.store.done(self.kind, key, digest)
+
+    def rows(self, star=None):
+        '''The results, of all stars or only one (see ResultStore.rows)'''
+        return self.store.rows(self.kind, star=star)
+
+    def table(self, star=None):
+        '''The results as a pandas DataFrame (see ResultStore.table)'''
+        return self.store.table(self.kind, star=star)
+
+    def clear(self):
+        '''Remove all results'''
+        self.store.clear(self.kind)
+
+    def export(self):
+        '''Write the table with all results (see ResultStore.export)'''
+        return self.store.export(self.kind, self.fname, sep=self.sep, na=self.na, columns=self.columns,
+                                 formats=self.formats)
+
+
+if __name__ == '__main__':
+    import argparse
+    args = argparse.ArgumentParser(description='Export results from a store to a table, or show the results of a star.')
+    args.add_argument('store',          help='The SQLite store, e.g. abundresults.db')
+    args.add_argument('kind',           help='The kind of results, e.g. abundances')
+    args.add_argument('-o', '--out',    help='Output table', default=None)
+    args.add_argument('-s', '--sep',    help='Column separator', default=',')
+    args.add_argument('--star',         help='Only print the results of this star or line list', default=None)
+    args = args.parse_args()
+
+    if not os.path.isfile(args.store):
+        raise IOError('No such store: %s' % args.store)
+    store = ResultStore(args.store)
+    if args.star:
+        for row in store.rows(args.kind, star=args.star):
+            print(args.sep.join('%s=%s' % item for item in row.items()))
+    else:
+        out = args.out or '%s.dat' % os.path.splitext(args.store)[0]
+        print('Saved in: %s' % store.export(args.kind, out, sep=args.sep))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''Mass, radius, luminosity and age of the stars from the spectroscopic
+parameters.
+
+The Torres et al. (2010) calibration is done for all stars and all Monte
+Carlo trials at once, on arrays with a row for each star and a column for
+each trial. The ages come from a table of the Dartmouth isochrones over
+(mass, [Fe/H]), which is made once and kept on disk:
+
+    python stellar.py
+'''
+
+# My imports
+from __future__ import division, print_function
+import os
+import numpy as np
+
+# Coefficients of the Torres calibration for log M and log R, and the scatter
+# of the calibration
+_mass = (1.5689, 1.3787, 0.4243, 1.139, -0.1425, 0.01969, 0.1010)
+_radius = (2.4427, 0.6679, 0.1771, 0.705, -0.21415, 0.02306, 0.04173)
+_scatter = {'mass': 0.027, 'radius': 0.014}
+
+
+def _calibration(coefficients, teff, logg, feh):
+    '''The Torres calibration (log M or log R) on arrays'''
+    c1, c2, c3, c4, c5, c6, c7 = coefficients
+    X = np.log10(teff) - 4.1
+    return c1 + c2*X + c3*X**2 + c4*X**3 + c5*logg**2 + c6*logg**3 + c7*feh
+
+
+def _statistics(values, scatter):
+    '''The mean and error from the trials (in log) of each star, with the
+    scatter of the calibration added'''
+    ntrials = values.shape[1]
+    mean = np.mean(values, axis=1)
+    sigma = np.sqrt(np.sum((values-mean[:, np.newaxis])**2, axis=1))/(ntrials-1)
+    sigma = np.sqrt(scatter**2 + sigma**2)
+    return 10**mean, 10**(mean + sigma) - 10**mean
+
+
+def torres(teff, erteff, logg, erlogg, feh, erfeh, ntrials=100, seed=None):
+    '''Mass and radius from the Torres calibration, with errors from Monte
+    Carlo trials
+
+    Inputs
+    ------
+    teff, erteff : ndarray/float
+      Effective temperature and its error for each star
+    logg, erlogg : ndarray/float
+      Surface gravity and its error
+    feh, erfeh : ndarray/float
+      Metallicity and its error
+    ntrials : int
+      Number of trials for each star (default: 100)
+    seed : int
+      Seed of the random numbers, for results which can be repeated
+      (default: None)
+
+    Outputs
+    -------
+    mass, masserr : ndarray
+      The mass and its error in solar masses
+    radius, radiuserr : ndarray
+      The radius and its error in solar radii
+    '''
+    rng = np.random.RandomState(seed)
+    params = [np.atleast_1d(np.asarray(p, dtype=float))[:, np.newaxis] for p in (teff, erteff, logg, erlogg, feh, erfeh)]
+    teff, erteff, logg, erlogg, feh, erfeh = params
+    shape = (max(len(p) for p in params), ntrials)
+    teff = teff + erteff*rng.randn(*shape)
+    logg = logg + erlogg*rng.randn(*shape)
+    feh = feh + erfeh*rng.randn(*shape)
+
+    mass, masserr = _statistics(_calibration(_mass, teff, logg, feh), _scatter['mass'])
+    radius, radiuserr = _statistics(_calibration(_radius, teff, logg, feh), _scatter['radius'])
+    return mass, masserr, radius, radiuserr
+
+
+def luminosity(teff, erteff, radius, radiuserr):
+    '''The luminosity from Teff and the radius
+
+    Inputs
+    ------
+    teff, erteff : ndarray/float
+      Effective temperature and its error
+    radius, radiuserr : ndarray/float
+      Radius and its error in solar radii
+
+    Outputs
+    -------
+    lum, lumerr : ndarray
+      The luminosity and its error in solar luminosities
+    '''
+    teff, erteff, radius, radiuserr = [np.asarray(p, dtype=float) for p in (teff, erteff, radius, radiuserr)]
+    lum = (teff/5777)**4 * radius**2
+    lumerr = lum * np.sqrt((4*erteff/teff)**2 + (2*radiuserr/radius)**2)
+    return lum, lumerr
+
+
+def add_properties(df, ntrials=100, seed=None):
+    '''Add the mass, radius and luminosity to a table of results
+
+    Inputs
+    ------
+    df : pd.DataFrame
+      The results with the columns teff, tefferr, logg, loggerr, feh and feherr
+    ntrials : int
+      Number of trials for each star (default: 100)
+    seed : int
+      Seed of the random numbers (default: None)
+
+    Output
+    ------
+    df : pd.DataFrame
+      The same table with the columns mass, masserr, radius, radiuserr, lum
+      and lumerr
+    '''
+    columns = [df[name].values for name in ('teff', 'tefferr', 'logg', 'loggerr', 'feh', 'feherr')]
+    mass, masserr, radius, radiuserr = torres(*columns, ntrials=ntrials, seed=seed)
+    df['mass'], df['masserr'] = mass, masserr
+    df['radius'], df['radiuserr'] = radius, radiuserr
+    df['lum'], df['lumerr'] = luminosity(df.teff.values, df.tefferr.values, radius, radiuserr)
+    return df
+
+
+# The grid of the table of ages
+agegrid = {'mass': np.round(np.arange(0.5, 2.501, 0.01), 2),
+           'feh': np.round(np.arange(-2.0, 0.501, 0.05), 2)}
+
+
+def agetable(fname='models/dartmouth_ages.npz', grid=agegrid):
+    '''The range of ages from the Dartmouth isochrones over a grid in
+    (mass, [Fe/H]). It is made once with the isochrones package, and read
+    from fname afterwards
+
+    Inputs
+    ------
+    fname : str
+      The table on disk (default: models/dartmouth_ages.npz)
+    grid : dict
+      The values of mass and feh (default: agegrid)
+
+    Outputs
+    -------
+    mass, feh : ndarray
+      The axes of the table
+    logage : ndarray
+      The lowest and highest log age (yr) at each point, with shape
+      (mass, feh, 2). NaN where there is no isochrone
+    '''
+    if os.path.isfile(fname):
+        with np.load(fname) as data:
+            if np.array_equal(data['mass'], grid['mass']) and np.array_equal(data['feh'], grid['feh']):
+                return data['mass'], data['feh'], data['logage']
+
+    from isochrones.dartmouth import Dartmouth_Isochrone
+    dar = Dartmouth_Isochrone()
+    logage = np.zeros((len(grid['mass']), len(grid['feh']), 2)) + np.nan
+    for i, mass in enumerate(grid['mass']):
+        for j, feh in enumerate(grid['feh']):
+            try:
+                logage[i, j] = dar.agerange(mass, feh)
+            except (ValueError, IndexError, RuntimeError):
+                continue
+    if os.path.dirname(fname) and not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    np.savez_compressed(fname, mass=grid['mass'], feh=grid['feh'], logage=logage)
+    return grid['mass'], grid['feh'], logage
+
+
+def ages(mass, feh, fname='models/dartmouth_ages.npz', grid=agegrid):
+    '''The age of the stars from the Dartmouth isochrones, as the middle of
+    the range of ages for the mass and [Fe/H]. All stars are looked up at
+    once in the table (see agetable)
+
+    Inputs
+    ------
+    mass : ndarray/float
+      The mass in solar masses
+    feh : ndarray/float
+      The metallicity
+    fname : str
+      The table on disk (default: models/dartmouth_ages.npz)
+    grid : dict
+      The values of mass and feh of the table (default: agegrid)
+
+    Output
+    ------
+    age : ndarray
+      The age in Gyr, NaN outside the table
+    '''
+    from scipy.interpolate import RegularGridInterpolator
+    masses, fehs, logage = agetable(fname=fname, grid=grid)
+    interpolate = RegularGridInterpolator((masses, fehs), logage, bounds_error=False, fill_value=np.nan)
+    points = np.column_stack(np.broadcast_arrays(np.atleast_1d(mass), np.atleast_1d(feh))).astype(float)
+    logage = interpolate(points)
+    return (10**(logage[:, 0]-9) + 10**(logage[:, 1]-9))/2
+
+
+if __name__ == '__main__':
+    import argparse
+    args = argparse.ArgumentParser(description='Make the table of ages from the Dartmouth isochrones.')
+    args.add_argument('-o', '--out', help='The table', default='models/dartmouth_ages.npz')
+    args = args.parse_args()
+    _, _, logage = agetable(fname=args.out)
+    print('Saved in: %s (%i of %i points with ages)' % (args.out, np.isfinite(logage[..., 0]).sum(), logage[..., 0].size))
@@ -0,0 +1,32 @@
+import os
+import aresDriver
+from utils import scratch
+from resultstore import ResultStore
+
+
+def test_resume_extra(monkeypatch):
+    calls = []
+
+    def aresRunner(linelist, spectrum, out, options):
+        # Only write the line list, as ARES would
+        calls.append(out)
+        with open('linelist/%s' % out.replace('.ares', '.moog'), 'w') as f:
+            f.write('%s\n' % options['output'])
+
+    monkeypatch.setattr(aresDriver, 'aresRunner', aresRunner)
+    with scratch(links=(), dirs=('spectra', 'rawLinelist', 'linelist')):
+        for fname in ('spectra/star.fits', 'rawLinelist/a.lst', 'rawLinelist/b.lst'):
+            with open(fname, 'w') as f:
+                f.write('%s\n' % fname)
+        with open('StarMe_ares.cfg', 'w') as f:
+            f.write('a.lst star.fits extra:b.lst\n')
+
+        aresDriver.aresdriver(resume=True)
+        assert calls == ['star.ares', 'star_sec.ares']
+        assert os.path.isfile('linelist/star.moog') and os.path.isfile('linelist/star_sec.moog')
+        rows = ResultStore('aresresults.db').rows('ares')
+        assert [row['linelist'] for row in rows] == ['linelist/star.moog']
+
+        # Nothing changed, so the spectrum is skipped
+        aresDriver.aresdriver(resume=True)
+        assert len(calls) == 2
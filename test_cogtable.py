@@ -0,0 +1,37 @@
+import numpy as np
+from utils import scratch, Readmoog
+from cogtable import COGTable, names
+
+
+def test_cogtable():
+    with scratch(links=()):
+        axes = [np.array([5500., 6000.]), np.array([4.0, 4.5]), np.array([-0.5, 0.0]), np.array([0.5, 1.5])]
+        ews = np.array([10., 100.])
+        lines = np.array([[5000.0, 26.0, 3.0, -1.0], [5100.0, 26.0, 2.0, -2.0], [5200.0, 26.0, 4.0, -1.5],
+                          [5300.0, 26.1, 3.5, -3.0], [5400.0, 26.1, 2.5, -2.5]])
+        # The abundance is 7.47 + [Fe/H] + log EW/10 at all points
+        abund = np.zeros((2, 2, 2, 2, len(lines), len(ews)))
+        abund += 7.47 + axes[2][None, None, :, None, None, None] + np.log10(ews/10)
+        titles = ['Abundance Results for Species Fe I          (input abundance =   7.470)\n',
+                  'Abundance Results for Species Fe II         (input abundance =   7.470)\n']
+        np.savez_compressed('table.npz', abund=abund, lines=lines, ews=ews, ids=np.array([26.0, 26.1]),
+                            titles=np.array(titles), atmtype='kurucz95', version=2014,
+                            **dict(zip(names, axes)))
+        table = COGTable('table.npz')
+
+        star = np.column_stack((lines, [10., 100., 31.6, 50., 20.]))
+        star[0, 3] += 0.1
+        x = [5777, 4.44, -0.2, 1.0]
+        abund = table.abundances(x, star)
+        assert np.allclose(abund, 7.27 + np.log10(star[:, 4]/10) - [0.1, 0, 0, 0, 0], atol=1e-3)
+        assert table.abundances([7000, 4.44, -0.2, 1.0], star) is None
+        assert table.abundances(x, np.vstack((star, [6000.0, 26.0, 1.0, -1.0, 20.0]))) is None
+
+        summary, params = table.summary(x, star)
+        with open('summary.out', 'w') as f:
+            f.writelines(summary)
+        m = Readmoog(fname='summary.out')
+        assert m.parameters() == (5777, 4.44, -0.2, 1.0)
+        fe1, _, fe2, _, _, _, linesFe1, linesFe2 = m.fe_statistics()
+        assert len(linesFe1) == 3 and len(linesFe2) == 2
+        assert np.allclose(linesFe1[:, 6], abund[:3], atol=1e-3)
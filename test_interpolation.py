@@ -6,6 +6,8 @@ import pytest
 from interpolation import read_model
 from interpolation import interpolator
 from interpolation import save_model
+from interpolation import _linear_weights
+from interpolation import _multilinear_weights
 
 
 def test_read_model():
@@ -51,3 +53,28 @@ def test_save_model():
     os.remove('test.atm')
     with pytest.raises(NameError):
         save_model(m, p, type='wrong', fout='test.atm')
+
+
+def test_interpolation_weights():
+    from scipy.interpolate import griddata
+    gridpoints = np.array([(t, g, f) for t in (5500, 5750, 6000, 6250)
+                           for g in (4.0, 4.5) for f in (0.0, 0.1)])
+    point = (5777, 4.44, 0.04)
+    values = np.random.rand(len(gridpoints))
+    w = _linear_weights(gridpoints, point)
+    assert np.isclose(w.sum(), 1)
+    assert np.isclose(w.dot(values), griddata(gridpoints, values, point, rescale=True))
+    assert np.all(np.isnan(_linear_weights(gridpoints, (7000, 4.44, 0.04))))
+    # Many points at once
+    points = np.array([point, (7000, 4.44, 0.04), (6100, 4.1, 0.01)])
+    W = _linear_weights(gridpoints, points)
+    assert W.shape == (3, len(gridpoints))
+    assert np.allclose(W[0], w)
+    assert np.all(np.isnan(W[1]))
+    assert np.allclose(W[2], _linear_weights(gridpoints, points[2]))
+
+    w = _multilinear_weights(gridpoints, point)
+    assert np.isclose(w.sum(), 1)
+    assert np.sum(w > 0) == 8
+    linear = 2*gridpoints[:, 0] + 3*gridpoints[:, 1] - gridpoints[:, 2]
+    assert np.isclose(w.dot(linear), 2*5777 + 3*4.44 - 0.04)
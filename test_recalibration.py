@@ -4,6 +4,7 @@ import pytest
 
 from recalibration import solar_abundance
 from recalibration import recalSingleLine
+from recalibration import illinois
 
 
 def test_solar_abundance():
@@ -15,6 +16,17 @@ def test_solar_abundance():
         solar_abundance('atom')
 
 
+def test_illinois():
+    # Roots of x**3 - r for three values of r at the same time
+    r = np.array([-8.0, 1.0, 27.0])
+    a, b = np.zeros(3) - 10, np.zeros(3) + 10
+    fa, fb, side = a**3 - r, b**3 - r, np.zeros(3)
+    for _ in range(60):
+        c = b - fb*(b-a)/(fb-fa)
+        a, b, fa, fb, side = illinois(a, b, fa, fb, c, c**3 - r, side)
+    assert np.allclose(c, [-2, 1, 3])
+
+
 # def test_recalSingleLine():
 #     line = np.array([4532.40, 26.0, 3.65, -1.800, 44.2])
 #     params = (5777, 4.44, 0.00, 1.00)
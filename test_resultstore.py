@@ -0,0 +1,73 @@
+import numpy as np
+from utils import scratch
+from resultstore import ResultStore, ResultsTable, fingerprint
+
+
+def test_add_and_export():
+    with scratch(links=()):
+        store = ResultStore('test.db')
+        store.add('abundances', 'a.moog', [('linelist', 'a.moog'), ('temperature', 5777), ('FeI', 7.47)])
+        store.add('abundances', 'b.moog', [('linelist', 'b.moog'), ('temperature', 5800),
+                                           ('TiI', np.float64(4.95)), ('FeI', np.nan)])
+        store.add('ew', 'a.moog', {'linelist': 'a.moog', 'convergence': True})
+        assert store.count('abundances') == 2
+        assert store.columns('abundances') == ['linelist', 'temperature', 'FeI', 'TiI']
+        assert store.rows('abundances', star='b.moog')[0]['TiI'] == 4.95
+        assert store.rows('ew')[0]['convergence'] == 'True'
+
+        store.export('abundances', 'abundresults.dat')
+        with open('abundresults.dat') as f:
+            assert f.readline() == 'linelist,temperature,FeI,TiI\n'
+            assert f.readline() == 'a.moog,5777,7.47,...\n'
+            assert f.readline() == 'b.moog,5800,...,4.95\n'
+
+        store.export('abundances', 'formats.dat', columns=['linelist', 'temperature'], formats={'temperature': '%.1f'})
+        with open('formats.dat') as f:
+            assert f.readlines()[1] == 'a.moog,5777.0,7.47,...\n'
+
+        # An exported table can be loaded again
+        store = ResultStore('other.db')
+        assert store.load('abundances', 'abundresults.dat') == 2
+        assert store.rows('abundances') == ResultStore('test.db').rows('abundances')
+
+        store.clear('abundances')
+        assert store.count('abundances') == 0
+
+
+def test_results_table():
+    with scratch(links=()):
+        with open('EWresults.dat', 'w') as f:
+            f.write('linelist\tteff\tconvergence\n')
+            f.write('a.moog\t5777\tTrue\n')
+        # The old table is kept in the new store
+        results = ResultsTable('EWresults.dat', 'ew', columns=['linelist', 'teff', 'convergence'], sep='\t')
+        assert results.store.fname == 'EWresults.db'
+        results.add('b.moog', [('linelist', 'b.moog'), ('teff', 5800), ('convergence', False)])
+        assert results.rows(star='a.moog') == [{'linelist': 'a.moog', 'teff': 5777, 'convergence': 'True'}]
+        results.export()
+        with open('EWresults.dat') as f:
+            assert f.read() == 'linelist\tteff\tconvergence\na.moog\t5777\tTrue\nb.moog\t5800\tFalse\n'
+        results.clear()
+        assert results.rows() == []
+
+
+def test_manifest():
+    with scratch(links=()):
+        with open('a.moog', 'w') as f:
+            f.write('a.moog\n5000.0 26.0 3.0 -1.0 50.0\n')
+        digest = fingerprint({'model': 'kurucz95'}, files=['a.moog'])
+        assert digest == fingerprint({'model': 'kurucz95'}, files=['a.moog'])
+        assert digest != fingerprint({'model': 'marcs'}, files=['a.moog'])
+        assert fingerprint(files=['b.moog']) is None
+
+        store = ResultStore('test.db')
+        assert not store.done('ew', 'a.moog', digest)
+        store.add('ew', 'a.moog', [('linelist', 'a.moog'), ('teff', 5700)], key='a.moog', digest=digest)
+        assert store.done('ew', 'a.moog', digest)
+        assert not store.done('ew', 'a.moog', 'other')
+        # New results of the same entry replace the old ones
+        store.add('ew', 'a.moog', [('linelist', 'a.moog'), ('teff', 5777)], key='a.moog', digest='other')
+        assert [row['teff'] for row in store.rows('ew')] == [5777]
+        assert store.done('ew', 'a.moog', 'other')
+        store.clear('ew')
+        assert not store.done('ew', 'a.moog', 'other')
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from utils import scratch
+from stellar import torres, luminosity, add_properties, ages
+
+
+def test_torres():
+    # Without errors all trials are the same, and only the scatter of the
+    # calibration is left
+    mass, masserr, radius, radiuserr = torres([5777, 5000], 0, [4.44, 4.5], 0, [0.0, -0.3], 0)
+    X = np.log10(5777) - 4.1
+    logM = 1.5689 + 1.3787*X + 0.4243*X**2 + 1.139*X**3 - 0.1425*4.44**2 + 0.01969*4.44**3
+    assert np.isclose(mass[0], 10**logM)
+    assert np.isclose(masserr[0], 10**(logM+0.027) - 10**logM)
+    logR = 2.4427 + 0.6679*X + 0.1771*X**2 + 0.705*X**3 - 0.21415*4.44**2 + 0.02306*4.44**3
+    assert np.isclose(radius[0], 10**logR)
+    assert np.isclose(radiuserr[0], 10**(logR+0.014) - 10**logR)
+
+    # The same seed gives the same results
+    assert np.allclose(torres(5777, 50, 4.44, 0.1, 0.0, 0.05, seed=1), torres(5777, 50, 4.44, 0.1, 0.0, 0.05, seed=1))
+
+    lum, lumerr = luminosity(5777, 0, 1.0, 0.0)
+    assert np.isclose(lum, 1.0) and np.isclose(lumerr, 0.0)
+
+    df = pd.DataFrame({'teff': [5777, 6000], 'tefferr': [50, 60], 'logg': [4.44, 4.3],
+                       'loggerr': [0.1, 0.1], 'feh': [0.0, 0.1], 'feherr': [0.05, 0.05]})
+    df = add_properties(df, ntrials=20, seed=42)
+    for name in ('mass', 'masserr', 'radius', 'radiuserr', 'lum', 'lumerr'):
+        assert np.isfinite(df[name]).all()
+
+
+def test_ages():
+    with scratch(links=()):
+        grid = {'mass': np.array([0.8, 1.0, 1.2]), 'feh': np.array([-0.5, 0.0, 0.5])}
+        # log age (yr) from 9.5 to 10.1 at all points
+        logage = np.zeros((3, 3, 2)) + [9.5, 10.1]
+        np.savez_compressed('ages.npz', mass=grid['mass'], feh=grid['feh'], logage=logage)
+        age = ages([1.0, 0.9, 2.0], [0.0, 0.1, 0.0], fname='ages.npz', grid=grid)
+        assert np.allclose(age[:2], (10**0.5 + 10**1.1)/2)
+        assert np.isnan(age[2])
@@ -10,7 +10,10 @@ from utils import fun_moog
 from utils import Readmoog
 from utils import error
 from utils import slope
+from utils import linfit, linfit_many
 from utils import _update_par
+from utils import scratch
+from utils import MoogCache, LineCache, Timings
 
 np.random.seed(42)
 
@@ -179,6 +182,18 @@ def test_slope():
         assert max(b) - 1 < 0.1
 
 
+def test_linfit():
+    x = np.arange(10.)
+    y = 2*x + np.random.rand(10)*0.1
+    w = np.random.rand(10)
+    a, b, siga = linfit(x, y, w**2)
+    assert np.allclose([a, b], np.polyfit(x, y, 1, w=w))
+    assert siga > 0
+    a, b, siga = linfit_many([(x, y, w**2), (x[:5], y[:5])])
+    assert np.allclose(a[1], linfit(x[:5], y[:5])[0])
+    assert linfit(np.ones(5), np.arange(5.))[0] == 0
+
+
 def test_update_par():
     with pytest.raises(IOError):
         _update_par(line_list='wrong-file.moog')
@@ -190,3 +205,68 @@ def test_update_par():
     assert os.path.isfile('batch.par')
     _update_par(line_list=ll, plotpars=True)
     assert os.path.isfile('batch.par')
+
+
+def test_scratch():
+    cwd = os.getcwd()
+    with scratch(links=('linelist',), dirs=('results',)) as path:
+        assert os.getcwd() == os.path.realpath(path)
+        assert os.path.isdir('results')
+        assert os.path.isfile('linelist/sun_harps_ganymede.moog')
+    assert os.getcwd() == cwd
+    assert not os.path.isdir(path)
+
+
+def test_moog_cache():
+    cache = MoogCache(maxsize=2)
+    cache.set((5777, 4.44, 0.0, 1.0), 1)
+    cache.set((5800, 4.44, 0.0, 1.0), 2)
+    assert cache.get((5777, 4.44, 0.0, 1.0)) == 1
+    cache.set((5900, 4.44, 0.0, 1.0), 3)
+    # The least recently used result is forgotten
+    assert cache.get((5800, 4.44, 0.0, 1.0)) is None
+    assert cache.get((5777, 4.44, 0.0, 1.0)) == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    with scratch(links=()) as path:
+        cache = MoogCache(path='cache')
+        cache.set((5777, 4.44, 0.0, 1.0), ['summary', (0.1, 0.0, 0.0)])
+        cache = MoogCache(path='cache')
+        assert cache.get((5777, 4.44, 0.0, 1.0)) == ['summary', (0.1, 0.0, 0.0)]
+
+
+def test_line_cache():
+    m = Readmoog(fname='results/sun_harps_ganymede.moog.out')
+    cache = LineCache()
+    cache.add((5777, 4.44, 0.0, 1.0), m, [5777, 4.44, 0.0, 1.0])
+    lines = m.all_table().values[:, :5].astype(float)
+    assert cache.summary((5800, 4.44, 0.0, 1.0), lines) is None
+    summary, params = cache.summary((5777, 4.44, 0.0, 1.0), lines[::2])
+    assert params == [5777, 4.44, 0.0, 1.0]
+    with scratch(links=()):
+        with open('summary.out', 'w') as f:
+            f.writelines(summary)
+        table = Readmoog().all_table()
+    assert np.allclose(table.abund, m.all_table().abund[::2])
+    # A line which has not been seen at this point
+    lines = np.vstack((lines, [5000.0, 26.0, 1.0, -1.0, 50.0]))
+    assert cache.summary((5777, 4.44, 0.0, 1.0), lines) is None
+
+
+def test_timings():
+    timings = Timings()
+    with timings('moog'):
+        with timings('parsing'):
+            pass
+    with timings('moog'):
+        pass
+    timings.count('iterations', 5)
+    timings.count('iterations')
+    slope = timings.timed('slopes')(lambda x: 2*x)
+    assert slope(2) == 4
+    metrics = timings.summary()
+    assert metrics['calls'] == {'moog': 2, 'parsing': 1, 'slopes': 1}
+    assert metrics['counts'] == {'iterations': 6}
+    assert metrics['time']['moog'] >= metrics['time']['parsing']
+    timings.reset()
+    assert timings.summary()['calls'] == {}
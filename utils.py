@@ -3,7 +3,16 @@
 
 from __future__ import division
 import os
-from itertools import islice
+import time
+import pickle
+import hashlib
+import shutil
+import tempfile
+import subprocess
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
 import numpy as np
 
 kurucz95 = {'teff': (3750, 4000, 4250, 4500, 4750, 5000, 5250, 5500, 5750, 6000,
@@ -76,6 +85,7 @@ class GetModels:
         self.grid['teff'] = np.asarray(self.grid['teff'])
         self.grid['logg'] = np.asarray(self.grid['logg'])
         self.grid['feh'] = np.asarray(self.grid['feh'])
+        self.available = None
 
         # Checking for bounds in Teff, logg, and [Fe/H]
         if (self.teff < self.grid['teff'][0]) or (self.teff > self.grid['teff'][-1]):
@@ -135,33 +145,31 @@ class GetModels:
         teff_model : int
           The new Teff. Same Teff is returned if the model exists at the right place
         '''
-
-        fname = self._model_path(teff_model, logg_model, feh_model)
-        if os.path.isfile(fname):
-            return fname, teff_model, logg_model
+        if self.available is None:
+            # Which models exist is looked up in the index of the grid, instead
+            # of on the disk (see modelgrid.available_models)
+            from modelgrid import available_models
+            self.available = available_models(self.atmtype)
+        available = self.available
+        i = self.grid['teff'].searchsorted(teff_model)
+        j = self.grid['logg'].searchsorted(logg_model)
+        k = self.grid['feh'].searchsorted(feh_model)
+        if available[i, j, k]:
+            return self._model_path(teff_model, logg_model, feh_model), teff_model, logg_model
 
         # Change the Teff (up or down) to compensate for the gap
-        teff_model0 = teff_model
-        idx = np.where(teff_model == self.grid['teff'])[0][0]
-        while True:
-            idx = idx+1 if upper else idx-1
-            try:
-                teff_model = self.grid['teff'][idx]
-            except IndexError:
-                teff_model = teff_model0
-                break
-            fname = self._model_path(teff_model, logg_model, feh_model)
-            if os.path.isfile(fname):
-                return fname, teff_model, logg_model
+        teffs = np.flatnonzero(available[:, j, k])
+        teffs = teffs[teffs > i] if upper else teffs[teffs < i][::-1]
+        if len(teffs):
+            teff_model = self.grid['teff'][teffs[0]]
+            return self._model_path(teff_model, logg_model, feh_model), teff_model, logg_model
 
         # Change logg to compensate for missing values
-        idx = np.where(logg_model == self.grid['logg'])[0][0]
         while True:
-            idx += 1
-            logg_model = self.grid['logg'][idx]
-            fname = self._model_path(teff_model, logg_model, feh_model)
-            if os.path.isfile(fname):
-                return fname, teff_model, logg_model
+            j += 1
+            logg_model = self.grid['logg'][j]
+            if available[i, j, k]:
+                return self._model_path(teff_model, logg_model, feh_model), teff_model, logg_model
 
     def _looping_models(self, teff_model, logg_model, feh_model):
         models = []
@@ -192,9 +200,8 @@ class GetModels:
         array : list
           A list with the k surrounding neighbours
         '''
-        for idx, (l1, l2) in enumerate(zip(arr, islice(arr, 1, None))):
-            if l1 <= val <= l2:
-                break
+        # The first interval with arr[idx] <= val <= arr[idx+1]
+        idx = min(max(np.searchsorted(arr, val) - 1, 0), len(arr) - 2)
         if k == 2:
             return [ai for ai in arr[idx:idx+2]]
         elif k == 4:
@@ -246,7 +253,7 @@ class GetModels:
                 'logg': (self.logg, logg_model), 'feh': (self.feh, feh_model)}
 
 
-def _update_par(atmosphere_model='out.atm', line_list='linelist.moog', **kwargs):
+def _update_par(atmosphere_model='out.atm', line_list='linelist.moog', par='batch.par', **kwargs):
     '''Update the parameter file (batch.par) with new linelists, atmosphere
     models, or others.
 
@@ -255,7 +262,9 @@ def _update_par(atmosphere_model='out.atm', line_list='linelist.moog', **kwargs)
     atmosphere_model : str
       Path of the model atmosphere file for MOOG
     line_list : str
-      Path of the line list
+      Path of the line list (relative to the folder of the parameter file)
+    par : str
+      The parameter file to write (default: batch.par)
 
     Additional keyword arguments
     ----------------------------
@@ -290,7 +299,7 @@ def _update_par(atmosphere_model='out.atm', line_list='linelist.moog', **kwargs)
     '''
 
     # Path checks for input files
-    if not os.path.exists(line_list):
+    if not os.path.exists(os.path.join(os.path.dirname(par), line_list)):
         raise IOError('Line list file "%s" could not be found.' % (line_list))
 
     default_kwargs = {
@@ -336,10 +345,79 @@ def _update_par(atmosphere_model='out.atm', line_list='linelist.moog', **kwargs)
         if setting in kwargs:
             moog_contents += "%s %s\n" % (setting + ' ' * (14 - len(setting)), kwargs[setting])
 
-    with open('batch.par', 'w') as moog:
+    with open(par, 'w') as moog:
         moog.writelines(moog_contents)
 
 
+class Timings:
+    '''Wall time and number of calls of each phase of an analysis (e.g.
+    interpolation or moog), and counters (e.g. cache hits). A phase is timed
+    with:
+
+        with timings('moog'):
+            ...
+
+    Phases can be nested, e.g. the MOOG runs inside the error estimation are
+    counted in both. The time of phases running in several threads at the
+    same time is added up.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Start again from zero'''
+        with self.lock:
+            self.start = time.time()
+            self.time = {}
+            self.calls = {}
+            self.counts = {}
+
+    @contextmanager
+    def __call__(self, phase):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            dt = time.time() - t0
+            with self.lock:
+                self.time[phase] = self.time.get(phase, 0.0) + dt
+                self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def timed(self, phase):
+        '''Decorator which times each call of a function as the phase'''
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self(phase):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        '''Add n to a counter'''
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def summary(self):
+        '''The metrics since the last reset
+
+        Output
+        ------
+        metrics : dict
+          wall (seconds since the reset), time (seconds in each phase), calls
+          (of each phase) and counts
+        '''
+        with self.lock:
+            return {'wall': round(time.time() - self.start, 4),
+                    'time': dict((phase, round(t, 4)) for phase, t in self.time.items()),
+                    'calls': dict(self.calls), 'counts': dict(self.counts)}
+
+
+timings = Timings()
+
+
 def _run_moog(par='batch.par'):
     '''Run MOOGSILENT with the given parameter file
 
@@ -352,11 +430,306 @@ def _run_moog(par='batch.par'):
     ------
       Run MOOG once in silent mode
     '''
-    os.system('MOOGSILENT > /dev/null')
+    with open(os.devnull, 'w') as devnull, timings('moog'):
+        subprocess.call(['MOOGSILENT'], stdout=devnull)
+
+
+@contextmanager
+def scratch(links=('models', 'rawLinelist'), dirs=(), keep=False):
+    '''Work inside an isolated temporary directory, so several MOOG runs can
+    happen at the same time without sharing batch.par, out.atm or summary.out
+
+    Inputs
+    ------
+    links : list/tuple
+      Files or directories from the current working directory which are
+      symlinked into the scratch directory (default: models and rawLinelist)
+    dirs : list/tuple
+      Empty directories to create inside the scratch directory
+    keep : bool
+      Keep the scratch directory after leaving the context (default: False)
+
+    Output
+    ------
+    path : str
+      The path of the scratch directory, which is the working directory
+      inside the context
+    '''
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix='fasma_')
+    for link in links:
+        if os.path.exists(os.path.join(cwd, link)):
+            os.symlink(os.path.join(cwd, link), os.path.join(path, link))
+    for d in dirs:
+        os.mkdir(os.path.join(path, d))
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class MoogCache:
+    '''A least recently used cache for the results of fun_moog. The results
+    can also be saved in a folder, so later runs and other processes can use
+    them as well.
+
+    Inputs
+    ------
+    maxsize : int
+      The number of results to keep in memory (default: 4096)
+    path : str
+      Folder to save the results in (default: None, only kept in memory)
+    '''
+
+    def __init__(self, maxsize=4096, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _fname(self, key):
+        '''The file on disk for a key'''
+        return os.path.join(self.path, hashlib.md5(repr(key).encode()).hexdigest() + '.pkl')
+
+    def _store(self, key, value):
+        '''Keep a result in memory, and forget the oldest one if full'''
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def get(self, key):
+        '''Get a result from the cache
+
+        Input
+        -----
+        key : tuple
+          The key of the result (see fun_moog)
+
+        Output
+        ------
+        value : object
+          The result or None if it is not in the cache
+        '''
+        value = self.data.pop(key, None)
+        if value is not None:
+            self.data[key] = value
+            self.hits += 1
+            return value
+        if self.path is not None and os.path.isfile(self._fname(key)):
+            with open(self._fname(key), 'rb') as f:
+                value = pickle.load(f)
+            self._store(key, value)
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        '''Save a result in the cache
+
+        Inputs
+        ------
+        key : tuple
+          The key of the result (see fun_moog)
+        value : object
+          The result
+        '''
+        self._store(key, value)
+        if self.path is not None:
+            if not os.path.isdir(self.path):
+                try:
+                    os.makedirs(self.path)
+                except OSError:  # Made by another process in the meantime
+                    pass
+            # Write to a temporary file first, so other processes never see
+            # half a result
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=2)
+            os.rename(tmp, self._fname(key))
+
+    def clear(self):
+        '''Forget all results in memory'''
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+moog_cache = MoogCache()
+
+
+def _correlation(name, x, y):
+    '''A correlation line as written by MOOG'''
+    if len(x) < 3 or np.ptp(x) == 0:
+        return ' No statistics done for %s trends\n' % name.split()[0]
+    a, b, _ = linfit(x, y)
+    r = np.corrcoef(x, y)[0, 1]
+    if name.startswith('wav'):
+        return '%s  slope = %11s  intercept = %7.3f  corr. coeff. = %7.3f\n' % (name, ('%.3E' % a).replace('E', 'D'), b, r)
+    return '%s  slope = %7.3f  intercept = %7.3f  corr. coeff. = %7.3f\n' % (name, a, b, r)
+
+
+def make_summary(header, titles, rows):
+    '''Make a summary in the layout of MOOG (abfind, version>2013) from the
+    abundances of single lines
+
+    Inputs
+    ------
+    header : list
+      The lines before the first species
+    titles : dict
+      The title of each species (e.g. 26.1), as written by MOOG
+    rows : ndarray
+      A row for each line (wavelength, ID, EP, loggf, EW, logRW, abund,
+      delavg). The species are written in the order they first appear, and
+      delavg is calculated here
+
+    Output
+    ------
+    summary : list
+      The lines of the summary
+    '''
+    summary = list(header)
+    ids = np.round(rows[:, 1], 1)
+    for i, ID in enumerate(sorted(set(ids), key=list(ids).index)):
+        block = rows[ids == ID].copy()
+        abund = block[:, 6]
+        mean = np.mean(abund)
+        std = np.std(abund, ddof=1) if len(abund) > 1 else 0.0
+        block[:, 7] = abund - mean
+        if i:
+            summary.append('\n')
+        summary.append(titles[ID])
+        summary.append('wavelength         ID      EP   logGF     EWin   logRWin     abund   delavg\n')
+        summary += ['%10.3f%11.5f%8.3f%8.3f%9.2f%10.3f%10.3f%9.3f\n' % tuple(row) for row in block]
+        summary.append('average abundance = %6.3f     std. deviation = %6.3f     #lines = %3i\n' % (mean, std, len(abund)))
+        summary.append(_correlation('E.P. correlation:', block[:, 2], abund))
+        summary.append(_correlation('R.W. correlation:', block[:, 5], abund))
+        summary.append(_correlation('wav. correl.:', block[:, 0], abund))
+    return summary
+
+
+class LineCache:
+    '''The abundance of each line from earlier runs of MOOG (abfind), kept
+    for each point (Teff, logg, [Fe/H], vt). The abundance of a line does not
+    depend on the other lines in the line list, so the summary of any subset
+    of the lines can be made from here, without running MOOG at a point it
+    has already seen. Only for MOOG versions with the ID column (>2013).
+
+    Input
+    -----
+    maxsize : int
+      The number of points to keep (default: 512)
+    '''
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.points = OrderedDict()
+
+    def clear(self):
+        '''Forget all points'''
+        self.points.clear()
+
+    def _keys(self, lines):
+        '''Keys of the lines from (wavelength, ID, EP, loggf, EW)'''
+        lines = np.atleast_2d(lines)
+        return list(zip(*[np.round(lines[:, i], d) for i, d in enumerate((2, 1, 2, 3, 1))]))
 
+    def add(self, point, m, params):
+        '''Keep the lines from a run of MOOG
+
+        Inputs
+        ------
+        point : tuple
+          The key of the point (see fun_moog)
+        m : Readmoog
+          The results from MOOG
+        params : list
+          The parameters returned by the interpolation
+        '''
+        entry = self.points.pop(point, None)
+        if entry is None:
+            start = [i for i, line in enumerate(m.lines) if line.startswith('Abundance Results')]
+            entry = {'header': m.lines[:start[0]] if start else m.lines,
+                     'titles': {}, 'rows': {}, 'params': list(params)}
+        titles = [line for line in m.lines if line.startswith('Abundance Results')]
+        for title, block in zip(titles, m.species()):
+            if not len(block['lines']):
+                continue
+            entry['titles'][round(block['lines'][0, 1], 1)] = title
+            entry['rows'].update(zip(self._keys(block['lines']), block['lines']))
+        self.points[point] = entry
+        while len(self.points) > self.maxsize:
+            self.points.popitem(last=False)
+
+    def summary(self, point, lines):
+        '''Make the summary from MOOG for a line list at a point
+
+        Inputs
+        ------
+        point : tuple
+          The key of the point (see fun_moog)
+        lines : ndarray
+          The line list (wavelength, element, EP, loggf, EW)
 
-def fun_moog(x, atmtype, par='batch.par', results='summary.out', weights='null',
-             version=2014):
+        Outputs
+        -------
+        summary : list
+          The lines of the summary
+        params : list
+          The parameters returned by the interpolation
+        Returns None if not all lines have been seen at this point.
+        '''
+        entry = self.points.pop(point, None)
+        if entry is None:
+            return None
+        self.points[point] = entry
+        try:
+            rows = np.array([entry['rows'][key] for key in self._keys(lines)])
+        except KeyError:
+            return None
+
+        summary = make_summary(entry['header'], entry['titles'], rows)
+        return summary, list(entry['params'])
+
+
+line_cache = LineCache()
+
+
+def _linelist_hash(lines):
+    '''A hash of the content of a line list
+
+    Input
+    -----
+    lines : str/ndarray
+      The path to the line list, or the line list as an array
+
+    Output
+    ------
+    hash : str
+      The md5 hash of the line list
+    '''
+    if isinstance(lines, str):
+        with open(lines, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+    return hashlib.md5(np.ascontiguousarray(lines, dtype=float).tobytes()).hexdigest()
+
+
+def _lines_in(par='batch.par'):
+    '''The line list used in a parameter file for MOOG'''
+    with open(par, 'r') as f:
+        for line in f:
+            if line.startswith('lines_in'):
+                return os.path.join(os.path.dirname(par), line.split("'")[1])
+    raise IOError('No line list in: %s' % par)
+
+
+def fun_moog(x, atmtype, par='batch.par', results=None, weights='null',
+             version=2014, engine=None, cache=True, table=None):
     '''Run MOOG and return slopes for abfind mode.
 
     Inputs
@@ -368,11 +741,26 @@ def fun_moog(x, atmtype, par='batch.par', results='summary.out', weights='null',
     par : str
       The configuration file for MOOG (default: batch.par)
     results : str
-      The summary file of MOOG
+      The summary file of MOOG (default: summary.out, or in the folder of the
+      engine). With an engine it is only written when the results come from
+      a cache or a table
     weights : str
       The weights to be used in the slope calculation
     version : int
       The version of MOOG (default:2014)
+    engine : MoogEngine/MoogPool
+      Run MOOG with this engine (see moogengine.py) instead of using batch.par,
+      out.atm and summary.out in the working directory (default: None)
+    cache : bool/MoogCache
+      Reuse the results of earlier runs with the same parameters (rounded),
+      atmosphere type, version, weights and line list, and the abundances of
+      single lines at the same point (see LineCache). If True the module
+      wide moog_cache is used (default: True)
+    table : COGTable
+      Take the abundances from a curve-of-growth table instead of MOOG, if
+      the table has all the lines and the point is inside it (see
+      cogtable.py). Only for MOOG versions with the ID column (>2013). These
+      results are not cached (default: None)
 
     Output
     ------
@@ -380,27 +768,82 @@ def fun_moog(x, atmtype, par='batch.par', results='summary.out', weights='null',
     '''
 
     from interpolation import interpolator
+    if results is None:
+        results = 'summary.out' if engine is None else os.path.join(engine.path, 'summary.out')
+    if cache is True:
+        cache = moog_cache
+    if cache:
+        lines = _lines_in(par) if engine is None else engine.lines
+        key = (int(round(x[0])), round(x[1], 2), round(x[2], 2), round(x[3], 2),
+               atmtype, version, weights, _linelist_hash(lines))
+        value = cache.get(key)
+        if value is not None:
+            timings.count('moog_cache_hits')
+            summary, (res, EPs, RWs, abundances, x) = value
+            # Later steps read the summary from MOOG
+            with open(results, 'w') as f:
+                f.writelines(summary)
+            return res, EPs, RWs, list(abundances), list(x)
+
+    # All the lines may have been seen at this point before (e.g. before an
+    # outlier was removed), so the summary can be made without MOOG
+    point = (int(round(x[0])), round(x[1], 2), round(x[2], 2), round(x[3], 2), atmtype, version)
+    perline = cache and version > 2013
+    summary = None
+    if table is not None and version > 2013:
+        lines = _lines_in(par) if engine is None else engine.lines
+        linelist = np.loadtxt(lines, skiprows=1, usecols=range(5)) if isinstance(lines, str) else lines
+        summary = table.summary(x, linelist)
+        if summary is not None:
+            timings.count('table_hits')
+            perline = cache = False
+    if perline:
+        linelist = np.loadtxt(lines, skiprows=1, usecols=range(5)) if isinstance(lines, str) else lines
+        summary = line_cache.summary(point, linelist)
+        if summary is not None:
+            timings.count('line_cache_hits')
+
     # Create an atmosphere model from input parameters
     teff, logg, feh, _ = x
-    _, x = interpolator(x, atmtype=atmtype, result=True)
-
-    # Run MOOG and get the slopes and abundances
-    _run_moog(par=par)
-    m = Readmoog(params=x, fname=results, version=version)
-    _, _, _, _, _, _, data, _ = m.fe_statistics()
+    if summary is not None:
+        summary, x = summary
+        with open(results, 'w') as f:
+            f.writelines(summary)
+        m = Readmoog(params=x, fname=results, version=version)
+    elif engine is None:
+        _, x = interpolator(x, atmtype=atmtype, result=True)
+        # Run MOOG and get the slopes and abundances
+        _run_moog(par=par)
+        m = Readmoog(params=x, fname=results, version=version)
+    else:
+        atmosphere, x = interpolator(x, atmtype=atmtype, save=False, result=True)
+        m = engine.abfind(atmosphere, x)
+        results = m.fname
+    if perline and summary is None:
+        line_cache.add(point, m, x)
+    fe1, _, fe2, _, _, _, data, _ = m.fe_statistics()
     if version > 2013:
         EPs, _ = slope((data[:, 2], data[:, 6]), weights=weights)
         RWs, _ = slope((data[:, 5], data[:, 6]), weights=weights)
     else:
         EPs, _ = slope((data[:, 1], data[:, 5]), weights=weights)
         RWs, _ = slope((data[:, 4], data[:, 5]), weights=weights)
-    m = Readmoog(params=x, fname=results, version=version)
-    fe1, _, fe2, _, _, _, _, _ = m.fe_statistics()
     abundances = [fe1+7.47, fe2+7.47]
     res = EPs**2 + RWs**2 + np.diff(abundances)[0]**2
+    if cache:
+        cache.set(key, (m.lines, (res, EPs, RWs, list(abundances), list(x))))
     return res, EPs, RWs, abundances, x
 
 
+def _slope_value(line):
+    '''The slope from a correlation line in the output from MOOG, or False
+    if there is none (e.g. "No statistics done for R.W. trends")'''
+    try:
+        return float(line.split()[4])
+    except (ValueError, IndexError):
+        return False
+
+
 class Readmoog:
     '''Read the output file from MOOG and return some useful informations
 
@@ -417,10 +860,9 @@ class Readmoog:
 
     def __init__(self, params=None, fname='summary.out', version=2014):
         self.fname = fname
-        self.nelements = 1
         self.idx = 1 if version > 2013 else 0
         self.version = version
-        with open(self.fname, 'r') as f:
+        with open(self.fname, 'r') as f, timings('parsing'):
             self.lines = f.readlines()
         if params:
             self.teff = params[0]
@@ -449,6 +891,56 @@ class Readmoog:
         self.params = self.teff, self.logg, self.feh, self.vt
         return self.params
 
+    def species(self):
+        '''Parse the blocks of each species in the output file. The file is
+        only parsed once, and the tables are converted to arrays in one go.
+
+        Output
+        ------
+        blocks : list
+          A dict for each species with the keys: element (e.g. FeI), lines
+          (the table as in fe_statistics), abundance, sigma, nlines, slopeEP
+          and slopeRW. The statistics are None if not found in the file.
+        '''
+        if getattr(self, 'blocks', None) is not None:
+            return self.blocks
+        with timings('parsing'):
+            self.blocks = self._parse()
+        return self.blocks
+
+    def _parse(self):
+        '''The blocks of each species (see species)'''
+        ncols = 7 + self.idx
+        starts = [i for i, line in enumerate(self.lines) if line.startswith('Abundance Results')]
+        blocks = []
+        for start, end in zip(starts, starts[1:] + [len(self.lines)]):
+            block = self.lines[start:end]
+            species = block[0].split()
+            info = {'element': species[4] + species[5], 'abundance': None,
+                    'sigma': None, 'nlines': None, 'slopeEP': None, 'slopeRW': None}
+            table = []
+            readdata = False
+            for line in block[1:]:
+                if line.startswith('wavelength'):
+                    readdata = True
+                elif '#lines' in line:
+                    readdata = False
+                    line = line.split()
+                    info['abundance'] = float(line[3])
+                    info['sigma'] = float(line[7])
+                    info['nlines'] = int(line[-1])
+                elif readdata:
+                    table.append(line)
+                elif 'E.P.' in line:
+                    info['slopeEP'] = _slope_value(line)
+                elif 'R.W.' in line:
+                    info['slopeRW'] = _slope_value(line)
+            # All rows of the table are converted at once
+            values = np.array(' '.join(table).split(), dtype=float)
+            info['lines'] = values.reshape(len(table), -1)[:, :ncols] if table else np.zeros((0, ncols))
+            blocks.append(info)
+        return blocks
+
     def fe_statistics(self):
         '''Get statistics on Fe lines
 
@@ -472,71 +964,17 @@ class Readmoog:
         linesFe2 : ndarray
           Same as for linesFe1 but for FeII
         '''
-        self.readdata = False
-        self.slopeEP = False
-        self.slopeRW = False
-        self.Fe1Lines = []
-        self.Fe2Lines = []
-        for line in self.lines:
-            if '#lines' in line and self.nelements == 1:  # Statistics on FeI
-                line = line.split()
-                self.readdata = False
-                self.nfe1 = int(line[-1])
-                self.fe1 = float(line[3])
-                self.sigfe1 = float(line[7])
-            elif '#lines' in line and self.nelements == 2:  # Statistics on FeII
-                line = line.split()
-                self.readdata = False
-                self.nfe2 = int(line[-1])
-                self.fe2 = float(line[3])
-                self.sigfe2 = float(line[7])
-            elif 'E.P.' in line and self.nelements == 1:  # We only want information from FeI
-                line = line.split()
-                try:
-                    self.slopeEP = float(line[4])
-                except ValueError:
-                    self.slopeEP = False
-            elif 'R.W.' in line and self.nelements == 1:  # We only want information from FeI
-                line = line.split()
-                self.nelements += 1  # Done with this element, move to next one
-                try:
-                    self.slopeRW = float(line[4])
-                except ValueError:
-                    self.slopeRW = False
-            else:
-                if line.startswith('wavelength'):
-                    self.readdata = True
-                    continue
-            if self.readdata:
-                content = list(map(float, filter(None, line.split(' '))))
-                if self.nelements == 1:
-                    self.Fe1Lines.append(content)
-                else:
-                    self.Fe2Lines.append(content)
-
-        # Store the line information in numpy arrays because lists are not for science!
-        self.linesFe1 = np.zeros((len(self.Fe1Lines), 7+self.idx))
-        self.linesFe2 = np.zeros((len(self.Fe2Lines), 7+self.idx))
-        for i, f1 in enumerate(self.Fe1Lines):
-            self.linesFe1[i, 0] = f1[0]
-            self.linesFe1[i, 1] = f1[1]
-            self.linesFe1[i, 2] = f1[2]
-            self.linesFe1[i, 3] = f1[3]
-            self.linesFe1[i, 4] = f1[4]
-            self.linesFe1[i, 5] = f1[5]
-            self.linesFe1[i, 6] = f1[6]
-            if self.version > 2013:
-                self.linesFe1[i, 7] = f1[7]
-        for i, f2 in enumerate(self.Fe2Lines):
-            self.linesFe2[i, 0] = f2[0]
-            self.linesFe2[i, 1] = f2[1]
-            self.linesFe2[i, 2] = f2[2]
-            self.linesFe2[i, 3] = f2[3]
-            self.linesFe2[i, 4] = f2[4]
-            self.linesFe2[i, 5] = f2[5]
-            self.linesFe2[i, 6] = f2[6]
-            if self.version > 2013:
-                self.linesFe2[i, 7] = f2[7]
+        blocks = self.species()
+        if len(blocks) < 2 or blocks[-1]['nlines'] is None:
+            raise ValueError('No FeII lines were measured.')
+        # FeI is the first species, and everything after it counts as FeII
+        fe1, fe2 = blocks[0], blocks[-1]
+        self.fe1, self.sigfe1, self.nfe1 = fe1['abundance'], fe1['sigma'], fe1['nlines']
+        self.fe2, self.sigfe2, self.nfe2 = fe2['abundance'], fe2['sigma'], fe2['nlines']
+        self.linesFe1 = fe1['lines']
+        self.linesFe2 = np.vstack([block['lines'] for block in blocks[1:]])
+        self.slopeEP = fe1['slopeEP']
+        self.slopeRW = fe1['slopeRW']
 
         # If We don't have any RW slope, calculate it manually
         if not self.slopeRW:
@@ -544,10 +982,7 @@ class Readmoog:
         if not self.slopeEP:
             self.slopeEP, _ = np.polyfit(self.linesFe1[:, 1+self.idx], self.linesFe1[:, 5+self.idx], 1)
         self.sigfe1 = self.sigfe1 / np.sqrt(self.nfe1)
-        try:
-            self.sigfe2 = self.sigfe2 / np.sqrt(self.nfe2)
-        except AttributeError:
-            raise ValueError('No FeII lines were measured.')
+        self.sigfe2 = self.sigfe2 / np.sqrt(self.nfe2)
         return self.fe1-7.47, self.sigfe1, self.fe2-7.47, self.sigfe2, self.slopeEP, self.slopeRW, self.linesFe1, self.linesFe2
 
     def elements(self):
@@ -560,17 +995,9 @@ class Readmoog:
         abundances : list
           The corresponding abundances to the elements
         '''
-        abundances = []
-        element = []
-        for line in self.lines:
-            # Get the average abundance
-            if line.startswith('average abundance'):
-                line = filter(None, line.split('abundance =')[1].split(' '))
-                abundances.append(float(line[0]))
-            # Get element
-            elif line.startswith('Abundance'):
-                line = filter(None, line.split(' '))
-                element.append(str(line[4])+str(line[5]))
+        blocks = [block for block in self.species() if block['abundance'] is not None]
+        element = [block['element'] for block in blocks]
+        abundances = [block['abundance'] for block in blocks]
         return element, abundances
 
     def all_table(self):
@@ -584,26 +1011,15 @@ class Readmoog:
           abundance, and delavg
         '''
         import pandas as pd
-        table = []
-        readLine = False
-        for line in self.lines:
-            if line.startswith('wavelength'):
-                readLine = True
-                continue
-            if readLine and line.startswith('average abundance'):
-                readLine = False
-            if readLine:
-                table.append(line)
-            else:
-                continue
-
+        lines = [block['lines'] for block in self.species()]
+        lines = np.vstack(lines) if lines else np.zeros((0, 7+self.idx))
         if self.version > 2013:
             cols = 'wavelength,ID,EP,logGF,EWin,logRWin,abund,delavg'.split(',')
-            table = pd.DataFrame([t.strip().split() for t in table], columns=cols, dtype=float)
+            table = pd.DataFrame(lines, columns=cols)
             table['atom'] = [self.atomNameFromMOOG(str(atomic)) for atomic in table.ID]
         else:
             cols = 'wavelength,EP,logGF,EWin,logRWin,abund,delavg'.split(',')
-            table = pd.DataFrame([t.strip().split() for t in table], columns=cols, dtype=float)
+            table = pd.DataFrame(lines, columns=cols)
         return table
 
     def atomNameFromMOOG(self, atomic):
@@ -642,6 +1058,81 @@ class Readmoog:
         return atoms[int(n1)] + 'I' * (int(n2)+1)
 
 
+def linfit(x, y, w=None):
+    '''Weighted least squares fit of a straight line, y = a*x + b, in closed
+    form. Same as a WLS fit in statsmodels, where each point adds w*r**2 to
+    the sum of squares. Several data sets can be fitted at once by stacking
+    them along the first axis; points with w=0 are left out.
+
+    Inputs
+    ------
+    x : array_like
+      Independent values, the fit is done along the last axis
+    y : array_like
+      Dependent values
+    w : array_like
+      Weights of the points (default: None, all points have weight 1)
+
+    Outputs
+    -------
+    a : float/ndarray
+      The slope. It is 0 if all x are the same
+    b : float/ndarray
+      The intercept
+    siga : float/ndarray
+      The standard error on the slope
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    w = np.ones(np.broadcast(x, y).shape) if w is None else np.asarray(w, dtype=float)
+    W = np.sum(w, axis=-1)
+    xm = np.sum(w*x, axis=-1) / W
+    ym = np.sum(w*y, axis=-1) / W
+    dx = x - xm[..., np.newaxis]
+    dy = y - ym[..., np.newaxis]
+    Sxx = np.sum(w*dx*dx, axis=-1)
+    Sxy = np.sum(w*dx*dy, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = np.where(Sxx > 0, Sxy/Sxx, 0.0)
+        b = ym - a*xm
+        r = dy - a[..., np.newaxis]*dx
+        n = np.sum(w > 0, axis=-1)
+        siga = np.sqrt(np.sum(w*r*r, axis=-1) / (n-2) / Sxx)
+    if a.ndim == 0:
+        return float(a), float(b), float(siga)
+    return a, b, siga
+
+
+def linfit_many(sets):
+    '''Fit straight lines to many data sets of different lengths at once
+    (see linfit)
+
+    Input
+    -----
+    sets : list
+      A list of (x, y) or (x, y, w) for each data set
+
+    Outputs
+    -------
+    a : ndarray
+      The slopes
+    b : ndarray
+      The intercepts
+    siga : ndarray
+      The standard errors on the slopes
+    '''
+    N = max([len(s[0]) for s in sets])
+    x = np.zeros((len(sets), N))
+    y = np.zeros((len(sets), N))
+    w = np.zeros((len(sets), N))
+    for i, s in enumerate(sets):
+        n = len(s[0])
+        x[i, :n] = s[0]
+        y[i, :n] = s[1]
+        w[i, :n] = s[2] if len(s) > 2 else 1
+    return linfit(x, y, w)
+
+
 def _slopeSigma(x, y, weights):
     '''Sigma on a slope after fitting a straight line
 
@@ -661,12 +1152,26 @@ def _slopeSigma(x, y, weights):
     '''
     N = len(x)
     var = np.var(x) * N
-    a, b = np.polyfit(x, y, 1, w=weights)
+    # The weights of polyfit multiply the residuals, not their squares
+    a, b, _ = linfit(x, y, np.asarray(weights)**2)
     chi2 = np.sum((y - a*x-b)**2)
     return np.sqrt(chi2/((N-2)*var))
 
 
-def error(linelist, converged, params, atmtype, version=2014, weights='null'):
+def _perturbation(engine, atmtype, version, x, xalt):
+    '''Run MOOG at x, or at xalt if that fails, and get the statistics on
+    the Fe lines (see Readmoog.fe_statistics)'''
+    results = os.path.join(engine.path, 'summary.out')
+    try:
+        fun_moog(x, atmtype, results=results, version=version, engine=engine)
+    except ValueError:
+        x = xalt
+        fun_moog(x, atmtype, results=results, version=version, engine=engine)
+    return Readmoog(params=x, fname=results, version=version).fe_statistics()
+
+
+def error(linelist, converged, params, atmtype, version=2014, weights='null',
+          steps=(100, 0.20, 0.10), parallel=True):
     '''Error estimation on a given line list
 
     Inputs
@@ -684,6 +1189,11 @@ def error(linelist, converged, params, atmtype, version=2014, weights='null'):
       The version of MOOG (default: 2014)
     weights : str
       The weights to be applied for slope calculation (default: 'null')
+    steps : list/tuple
+      The perturbations of (Teff, logg, vt) (default: (100, 0.20, 0.10))
+    parallel : bool
+      Run MOOG for the three perturbations at the same time, each with its
+      own MoogEngine (default: True)
 
     Outputs
     -------
@@ -704,6 +1214,8 @@ def error(linelist, converged, params, atmtype, version=2014, weights='null'):
     errormicro : float
       Error on microturbulence
     '''
+    from threading import Thread
+    from moogengine import MoogEngine
     # Find the output file and read the current state of it
     idx = 1 if version > 2013 else 0
     if converged:
@@ -712,13 +1224,12 @@ def error(linelist, converged, params, atmtype, version=2014, weights='null'):
     else:
         m = Readmoog(params=params, fname='results/%s.NC.out' % linelist, version=version)
         summary = m.fe_statistics()
-    # Read the correct output file (error_summary.out).
-    _update_par(line_list='linelist/%s' % linelist, summary='error_summary.out')
     data = summary[6]
     _, weights = slope((data[:, 1+idx], data[:, 5+idx]), weights=weights)
 
     # Prepare the different things we need
     teff, logg, feh, vt = m.parameters()
+    dteff, dlogg, dvt = steps
     Fe1 = summary[-2]
     sigmafe1 = summary[1]
     sigmafe2 = summary[3]
@@ -726,45 +1237,61 @@ def error(linelist, converged, params, atmtype, version=2014, weights='null'):
     siga1 = _slopeSigma(Fe1[:, 4+idx], Fe1[:, 5+idx], weights=weights)
     siga2 = _slopeSigma(Fe1[:, 1+idx], Fe1[:, 5+idx], weights=weights)
 
-    # Error om microturbulence
+    # The perturbed parameters, and the ones to use if those fail. They do
+    # not depend on each other, so MOOG can run for all of them at once.
+    jobs = {'vt': ((teff, logg, feh, vt+dvt), (teff, logg, feh, vt-dvt)),
+            'teff': ((teff+dteff, logg, feh, vt), (teff-dteff, logg, feh, vt)),
+            'logg': ((teff, logg-dlogg, feh, vt), (teff, logg+dlogg, feh, vt))}
+    engines = {}
+    perturbed = {}
+
+    def run(name):
+        try:
+            perturbed[name] = _perturbation(engines[name], atmtype, version, *jobs[name])
+        except Exception as e:
+            perturbed[name] = e
+
     try:
-        fun_moog((teff, logg, feh, vt+0.1), atmtype, results='error_summary.out', version=version)
-        sumvt = Readmoog(params=(teff, logg, feh, vt+0.1), fname='error_summary.out', version=version).fe_statistics()
-    except ValueError:
-        fun_moog((teff, logg, feh, vt-0.1), atmtype, results='error_summary.out', version=version)
-        sumvt = Readmoog(params=(teff, logg, feh, vt-0.1), fname='error_summary.out', version=version).fe_statistics()
+        # Made one at a time, so the ones made are closed if one fails
+        for name in jobs:
+            engines[name] = MoogEngine('linelist/%s' % linelist, version=version)
+        if parallel:
+            threads = [Thread(target=run, args=(name,)) for name in jobs]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            for name in jobs:
+                run(name)
+    finally:
+        for engine in engines.values():
+            engine.close()
+    for name in ('vt', 'teff', 'logg'):
+        if isinstance(perturbed[name], Exception):
+            raise perturbed[name]
+    sumvt, sumteff, sumlogg = perturbed['vt'], perturbed['teff'], perturbed['logg']
+
+    # Error om microturbulence
     slopeEP, slopeRW = sumvt[4], sumvt[5]
     if slopeRW == 0:
-        errormicro = abs(siga1/0.001) * 0.10
+        errormicro = abs(siga1/0.001) * dvt
     else:
-        errormicro = abs(siga1/slopeRW) * 0.10
+        errormicro = abs(siga1/slopeRW) * dvt
 
     # Contribution to [Fe/H]
-    deltafe1micro = abs((errormicro/0.10) * (sumvt[0]-feh))
+    deltafe1micro = abs((errormicro/dvt) * (sumvt[0]-feh))
 
     # Error on Teff
-    slopes = errormicro/0.10 * slopeEP
+    slopes = errormicro/dvt * slopeEP
     errorslopeEP = np.hypot(slopes, siga2)
-    try:
-        fun_moog((teff+100, logg, feh, vt), atmtype, results='error_summary.out', version=version)
-        sumteff = Readmoog(params=(teff+100, logg, feh, vt), fname='error_summary.out', version=version).fe_statistics()
-    except ValueError:
-        fun_moog((teff-100, logg, feh, vt), atmtype, results='error_summary.out', version=version)
-        sumteff = Readmoog(params=(teff-100, logg, feh, vt), fname='error_summary.out', version=version).fe_statistics()
-
-    errorteff = abs(errorslopeEP/sumteff[4]) * 100
+    errorteff = abs(errorslopeEP/sumteff[4]) * dteff
     # Contribution to [Fe/H]
-    deltafe1teff = abs((errorteff/100) * (sumteff[0]-feh))
+    deltafe1teff = abs((errorteff/dteff) * (sumteff[0]-feh))
     # Error on logg
-    fe2error = abs(errorteff/100 * (sumteff[2]-feh))
+    fe2error = abs(errorteff/dteff * (sumteff[2]-feh))
     sigmafe2total = np.hypot(sigmafe2, fe2error)
-    try:
-        fun_moog((teff, logg-0.20, feh, vt), atmtype, results='error_summary.out', version=version)
-        sumlogg = Readmoog(params=(teff, logg-0.20, feh, vt), fname='error_summary.out', version=version).fe_statistics()
-    except ValueError:
-        fun_moog((teff, logg+0.20, feh, vt), atmtype, results='error_summary.out', version=version)
-        sumlogg = Readmoog(params=(teff, logg+0.20, feh, vt), fname='error_summary.out', version=version).fe_statistics()
-    errorlogg = abs(sigmafe2total/(sumlogg[2]-feh)*0.20)
+    errorlogg = abs(sigmafe2total/(sumlogg[2]-feh)*dlogg)
 
     # Error on [Fe/H]
     errorfeh = np.sqrt(sigmafe1**2 + deltafe1teff**2 + deltafe1micro**2)
@@ -774,10 +1301,10 @@ def error(linelist, converged, params, atmtype, version=2014, weights='null'):
     errorfeh = round(errorfeh, 2)
     errormicro = round(errormicro, 2)
 
-    os.remove('error_summary.out')
     return teff, errorteff, logg, errorlogg, feh, errorfeh, vt, errormicro
 
 
+@timings.timed('slopes')
 def slope(data, weights='null'):
     '''Calculate the slope of a data set with weights.
 
@@ -801,15 +1328,14 @@ def slope(data, weights='null'):
     w : ndarray
       The weights used
     '''
-    import statsmodels.formula.api as sm
     weights = weights.lower()
     options = ['null', 'sigma', 'mad']
     if weights not in options:
         weights = None
 
     data = {'x': data[0], 'y': data[1]}
-    fit = np.polyfit(data['x'], data['y'], 1)
-    Y = np.poly1d(fit)(data['x'])
+    a, b, _ = linfit(data['x'], data['y'])
+    Y = a*np.asarray(data['x']) + b
     dif = data['y'] - Y
 
     if not weights:
@@ -838,5 +1364,4 @@ def slope(data, weights='null'):
         mask1 = abs(data['y'] - Y) < mad
         w[mask1] = 1.0
 
-    wls = sm.wls('y ~ x', data=data, weights=w).fit()
-    return wls.params[1], w
+    return linfit(data['x'], data['y'], w)[0], w